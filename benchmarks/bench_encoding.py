@@ -0,0 +1,81 @@
+"""Micro-benchmark of encoding hits for the bulk tracking api.
+
+Compares the encoding used before `HitEncoder` (`json.dumps` of `cvar`, `urlencode`
+of the hit and `json.dumps` of the bulk payload) with `HitEncoder`.
+
+Run with:
+
+    python benchmarks/bench_encoding.py
+"""
+
+import json
+import random
+import timeit
+import urllib.parse
+
+from flask_matomo2.encoding import HitEncoder
+
+BATCH_SIZE = 100
+REPEAT = 5
+NUMBER = 200
+
+
+def make_hit(i: int) -> dict:
+    return {
+        "idsite": "1",
+        "rec": "1",
+        "apiv": "1",
+        "send_image": "0",
+        "action_name": f"/api/items/<int:item_id>/{i % 10}",
+        "url": f"https://example.com/api/items/{i}",
+        "ua": "Mozilla/5.0 (X11; Linux x86_64; rv:128.0) Gecko/20100101 Firefox/128.0",
+        "cvar": {"http_status_code": 200, "http_method": "GET"},
+        "rand": random.getrandbits(32),
+        "token_auth": "XXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXX",
+        "cip": "127.0.0.1",
+        "lang": "sv",
+        "gt_ms": random.random() * 100,
+    }
+
+
+def encode_with_urlencode(hits: list) -> bytes:
+    requests = []
+    for hit in hits:
+        data = {key: value for key, value in hit.items() if key != "token_auth"}
+        data["cvar"] = json.dumps(data["cvar"])
+        requests.append(f"?{urllib.parse.urlencode(data)}")
+    payload = {"requests": requests, "token_auth": "XXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXX"}
+    return json.dumps(payload).encode("utf-8")
+
+
+def encode_with_hit_encoder(encoder: HitEncoder, hits: list) -> bytes:
+    return encoder.encode_bulk(
+        [encoder.encode(hit) for hit in hits], token_auth="XXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXX"
+    )
+
+
+def main() -> None:
+    hits = [make_hit(i) for i in range(BATCH_SIZE)]
+    encoder = HitEncoder()
+    assert json.loads(encode_with_urlencode(hits)) == json.loads(
+        encode_with_hit_encoder(encoder, hits)
+    )
+
+    results = {
+        "urlencode": min(
+            timeit.repeat(lambda: encode_with_urlencode(hits), repeat=REPEAT, number=NUMBER)
+        ),
+        "HitEncoder": min(
+            timeit.repeat(
+                lambda: encode_with_hit_encoder(encoder, hits), repeat=REPEAT, number=NUMBER
+            )
+        ),
+    }
+    for name, seconds in results.items():
+        us_per_hit = seconds / (NUMBER * BATCH_SIZE) * 1e6
+        print(f"{name:>12}: {us_per_hit:6.2f} us/hit")
+    print(f"{'speedup':>12}: {results['urlencode'] / results['HitEncoder']:6.2f}x")
+
+
+if __name__ == "__main__":
+    main()
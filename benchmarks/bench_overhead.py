@@ -0,0 +1,307 @@
+"""Benchmark of the per-request overhead and the tracking throughput of `Matomo`.
+
+Compares a bare Flask app with the same app with `Matomo` attached, for every send mode
+and number of `ignored_patterns`, with hits sent to `flask_matomo2.testing.FakeMatomo`,
+written to files ("file") or kept in memory ("memory", the cost of the extension itself).
+For every scenario it reports:
+
+- the added p50/p99 latency per request, compared to the bare app,
+- the hits per second delivered by the transport,
+- the memory allocated per request, compared to the bare app (measured with tracemalloc).
+
+Run with:
+
+    python benchmarks/bench_overhead.py --json results.json
+
+To catch regressions, compare the results with the results of an earlier commit:
+
+    python benchmarks/bench_overhead.py --compare results.json
+
+which fails if the added p50 latency of a scenario grew by more than `--tolerance`.
+"""
+
+import argparse
+import gc
+import json
+import os
+import pathlib
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import typing
+
+from flask import Flask
+
+from flask_matomo2 import Matomo
+from flask_matomo2.hitlog import read_hits
+from flask_matomo2.testing import FakeMatomo
+from flask_matomo2.transports import InMemoryTransport
+
+# the send modes and "memory", an `InMemoryTransport`
+SCENARIOS = ("sync", "background", "async", "collector", "file", "memory")
+IGNORED_PATTERN_COUNTS = (0, 10, 100)
+WARMUP = 200
+ALLOC_REQUESTS = 200
+TOKEN_AUTH = "X" * 32
+
+
+def make_app() -> Flask:
+    app = Flask(__name__)
+
+    @app.route("/items/<int:item_id>")
+    def item(item_id: int):
+        return f"item {item_id}"
+
+    return app
+
+
+def percentile(values: typing.List[float], percent: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+def measure_latency(app: Flask, requests: int) -> typing.List[float]:
+    """Return the latency in microseconds of `requests` requests."""
+    client = app.test_client()
+    for i in range(WARMUP):
+        client.get(f"/items/{i}")
+    latencies = []
+    for i in range(requests):
+        start_ns = time.perf_counter_ns()
+        client.get(f"/items/{i}")
+        latencies.append((time.perf_counter_ns() - start_ns) / 1000)
+    return latencies
+
+
+def measure_allocations(app: Flask) -> float:
+    """Return the mean number of KiB allocated while handling a request."""
+    client = app.test_client()
+    gc.collect()
+    tracemalloc.start()
+    allocated = 0
+    for i in range(ALLOC_REQUESTS):
+        start, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        client.get(f"/items/{i}")
+        _, peak = tracemalloc.get_traced_memory()
+        allocated += peak - start
+    tracemalloc.stop()
+    return allocated / ALLOC_REQUESTS / 1024
+
+
+def make_tracked_app(
+    scenario: str,
+    ignored_patterns: int,
+    fake: FakeMatomo,
+    collector_socket: typing.Optional[str],
+    hit_log_dir: str,
+) -> typing.Tuple[Flask, Matomo]:
+    send_mode = scenario
+    kwargs: typing.Dict[str, typing.Any] = {}
+    if scenario == "collector":
+        kwargs["collector_socket"] = collector_socket
+    elif scenario in ("background", "async"):
+        kwargs["max_batch_size"] = 100
+        kwargs["max_batch_delay"] = 0.1
+    elif scenario == "file":
+        kwargs["hit_log_dir"] = hit_log_dir
+    elif scenario == "memory":
+        send_mode = "sync"
+        kwargs["transport"] = InMemoryTransport()
+    app = make_app()
+    matomo = Matomo(
+        app,
+        matomo_url=fake.url,
+        id_site=1,
+        token_auth=TOKEN_AUTH,
+        send_mode=send_mode,
+        ignored_patterns=[f"/ignored/{i}/.*" for i in range(ignored_patterns)],
+        **kwargs,
+    )
+    return app, matomo
+
+
+def start_collector(socket_path: str, fake: FakeMatomo) -> subprocess.Popen:
+    """Run the collector in its own process, like in production."""
+    process = subprocess.Popen(  # noqa: S603
+        [
+            sys.executable,
+            "-c",
+            "from flask_matomo2.collector import main; main()",
+            f"--socket={socket_path}",
+            f"--matomo-url={fake.url}",
+            f"--token-auth={TOKEN_AUTH}",
+            "--max-batch-size=100",
+            "--max-batch-delay=0.1",
+            "--log-level=WARNING",
+        ]
+    )
+    deadline = time.monotonic() + 10.0
+    while not os.path.exists(socket_path) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return process
+
+
+def stop_collector(process: subprocess.Popen) -> None:
+    process.terminate()
+    process.wait()
+
+
+def delivered_hits(matomo: Matomo, fake: FakeMatomo) -> int:
+    """Return the number of hits the transport of `matomo` delivered."""
+    if isinstance(matomo.transport, InMemoryTransport):
+        return len(matomo.transport.hits)
+    if matomo.hit_log is not None:
+        return sum(1 for path in matomo.hit_log.files() for _ in read_hits(path))
+    return len(fake.received)
+
+
+def run_scenario(
+    scenario: str, ignored_patterns: int, requests: int, fake: FakeMatomo, tmp_dir: str
+) -> typing.Dict[str, float]:
+    collector = None
+    collector_socket = None
+    if scenario == "collector":
+        collector_socket = os.path.join(tmp_dir, f"collector-{ignored_patterns}.sock")
+        collector = start_collector(collector_socket, fake)
+    hit_log_dir = os.path.join(tmp_dir, f"hits-{ignored_patterns}")
+    try:
+        app, matomo = make_tracked_app(
+            scenario, ignored_patterns, fake, collector_socket, hit_log_dir
+        )
+        fake.reset()
+        start = time.perf_counter()
+        latencies = measure_latency(app, requests)
+        matomo.close()
+        if scenario not in ("file", "memory"):
+            fake.wait_for_hits(WARMUP + requests)
+        elapsed = time.perf_counter() - start
+        delivered = delivered_hits(matomo, fake)
+        if delivered < WARMUP + requests:
+            print(f"  {scenario}: only {delivered} of {WARMUP + requests} hits")
+        hits_per_second = delivered / elapsed
+
+        # measured with a new app, tracemalloc would slow down the throughput measurement
+        app, matomo = make_tracked_app(
+            scenario, ignored_patterns, fake, collector_socket, hit_log_dir + "-alloc"
+        )
+        allocations = measure_allocations(app)
+        matomo.close()
+    finally:
+        if collector is not None:
+            stop_collector(collector)
+    return {
+        "p50_us": percentile(latencies, 50),
+        "p99_us": percentile(latencies, 99),
+        "hits_per_second": hits_per_second,
+        "alloc_kib": allocations,
+    }
+
+
+def git_commit() -> typing.Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],  # noqa: S607
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(requests: int, latency_ms: float, error_rate: float) -> typing.Dict[str, typing.Any]:
+    bare = make_app()
+    bare_latencies = measure_latency(bare, requests)
+    baseline = {
+        "p50_us": percentile(bare_latencies, 50),
+        "p99_us": percentile(bare_latencies, 99),
+        "alloc_kib": measure_allocations(bare),
+    }
+    scenarios = {}
+    with FakeMatomo(latency_ms=latency_ms, error_rate=error_rate) as fake:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for scenario in SCENARIOS:
+                for ignored_patterns in IGNORED_PATTERN_COUNTS:
+                    name = f"{scenario}-{ignored_patterns}-patterns"
+                    result = run_scenario(scenario, ignored_patterns, requests, fake, tmp_dir)
+                    scenarios[name] = {
+                        "added_p50_us": result["p50_us"] - baseline["p50_us"],
+                        "added_p99_us": result["p99_us"] - baseline["p99_us"],
+                        "hits_per_second": result["hits_per_second"],
+                        "added_alloc_kib": result["alloc_kib"] - baseline["alloc_kib"],
+                    }
+    return {
+        "commit": git_commit(),
+        "python": sys.version.split()[0],
+        "requests": requests,
+        "latency_ms": latency_ms,
+        "error_rate": error_rate,
+        "baseline": baseline,
+        "scenarios": scenarios,
+    }
+
+
+def print_results(results: typing.Dict[str, typing.Any]) -> None:
+    baseline = results["baseline"]
+    print(
+        f"bare app: p50 {baseline['p50_us']:.1f} us, p99 {baseline['p99_us']:.1f} us, "
+        f"{baseline['alloc_kib']:.1f} KiB/request"
+    )
+    print(f"{'scenario':>26} {'+p50 us':>9} {'+p99 us':>9} {'hits/s':>9} {'+KiB/req':>9}")
+    for name, scenario in results["scenarios"].items():
+        print(
+            f"{name:>26} {scenario['added_p50_us']:9.1f} {scenario['added_p99_us']:9.1f} "
+            f"{scenario['hits_per_second']:9.0f} {scenario['added_alloc_kib']:9.2f}"
+        )
+
+
+def compare(
+    results: typing.Dict[str, typing.Any],
+    previous: typing.Dict[str, typing.Any],
+    tolerance: float,
+) -> bool:
+    """Print the change of the added latency, returns False if a scenario regressed."""
+    ok = True
+    print(f"compared with {previous.get('commit') or 'previous run'}:")
+    for name, scenario in results["scenarios"].items():
+        before = previous["scenarios"].get(name)
+        if before is None:
+            continue
+        # the added latency can be close to 0, so allow for a few microseconds of noise
+        limit = max(before["added_p50_us"] * (1 + tolerance), before["added_p50_us"] + 5.0)
+        regressed = scenario["added_p50_us"] > limit
+        ok = ok and not regressed
+        print(
+            f"{name:>26} +p50 {before['added_p50_us']:7.1f} -> {scenario['added_p50_us']:7.1f} us"
+            f"{'  REGRESSED' if regressed else ''}"
+        )
+    return ok
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Measure the overhead of flask_matomo2.")
+    parser.add_argument("--requests", type=int, default=2000, help="requests per scenario")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="latency of Matomo")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of 503s")
+    parser.add_argument("--json", type=pathlib.Path, help="write the results to this file")
+    parser.add_argument("--compare", type=pathlib.Path, help="results of an earlier run")
+    parser.add_argument(
+        "--tolerance", type=float, default=0.2, help="allowed relative p50 regression"
+    )
+    args = parser.parse_args()
+
+    results = run(args.requests, args.latency_ms, args.error_rate)
+    print_results(results)
+    if args.json is not None:
+        args.json.write_text(json.dumps(results, indent=2))
+    if args.compare is not None:
+        previous = json.loads(args.compare.read_text())
+        if not compare(results, previous, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
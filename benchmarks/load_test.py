@@ -0,0 +1,163 @@
+"""Load test of examples/simple-app with `flask_matomo2.testing.FakeMatomo` as Matomo.
+
+Serves the simple app from a local WSGI server, requests it at a target rate and reports
+the hits lost on the way to Matomo and the end-to-end latency from sending a request to
+the fake Matomo receiving its hit.
+
+Run with e.g.:
+
+    python benchmarks/load_test.py --rps 200 --duration 10 --send-mode background
+
+and see how the app copes with a slow, failing or unreachable Matomo with
+`--latency-ms`, `--error-rate` and `--outage-after`/`--outage-seconds`.
+"""
+
+import argparse
+import concurrent.futures
+import logging
+import os
+import pathlib
+import sys
+import threading
+import time
+import typing
+import urllib.parse
+
+import httpx
+from werkzeug.serving import make_server
+
+from flask_matomo2.testing import FakeMatomo, Phase
+
+SIMPLE_APP = pathlib.Path(__file__).parent.parent / "examples" / "simple-app" / "src"
+
+
+def percentile(values: typing.List[float], percent: float) -> float:
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+def load_simple_app(fake: FakeMatomo, send_mode: str):
+    os.environ.update(
+        {
+            "MATOMO_URL": fake.url,
+            "MATOMO_ID_SITE": "1",
+            "MATOMO_TOKEN": "X" * 32,
+            "MATOMO_SEND_MODE": send_mode,
+        }
+    )
+    sys.path.insert(0, str(SIMPLE_APP))
+    import simple_app
+
+    # the simple app logs every tracking call and werkzeug every request
+    logging.getLogger().setLevel(logging.WARNING)
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    return simple_app
+
+
+def drive(
+    base_url: str, rps: float, duration: float, concurrency: int
+) -> typing.Tuple[typing.Dict[int, float], typing.List[float], int]:
+    """Request the app at `rps` requests per second for `duration` seconds.
+
+    Returns when each request was sent, the latencies of the responses in milliseconds
+    and the number of failed requests.
+    """
+    sent_at: typing.Dict[int, float] = {}
+    latencies: typing.List[float] = []
+    failed = 0
+    lock = threading.Lock()
+
+    def request(client: httpx.Client, load_id: int) -> None:
+        nonlocal failed
+        start = time.perf_counter()
+        sent_at[load_id] = start
+        try:
+            client.get(f"/?load_id={load_id}").raise_for_status()
+        except httpx.HTTPError:
+            with lock:
+                failed += 1
+            return
+        with lock:
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    limits = httpx.Limits(max_connections=concurrency)
+    with httpx.Client(base_url=base_url, limits=limits) as client:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+            start = time.perf_counter()
+            for load_id in range(int(rps * duration)):
+                # an open loop: requests are sent on schedule even if the app is slow
+                delay = start + load_id / rps - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                executor.submit(request, client, load_id)
+    return sent_at, latencies, failed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Load test examples/simple-app.")
+    parser.add_argument("--rps", type=float, default=100.0, help="requests per second")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds to run")
+    parser.add_argument("--concurrency", type=int, default=32, help="concurrent requests")
+    parser.add_argument("--send-mode", default="sync", help="send_mode of the extension")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="latency of Matomo")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of 503s")
+    parser.add_argument("--outage-after", type=float, help="seconds until Matomo goes down")
+    parser.add_argument("--outage-seconds", type=float, default=5.0, help="outage duration")
+    parser.add_argument(
+        "--drain-timeout", type=float, default=30.0, help="seconds to wait for queued hits"
+    )
+    args = parser.parse_args()
+
+    with FakeMatomo(latency_ms=args.latency_ms, error_rate=args.error_rate, seed=0) as fake:
+        simple_app = load_simple_app(fake, args.send_mode)
+        server = make_server("127.0.0.1", 0, simple_app.app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        if args.outage_after is not None:
+            fake.script(
+                [
+                    Phase(args.outage_after, args.latency_ms, args.error_rate),
+                    Phase(args.outage_seconds, down=True),
+                ]
+            )
+
+        start = time.perf_counter()
+        sent_at, latencies, failed = drive(
+            f"http://127.0.0.1:{server.server_port}", args.rps, args.duration, args.concurrency
+        )
+        elapsed = time.perf_counter() - start
+        simple_app.matomo.close(timeout=args.drain_timeout)
+        fake.wait_for_hits(len(sent_at), timeout=args.drain_timeout)
+        server.shutdown()
+
+        received_at: typing.Dict[int, float] = {}
+        for received, hit in list(fake.received):
+            query = urllib.parse.parse_qs(urllib.parse.urlsplit(hit.get("url", "")).query)
+            if "load_id" in query:
+                received_at.setdefault(int(query["load_id"][0]), received)
+        end_to_end = [
+            (received - sent_at[load_id]) * 1000 for load_id, received in received_at.items()
+        ]
+        lost = len(sent_at) - len(received_at)
+
+    print(f"requests:   {len(sent_at)} in {elapsed:.1f} s ({len(sent_at) / elapsed:.0f}/s)")
+    print(f"            {failed} failed")
+    print(
+        f"latency:    p50 {percentile(latencies, 50):.2f} ms, "
+        f"p99 {percentile(latencies, 99):.2f} ms"
+    )
+    print(
+        f"hits:       {len(received_at)} received, {lost} lost "
+        f"({lost / max(1, len(sent_at)):.2%}), dropped by the extension: "
+        f"{simple_app.matomo.dropped_hits}"
+    )
+    print(f"matomo:     {fake.requests} requests, {fake.errors} failed")
+    print(
+        f"end to end: p50 {percentile(end_to_end, 50):.1f} ms, "
+        f"p99 {percentile(end_to_end, 99):.1f} ms, max {max(end_to_end, default=0):.1f} ms"
+    )
+
+
+if __name__ == "__main__":
+    main()
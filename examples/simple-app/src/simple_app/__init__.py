@@ -8,6 +8,7 @@ from flask_matomo2 import Matomo
 MATOMO_URL = os.environ.get("MATOMO_URL", None)
 MATOMO_ID_SITE = os.environ.get("MATOMO_ID_SITE", None)
 MATOMO_TOKEN = os.environ.get("MATOMO_TOKEN", None)
+MATOMO_SEND_MODE = os.environ.get("MATOMO_SEND_MODE", "sync")
 
 logging.basicConfig(
     format="%(levelname)s:\t\b%(asctime)s %(name)s:%(lineno)d %(message)s",
@@ -17,7 +18,11 @@ logging.basicConfig(
 app = Flask(__name__)
 
 matomo = Matomo(
-    app, matomo_url=MATOMO_URL, id_site=MATOMO_ID_SITE, token_auth=MATOMO_TOKEN
+    app,
+    matomo_url=MATOMO_URL,
+    id_site=MATOMO_ID_SITE,
+    token_auth=MATOMO_TOKEN,
+    send_mode=MATOMO_SEND_MODE,
 )
 
 
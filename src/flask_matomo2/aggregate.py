@@ -0,0 +1,146 @@
+import bisect
+import logging
+import threading
+import typing
+
+logger = logging.getLogger("flask_matomo2")
+
+# upper bounds in milliseconds of the gt_ms histogram buckets, the last bucket is unbounded
+GT_MS_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+PERCENTILES = (50, 90, 99)
+
+
+class RouteStats:
+    """Hit count, status classes and a gt_ms histogram of one route, in constant memory.
+
+    >>> stats = RouteStats()
+    >>> for gt_ms in (3.0, 4.0, 40.0):
+    ...     stats.record(200, gt_ms)
+    >>> stats.record(503, 700.0)
+    >>> summary = stats.summary()
+    >>> summary["hits"], summary["status_2xx"], summary["status_5xx"]
+    (4, 3, 1)
+    >>> summary["gt_ms_p50"], summary["gt_ms_max"]
+    (5, 700.0)
+    """
+
+    __slots__ = ("buckets", "count", "max_ms", "status_classes", "total_ms")
+
+    def __init__(self) -> None:
+        self.count = 0
+        # counts of 1xx to 5xx responses
+        self.status_classes = [0] * 5
+        self.buckets = [0] * (len(GT_MS_BUCKETS) + 1)
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def record(self, status_code: int, gt_ms: float) -> None:
+        self.count += 1
+        status_class = status_code // 100
+        if 1 <= status_class <= 5:
+            self.status_classes[status_class - 1] += 1
+        self.buckets[bisect.bisect_left(GT_MS_BUCKETS, gt_ms)] += 1
+        self.total_ms += gt_ms
+        self.max_ms = max(self.max_ms, gt_ms)
+
+    def percentile(self, percent: float) -> float:
+        """Return the upper bound of the bucket that contains the `percent` percentile."""
+        rank = self.count * percent / 100
+        seen = 0
+        for index, bucket_count in enumerate(self.buckets):
+            seen += bucket_count
+            if seen >= rank and bucket_count:
+                return GT_MS_BUCKETS[index] if index < len(GT_MS_BUCKETS) else self.max_ms
+        return self.max_ms
+
+    def summary(self) -> typing.Dict[str, typing.Any]:
+        summary: typing.Dict[str, typing.Any] = {"hits": self.count}
+        for status_class, status_count in enumerate(self.status_classes, start=1):
+            summary[f"status_{status_class}xx"] = status_count
+        summary["gt_ms_avg"] = round(self.total_ms / self.count, 3) if self.count else 0.0
+        for percent in PERCENTILES:
+            summary[f"gt_ms_p{percent}"] = self.percentile(percent)
+        summary["gt_ms_max"] = round(self.max_ms, 3)
+        return summary
+
+
+class Aggregator:
+    """Collect `RouteStats` per route and flush them every `interval` seconds.
+
+    >>> flushed = []
+    >>> aggregator = Aggregator(lambda route, stats: flushed.append((route, stats.count)))
+    >>> aggregator.record("/poll", 200, 1.5)
+    >>> aggregator.flush()
+    >>> flushed
+    [('/poll', 1)]
+
+    Parameters
+    ----------
+    send : Callable[[str, RouteStats], Any]
+        called with the route and its stats for every route with hits when flushing
+    interval : float
+        seconds between flushes. Default: 60.0
+    """
+
+    def __init__(
+        self,
+        send: typing.Callable[[str, RouteStats], typing.Any],
+        *,
+        interval: float = 60.0,
+    ) -> None:
+        self.send = send
+        self.interval = interval
+        self._stats: typing.Dict[str, RouteStats] = {}
+        self._lock = threading.Lock()
+        self._thread: typing.Optional[threading.Thread] = None
+        self._stopping = threading.Event()
+
+    def record(self, route: str, status_code: int, gt_ms: float) -> None:
+        """Add a request to the stats of `route`, starts the flush thread if needed."""
+        if self._thread is None:
+            self.start()
+        with self._lock:
+            stats = self._stats.get(route)
+            if stats is None:
+                stats = self._stats[route] = RouteStats()
+            stats.record(status_code, gt_ms)
+
+    def flush(self) -> None:
+        """Send the stats collected since the last flush."""
+        with self._lock:
+            stats, self._stats = self._stats, {}
+        for route, route_stats in stats.items():
+            try:
+                self.send(route, route_stats)
+            except Exception:
+                logger.exception("Sending aggregated stats failed (route=%s)", route)
+
+    def start(self) -> None:
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._stopping.clear()
+            self._thread = threading.Thread(
+                target=self._run, name="flask_matomo2-aggregator", daemon=True
+            )
+            self._thread.start()
+
+    def stop(self) -> None:
+        """Stop the flush thread and send the collected stats."""
+        thread = self._thread
+        if thread is not None:
+            self._stopping.set()
+            thread.join()
+            self._thread = None
+        self.flush()
+
+    def after_fork(self) -> None:
+        """Reset the aggregator in a forked child process, the stats belong to the parent."""
+        self._stats = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stopping = threading.Event()
+
+    def _run(self) -> None:
+        while not self._stopping.wait(self.interval):
+            self.flush()
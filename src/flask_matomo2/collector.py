@@ -0,0 +1,324 @@
+"""A per-host collector process that forwards hits from many workers to Matomo.
+
+Workers running with `send_mode="collector"` write every hit, encoded by `HitEncoder`, to
+a Unix domain socket, framed the same way as spool records. The collector receives the hits
+of all workers on the host and sends them in batches with the bulk tracking api over one
+connection pool.
+
+Run the collector with::
+
+    flask-matomo2-collector --socket /run/my-app/matomo.sock \\
+        --matomo-url https://matomo.example.com --max-batch-size 100
+"""
+
+import argparse
+import logging
+import os
+import selectors
+import signal
+import socket
+import threading
+import typing
+
+from flask_matomo2.dispatchers import BackgroundDispatcher
+from flask_matomo2.queues import TrackingQueue
+from flask_matomo2.spool import RECORD_HEADER
+
+logger = logging.getLogger("flask_matomo2")
+
+
+class CollectorClient:
+    """Send encoded hits to a `Collector` listening on `socket_path`.
+
+    Every process keeps one connection to the collector. Sending waits at most
+    `send_timeout` seconds: if the collector isn't running or can't keep up, `send` returns
+    False and the connection is made again on the next hit.
+
+    Parameters
+    ----------
+    socket_path : str | os.PathLike
+        path of the Unix domain socket the collector listens on
+    send_timeout : float
+        maximum number of seconds to wait for the collector. Default: 0.1
+    """
+
+    def __init__(
+        self,
+        socket_path: typing.Union[str, os.PathLike],
+        *,
+        send_timeout: float = 0.1,
+    ) -> None:
+        if not hasattr(socket, "AF_UNIX"):
+            raise ValueError("the collector requires Unix domain sockets")
+        self.socket_path = os.fspath(socket_path)
+        self.send_timeout = send_timeout
+        self._sock: typing.Optional[socket.socket] = None
+        self._lock = threading.Lock()
+
+    def send(self, record: bytes) -> bool:
+        """Send one encoded hit, returns False if the hit couldn't be sent."""
+        with self._lock:
+            try:
+                if self._sock is None:
+                    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                    sock.settimeout(self.send_timeout)
+                    try:
+                        sock.connect(self.socket_path)
+                    except OSError:
+                        sock.close()
+                        raise
+                    self._sock = sock
+                self._sock.sendall(RECORD_HEADER.pack(len(record)) + record)
+            except OSError as exc:
+                # a partly sent record is discarded by the collector when we disconnect
+                self._close()
+                logger.warning("Can't send hit to collector at '%s': %s", self.socket_path, exc)
+                return False
+            return True
+
+    def _close(self) -> None:
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def close(self) -> None:
+        with self._lock:
+            self._close()
+
+    def after_fork(self) -> None:
+        """Give the forked child process its own connection."""
+        self._lock = threading.Lock()
+        # closing the inherited socket doesn't close the connection of the parent
+        self._close()
+
+
+class Collector:
+    """Receive hits from workers on a Unix domain socket and send them in batches.
+
+    Received hits are queued and sent by a `BackgroundDispatcher`, so receiving doesn't
+    wait for Matomo.
+
+    >>> import tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), "matomo.sock")
+    >>> batches = []
+    >>> collector = Collector(path, lambda records: batches.append(records) or True)
+    >>> collector.start()
+    >>> CollectorClient(path).send(b"idsite=1&rec=1")
+    True
+    >>> collector.stop()
+    >>> batches
+    [[b'idsite=1&rec=1']]
+
+    Parameters
+    ----------
+    socket_path : str | os.PathLike
+        path of the Unix domain socket to listen on, a stale socket file is replaced
+    send_batch : Callable[[list[bytes]], Any]
+        sends a batch of encoded hits, e.g. `Matomo.track_records`
+    max_batch_size : int
+        maximum number of hits to send in one bulk request. Default: 100
+    max_batch_delay : float
+        maximum number of seconds to wait for a batch to fill up. Default: 1.0
+    max_queue_size : Optional[int]
+        maximum number of received hits waiting to be sent. Default: 100_000
+    on_drop : Optional[Callable[[bytes], Any]]
+        called with every hit dropped because the queue is full, e.g. to spool it.
+        Default: None
+    shutdown_timeout : Optional[float]
+        seconds to wait for queued hits to be sent when stopping. Default: 5.0
+    """
+
+    def __init__(
+        self,
+        socket_path: typing.Union[str, os.PathLike],
+        send_batch: typing.Callable[[typing.List[bytes]], typing.Any],
+        *,
+        max_batch_size: int = 100,
+        max_batch_delay: float = 1.0,
+        max_queue_size: typing.Optional[int] = 100_000,
+        on_drop: typing.Optional[typing.Callable[[bytes], typing.Any]] = None,
+        shutdown_timeout: typing.Optional[float] = 5.0,
+    ) -> None:
+        if not hasattr(socket, "AF_UNIX"):
+            raise ValueError("the collector requires Unix domain sockets")
+        self.socket_path = os.fspath(socket_path)
+        self.shutdown_timeout = shutdown_timeout
+        self.received = 0
+        self.dispatcher: BackgroundDispatcher[bytes] = BackgroundDispatcher(
+            lambda record: send_batch([record]),
+            send_batch=send_batch,
+            max_batch_size=max_batch_size,
+            max_batch_delay=max_batch_delay,
+            tracking_queue=TrackingQueue(max_items=max_queue_size, size_of=len, on_drop=on_drop),
+            shutdown_timeout=shutdown_timeout,
+            name="flask_matomo2-collector-sender",
+        )
+        self._server: typing.Optional[socket.socket] = None
+        self._thread: typing.Optional[threading.Thread] = None
+        self._stopping = False
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+
+    def bind(self) -> socket.socket:
+        """Create the listening socket, called by `serve_forever` and `start`."""
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.socket_path)
+        server.listen(128)
+        server.setblocking(False)
+        self._server = server
+        self._stopping = False
+        logger.info("Collecting hits on '%s'", self.socket_path)
+        return server
+
+    def serve_forever(self) -> None:
+        """Receive hits until `stop` is called, then send the queued hits."""
+        server = self._server if self._server is not None else self.bind()
+        # the unparsed bytes received from every worker connection
+        buffers: typing.Dict[socket.socket, bytearray] = {}
+        with selectors.DefaultSelector() as selector:
+            selector.register(server, selectors.EVENT_READ)
+            selector.register(self._wakeup_r, selectors.EVENT_READ)
+            try:
+                while not self._stopping:
+                    for key, _ in selector.select():
+                        sock = typing.cast(socket.socket, key.fileobj)
+                        if sock is server:
+                            self._accept(server, buffers, selector)
+                        elif sock is self._wakeup_r:
+                            sock.recv(64)
+                        else:
+                            self._receive(sock, buffers, selector)
+            finally:
+                # read what the workers sent before `stop` was called
+                self._accept(server, buffers, selector)
+                for conn in list(buffers):
+                    while self._receive(conn, buffers, selector):
+                        pass
+                for conn in buffers:
+                    conn.close()
+                server.close()
+                self._server = None
+                if os.path.exists(self.socket_path):
+                    os.unlink(self.socket_path)
+                self.dispatcher.stop(self.shutdown_timeout)
+
+    @staticmethod
+    def _accept(
+        server: socket.socket,
+        buffers: typing.Dict[socket.socket, bytearray],
+        selector: selectors.BaseSelector,
+    ) -> None:
+        while True:
+            try:
+                conn, _ = server.accept()
+            except BlockingIOError:
+                return
+            conn.setblocking(False)
+            selector.register(conn, selectors.EVENT_READ)
+            buffers[conn] = bytearray()
+
+    def _receive(
+        self,
+        conn: socket.socket,
+        buffers: typing.Dict[socket.socket, bytearray],
+        selector: selectors.BaseSelector,
+    ) -> bool:
+        """Receive hits from a worker, returns False if there was nothing to receive."""
+        try:
+            data = conn.recv(256 * 1024)
+        except BlockingIOError:
+            return False
+        except OSError:
+            data = b""
+        if not data:
+            # a partly received record is discarded
+            selector.unregister(conn)
+            del buffers[conn]
+            conn.close()
+            return False
+        buffer = buffers[conn]
+        buffer += data
+        offset = 0
+        while offset + RECORD_HEADER.size <= len(buffer):
+            (length,) = RECORD_HEADER.unpack_from(buffer, offset)
+            start = offset + RECORD_HEADER.size
+            if start + length > len(buffer):
+                break
+            offset = start + length
+            self.received += 1
+            self.dispatcher.submit(bytes(buffer[start:offset]))
+        del buffer[:offset]
+        return True
+
+    def start(self) -> None:
+        """Receive hits in a thread of this process."""
+        self.bind()
+        self._thread = threading.Thread(
+            target=self.serve_forever, name="flask_matomo2-collector", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop receiving hits and send the queued hits."""
+        self._stopping = True
+        self._wakeup_w.send(b"\0")
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+def main(argv: typing.Optional[typing.List[str]] = None) -> None:
+    """Run a collector that forwards the hits to Matomo."""
+    from flask_matomo2.core import Matomo
+
+    parser = argparse.ArgumentParser(
+        prog="flask-matomo2-collector",
+        description="Forward hits from all workers on this host to Matomo in batches.",
+    )
+    parser.add_argument("--socket", required=True, help="Unix domain socket to listen on")
+    parser.add_argument("--matomo-url", required=True, help="url of the Matomo server")
+    parser.add_argument(
+        "--token-auth",
+        default=os.environ.get("MATOMO_TOKEN_AUTH"),
+        help="token_auth of the Matomo server, default: $MATOMO_TOKEN_AUTH",
+    )
+    parser.add_argument("--max-batch-size", type=int, default=100)
+    parser.add_argument("--max-batch-delay", type=float, default=1.0)
+    parser.add_argument("--max-queue-size", type=int, default=100_000)
+    parser.add_argument("--spool-dir", help="directory to spool hits that can't be sent")
+    parser.add_argument("--max-retries", type=int, default=0)
+    parser.add_argument("--max-connections", type=int, default=20)
+    parser.add_argument("--http2", action="store_true", help="use HTTP/2, requires 'h2'")
+    parser.add_argument("--log-level", default="INFO")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=args.log_level)
+    matomo = Matomo(
+        matomo_url=args.matomo_url,
+        token_auth=args.token_auth,
+        spool_dir=args.spool_dir,
+        max_retries=args.max_retries,
+        max_connections=args.max_connections,
+        max_keepalive_connections=args.max_connections,
+        http2=args.http2,
+    )
+    collector = Collector(
+        args.socket,
+        matomo.track_records,
+        max_batch_size=args.max_batch_size,
+        max_batch_delay=args.max_batch_delay,
+        max_queue_size=args.max_queue_size,
+        on_drop=matomo.spool.append if matomo.spool is not None else None,
+    )
+
+    def handle_sigterm(_signum, _frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, handle_sigterm)
+    try:
+        collector.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        matomo.close()
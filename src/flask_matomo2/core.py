@@ -1,17 +1,132 @@
+import asyncio
+import atexit
+import functools
 import json
 import logging
+import os
 import random
 import re
 import time
 import typing
-import urllib.parse
+import weakref
 
 import flask
 import httpx
 from flask import g, request
 
+from flask_matomo2.aggregate import Aggregator, RouteStats
+from flask_matomo2.collector import CollectorClient
+from flask_matomo2.dispatchers import AsyncDispatcher, BackgroundDispatcher
+from flask_matomo2.encoding import HitEncoder
+from flask_matomo2.hitlog import HitLog
+from flask_matomo2.metrics import PipelineMetrics
+from flask_matomo2.queues import OVERFLOW_POLICIES, TrackingQueue
+from flask_matomo2.ratelimit import RATE_LIMIT_POLICIES, RateLimitedError, RateLimiter
+from flask_matomo2.replay import create_cli
+from flask_matomo2.retries import CircuitBreaker, CircuitOpenError, RetryPolicy
+from flask_matomo2.spool import Spool
+from flask_matomo2.state import TrackingState
+from flask_matomo2.transports import (
+    CollectorTransport,
+    DispatcherTransport,
+    FileTransport,
+    HttpTransport,
+    Transport,
+)
+
 logger = logging.getLogger("flask_matomo2")
 
+SEND_MODES = ("sync", "background", "async", "collector", "file")
+# the lanes of the queue in background and async mode, highest priority first
+PRIORITY_LANES = ("error", "slow", "normal")
+BULK_HEADERS = {"Content-Type": "application/json"}
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+CIRCUIT_BREAKER_STATES = ("closed", "half_open", "open")
+
+
+def _register_hooks(matomo: "Matomo") -> None:
+    # a weak reference, so that the registered hooks don't keep the extension alive
+    ref = weakref.ref(matomo)
+
+    def after_in_child() -> None:
+        instance = ref()
+        if instance is not None:
+            instance.after_fork()
+
+    def at_exit() -> None:
+        instance = ref()
+        if instance is not None:
+            instance._flush_aggregates()
+
+    if hasattr(os, "register_at_fork"):
+        os.register_at_fork(after_in_child=after_in_child)
+    atexit.register(at_exit)
+
+
+def _check_sample_rate(sample_rate: float) -> None:
+    if not 0 < sample_rate <= 1:
+        raise ValueError(f"sample_rate must be in (0, 1], got {sample_rate}")
+
+
+def _compile_matcher(
+    patterns: typing.Sequence[typing.Pattern],
+) -> typing.Optional[typing.Callable[[str], bool]]:
+    """Combine regexes to one matcher that tells if any of the patterns match.
+
+    Patterns with capture groups or flags are matched one by one, since combining them
+    would renumber their groups (breaking backreferences) or drop their flags.
+
+    >>> matcher = _compile_matcher([re.compile(".*/old.*"), re.compile("/admin")])
+    >>> matcher("/some/old/path"), matcher("/admin/users"), matcher("/new")
+    (True, True, False)
+    >>> matcher = _compile_matcher([re.compile("/(a)"), re.compile(r"/(x)/\\1")])
+    >>> matcher("/x/x")
+    True
+    """
+    if not patterns:
+        return None
+
+    def match_any(value: str) -> bool:
+        return any(pattern.match(value) for pattern in patterns)
+
+    if any(
+        pattern.groups or pattern.flags != re.compile(pattern.pattern).flags
+        for pattern in patterns
+    ):
+        return match_any
+    try:
+        combined = re.compile("|".join(f"(?:{pattern.pattern})" for pattern in patterns))
+    except re.error:
+        # e.g. patterns with global flags can't be combined
+        return match_any
+    return lambda value: combined.match(value) is not None
+
+
+class _ByteCounter:
+    """Count the bytes of a response body while it is sent."""
+
+    def __init__(self, iterable: typing.Iterable[typing.Union[str, bytes]]) -> None:
+        self.iterable = iterable
+        self.bytes_sent = 0
+
+    def __iter__(self) -> typing.Iterator[typing.Union[str, bytes]]:
+        for chunk in self.iterable:
+            self.bytes_sent += len(chunk.encode() if isinstance(chunk, str) else chunk)
+            yield chunk
+
+    def close(self) -> None:
+        # e.g. ends the request context of `flask.stream_with_context`
+        close = getattr(self.iterable, "close", None)
+        if close is not None:
+            close()
+
+
+def _encode_cvar(tracking_data: typing.Dict) -> None:
+    """Encode custom variables as json, in place."""
+    cvar = tracking_data.get("cvar")
+    if cvar is not None and not isinstance(cvar, str):
+        tracking_data["cvar"] = json.dumps(cvar)
+
 
 class Matomo:
     """The Matomo object provides the central interface for interacting with Matomo.
@@ -29,17 +144,142 @@ class Matomo:
     base_url : str
         base_url to the site that should be tracked. Default: None.
     client :
-        http-client to use for tracking the requests. Must use the same api as `httpx.Client`. Default: creates `httpx.Client`
+        http-client to use for tracking the requests. Must use the same api as `httpx.Client`,
+        or `httpx.AsyncClient` if `send_mode="async"`.
+        Default: creates `httpx.Client` (or `httpx.AsyncClient`) configured by the
+        connection settings below.
+    http2 : bool
+        use HTTP/2 for the created client, requires `pip install flask-matomo2[http2]`.
+        Default: False.
+    max_connections : Optional[int]
+        maximum number of connections of the created client. Default: 20.
+    max_keepalive_connections : Optional[int]
+        maximum number of idle connections the created client keeps open. Default: 20.
+    keepalive_expiry : Optional[float]
+        seconds an idle connection is kept open, should be below the keep-alive timeout of
+        the Matomo server. Default: 60.0.
+    connect_timeout : Optional[float]
+        seconds to wait for a connection to Matomo. Default: 2.0.
+    read_timeout : Optional[float]
+        seconds to wait for Matomo to send or receive data. Default: 5.0.
+    pool_timeout : Optional[float]
+        seconds to wait for a free connection of the created client. Default: 1.0.
     ignored_routers : list[str]
         a list of routes to ignore
-    routes_details: dict[str, dict[str, str]]
-        a dict of details for routes. Default: None.
+    routes_details: dict[str, dict[str, Any]]
+        a dict of details for routes, e.g. `{"/poll": {"sample_rate": 0.01}}`. Default: None.
     ignored_patterns : list[str]
         list of regexes of routes to ignore. Default: None.
     ignored_ua_patterns: list[str]
         list of regexes of User-Agent to ignore requests. Default: None.
+    sample_rate : float
+        fraction of the requests to track, between 0 (exclusive) and 1. Tracked hits get
+        the custom variable `sample_weight` = 1 / sample_rate. Can be set per route with
+        `details` or `routes_details`. Default: 1.0 (track all requests).
+    aggregate_interval : float
+        seconds between the summary events of routes with `aggregate=True`. Default: 60.0.
+    ua_cache_size : int
+        number of User-Agents to remember if they should be ignored, 0 disables the cache.
+        Default: 1024.
+    send_mode : str
+        how to send the tracking calls, "sync" sends the hit from the request thread,
+        "background" queues the hit and sends it from a dispatcher thread, "async" queues
+        the hit and sends it from an event loop using `httpx.AsyncClient`, "collector"
+        sends the hit to the collector process at `collector_socket` and "file" appends the
+        hit to the NDJSON files in `hit_log_dir` instead of calling Matomo. Default: "sync".
+    collector_socket : Optional[str | os.PathLike]
+        path of the Unix domain socket of the collector, required for
+        `send_mode="collector"`. Default: None.
+    hit_log_dir : Optional[str | os.PathLike]
+        directory of the NDJSON files, required for `send_mode="file"`. Default: None.
+    hit_log_max_bytes : Optional[int]
+        maximum uncompressed size in bytes of one NDJSON file. Default: 64 MiB.
+    hit_log_max_age : Optional[float]
+        maximum number of seconds to write to one NDJSON file. Default: 3600.0.
+    hit_log_compress : bool
+        gzip compress the NDJSON files. Default: False.
+    hit_log_fsync_interval : Optional[float]
+        seconds between syncs of the NDJSON file to disk by a background thread, None
+        leaves syncing to the operating system. Default: 1.0.
+    max_batch_size : int
+        maximum number of hits to send in one call to Matomo's bulk tracking api, requires
+        `send_mode="background"` or `send_mode="async"`. Default: 1 (don't use the bulk tracking api).
+    max_batch_delay : float
+        maximum number of seconds to wait for a batch to fill up. Default: 1.0.
+    max_concurrency : int
+        maximum number of concurrent tracking calls when `send_mode="async"`. Default: 10.
+    max_queue_size : Optional[int]
+        maximum number of hits to queue in background mode. Default: 10000.
+    max_queue_bytes : Optional[int]
+        maximum estimated size in bytes of the hits queued in background mode. Default: None.
+    overflow_policy : str
+        what to do when the queue is full, one of "drop_newest", "drop_oldest" or "block".
+        Default: "drop_newest".
+    block_timeout : float
+        seconds to wait for room in the queue when `overflow_policy="block"`. Default: 1.0.
+    slow_request_ms : Optional[float]
+        requests taking at least this many milliseconds are queued in the "slow" lane, which
+        is shed after the "normal" lane when the queue is full. Hits of 5xx responses are
+        queued in the "error" lane, which is shed last. Default: 1000.0.
+    spool_dir : Optional[str | os.PathLike]
+        directory to spool failed and dropped hits in, until Matomo can be reached.
+        Default: None (don't spool hits).
+    spool_max_segment_bytes : int
+        maximum size in bytes of one spool segment. Default: 4 MiB.
+    spool_max_segments : Optional[int]
+        maximum number of spool segments to keep, the oldest is removed. Default: None.
+    max_retries : int
+        number of times to retry a tracking call that failed with a connection error or a
+        5xx response. Default: 0.
+    retry_backoff : float
+        seconds to wait before the first retry, doubled for every retry and jittered.
+        Default: 0.5.
+    retry_backoff_max : float
+        maximum number of seconds to wait between retries. Default: 30.0.
+    circuit_breaker_threshold : Optional[int]
+        number of consecutive failed tracking calls after which Matomo isn't called for
+        `circuit_breaker_timeout` seconds, hits are spooled (if `spool_dir` is set) or
+        dropped meanwhile. Default: None (no circuit breaker).
+    circuit_breaker_timeout : float
+        seconds to stop calling Matomo when the circuit breaker is open. Default: 30.0.
+    max_hits_per_second : Optional[float]
+        maximum number of hits per second to send to Matomo. Default: None (no limit).
+    max_bytes_per_second : Optional[float]
+        maximum number of bytes per second to send to Matomo. Default: None (no limit).
+    rate_limit_burst : float
+        seconds worth of hits and bytes that may be sent at once. Default: 1.0.
+    rate_limit_policy : str
+        what to do with hits over the rate limit, "wait" delays the call (so hits pile up
+        in the queue in background and async mode) and "spool" spools the hits (if
+        `spool_dir` is set) or drops them. Default: "wait".
+    rate_limit_max_wait : Optional[float]
+        maximum number of seconds a call waits for the rate limit with policy "wait", hits
+        that would have to wait longer are spooled (if `spool_dir` is set) or dropped. None
+        waits as long as needed. Default: 1.0.
+    shutdown_timeout : Optional[float]
+        seconds to wait for queued hits to be sent when the process exits, hits that are
+        still queued after that are spooled (if `spool_dir` is set). Default: 5.0.
+    metrics_path : Optional[str]
+        path to serve the metrics of the extension on in the Prometheus text format, the
+        route is registered by `init_app` and isn't tracked. Default: None (no endpoint).
+    transport : Optional[Transport]
+        how to deliver the hits instead of `send_mode`, e.g. an `InMemoryTransport` in
+        tests or a subclass of `Transport` for another destination. Default: None (use
+        the transport of `send_mode`).
+    defer_streamed_responses : bool
+        send the hit of a streamed response when the response is closed, after its body is
+        sent, instead of when the view returns. `gt_ms` then covers streaming the body and
+        the custom variables `stream_ms` and `stream_bytes` hold the time spent streaming
+        and the number of bytes sent. Default: False.
     """
 
+    # `activate` may be called again, e.g. after `activate_later`, it then stops the
+    # aggregator, transport and spool created by the previous call
+    _activated = False
+    aggregator: Aggregator
+    transport: Transport
+    spool: typing.Optional[Spool]
+
     def __init__(
         self,
         app=None,
@@ -49,10 +289,52 @@ class Matomo:
         token_auth=None,
         base_url=None,
         client=None,
+        http2: bool = False,
+        max_connections: typing.Optional[int] = 20,
+        max_keepalive_connections: typing.Optional[int] = 20,
+        keepalive_expiry: typing.Optional[float] = 60.0,
+        connect_timeout: typing.Optional[float] = 2.0,
+        read_timeout: typing.Optional[float] = 5.0,
+        pool_timeout: typing.Optional[float] = 1.0,
         ignored_routes: typing.Optional[typing.List[str]] = None,
-        routes_details: typing.Optional[typing.Dict[str, typing.Dict[str, str]]] = None,
+        routes_details: typing.Optional[typing.Dict[str, typing.Dict[str, typing.Any]]] = None,
         ignored_patterns: typing.Optional[typing.List[str]] = None,
         ignored_ua_patterns: typing.Optional[typing.List[str]] = None,
+        sample_rate: float = 1.0,
+        aggregate_interval: float = 60.0,
+        ua_cache_size: int = 1024,
+        send_mode: str = "sync",
+        collector_socket: typing.Optional[typing.Union[str, os.PathLike]] = None,
+        hit_log_dir: typing.Optional[typing.Union[str, os.PathLike]] = None,
+        hit_log_max_bytes: typing.Optional[int] = 64 * 1024 * 1024,
+        hit_log_max_age: typing.Optional[float] = 3600.0,
+        hit_log_compress: bool = False,
+        hit_log_fsync_interval: typing.Optional[float] = 1.0,
+        max_batch_size: int = 1,
+        max_batch_delay: float = 1.0,
+        max_concurrency: int = 10,
+        max_queue_size: typing.Optional[int] = 10_000,
+        max_queue_bytes: typing.Optional[int] = None,
+        overflow_policy: str = "drop_newest",
+        block_timeout: float = 1.0,
+        slow_request_ms: typing.Optional[float] = 1000.0,
+        spool_dir: typing.Optional[typing.Union[str, os.PathLike]] = None,
+        spool_max_segment_bytes: int = 4 * 1024 * 1024,
+        spool_max_segments: typing.Optional[int] = None,
+        max_retries: int = 0,
+        retry_backoff: float = 0.5,
+        retry_backoff_max: float = 30.0,
+        circuit_breaker_threshold: typing.Optional[int] = None,
+        circuit_breaker_timeout: float = 30.0,
+        max_hits_per_second: typing.Optional[float] = None,
+        max_bytes_per_second: typing.Optional[float] = None,
+        rate_limit_burst: float = 1.0,
+        rate_limit_policy: str = "wait",
+        rate_limit_max_wait: typing.Optional[float] = 1.0,
+        shutdown_timeout: typing.Optional[float] = 5.0,
+        metrics_path: typing.Optional[str] = None,
+        transport: typing.Optional[Transport] = None,
+        defer_streamed_responses: bool = False,
     ):
         self.activate(
             app=app,
@@ -61,10 +343,52 @@ class Matomo:
             token_auth=token_auth,
             base_url=base_url,
             client=client,
+            http2=http2,
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+            connect_timeout=connect_timeout,
+            read_timeout=read_timeout,
+            pool_timeout=pool_timeout,
             ignored_routes=ignored_routes,
             routes_details=routes_details,
             ignored_patterns=ignored_patterns,
             ignored_ua_patterns=ignored_ua_patterns,
+            sample_rate=sample_rate,
+            aggregate_interval=aggregate_interval,
+            ua_cache_size=ua_cache_size,
+            send_mode=send_mode,
+            collector_socket=collector_socket,
+            hit_log_dir=hit_log_dir,
+            hit_log_max_bytes=hit_log_max_bytes,
+            hit_log_max_age=hit_log_max_age,
+            hit_log_compress=hit_log_compress,
+            hit_log_fsync_interval=hit_log_fsync_interval,
+            max_batch_size=max_batch_size,
+            max_batch_delay=max_batch_delay,
+            max_concurrency=max_concurrency,
+            max_queue_size=max_queue_size,
+            max_queue_bytes=max_queue_bytes,
+            overflow_policy=overflow_policy,
+            block_timeout=block_timeout,
+            slow_request_ms=slow_request_ms,
+            spool_dir=spool_dir,
+            spool_max_segment_bytes=spool_max_segment_bytes,
+            spool_max_segments=spool_max_segments,
+            max_retries=max_retries,
+            retry_backoff=retry_backoff,
+            retry_backoff_max=retry_backoff_max,
+            circuit_breaker_threshold=circuit_breaker_threshold,
+            circuit_breaker_timeout=circuit_breaker_timeout,
+            max_hits_per_second=max_hits_per_second,
+            max_bytes_per_second=max_bytes_per_second,
+            rate_limit_burst=rate_limit_burst,
+            rate_limit_policy=rate_limit_policy,
+            rate_limit_max_wait=rate_limit_max_wait,
+            shutdown_timeout=shutdown_timeout,
+            metrics_path=metrics_path,
+            transport=transport,
+            defer_streamed_responses=defer_streamed_responses,
         )
 
     @classmethod
@@ -80,13 +404,86 @@ class Matomo:
         token_auth=None,
         base_url=None,
         client=None,
+        http2: bool = False,
+        max_connections: typing.Optional[int] = 20,
+        max_keepalive_connections: typing.Optional[int] = 20,
+        keepalive_expiry: typing.Optional[float] = 60.0,
+        connect_timeout: typing.Optional[float] = 2.0,
+        read_timeout: typing.Optional[float] = 5.0,
+        pool_timeout: typing.Optional[float] = 1.0,
         ignored_routes: typing.Optional[typing.List[str]] = None,
-        routes_details: typing.Optional[typing.Dict[str, typing.Dict[str, str]]] = None,
+        routes_details: typing.Optional[typing.Dict[str, typing.Dict[str, typing.Any]]] = None,
         ignored_patterns: typing.Optional[typing.List[str]] = None,
         ignored_ua_patterns: typing.Optional[typing.List[str]] = None,
+        sample_rate: float = 1.0,
+        aggregate_interval: float = 60.0,
+        ua_cache_size: int = 1024,
+        send_mode: str = "sync",
+        collector_socket: typing.Optional[typing.Union[str, os.PathLike]] = None,
+        hit_log_dir: typing.Optional[typing.Union[str, os.PathLike]] = None,
+        hit_log_max_bytes: typing.Optional[int] = 64 * 1024 * 1024,
+        hit_log_max_age: typing.Optional[float] = 3600.0,
+        hit_log_compress: bool = False,
+        hit_log_fsync_interval: typing.Optional[float] = 1.0,
+        max_batch_size: int = 1,
+        max_batch_delay: float = 1.0,
+        max_concurrency: int = 10,
+        max_queue_size: typing.Optional[int] = 10_000,
+        max_queue_bytes: typing.Optional[int] = None,
+        overflow_policy: str = "drop_newest",
+        block_timeout: float = 1.0,
+        slow_request_ms: typing.Optional[float] = 1000.0,
+        spool_dir: typing.Optional[typing.Union[str, os.PathLike]] = None,
+        spool_max_segment_bytes: int = 4 * 1024 * 1024,
+        spool_max_segments: typing.Optional[int] = None,
+        max_retries: int = 0,
+        retry_backoff: float = 0.5,
+        retry_backoff_max: float = 30.0,
+        circuit_breaker_threshold: typing.Optional[int] = None,
+        circuit_breaker_timeout: float = 30.0,
+        max_hits_per_second: typing.Optional[float] = None,
+        max_bytes_per_second: typing.Optional[float] = None,
+        rate_limit_burst: float = 1.0,
+        rate_limit_policy: str = "wait",
+        rate_limit_max_wait: typing.Optional[float] = 1.0,
+        shutdown_timeout: typing.Optional[float] = 5.0,
+        metrics_path: typing.Optional[str] = None,
+        transport: typing.Optional[Transport] = None,
+        defer_streamed_responses: bool = False,
     ):
         if not matomo_url:
             raise ValueError("matomo_url has to be set")
+        if not isinstance(ua_cache_size, int) or ua_cache_size < 0:
+            raise ValueError(f"ua_cache_size must be an int >= 0, got {ua_cache_size!r}")
+        if send_mode not in SEND_MODES:
+            raise ValueError(f"send_mode must be one of {SEND_MODES}, got '{send_mode}'")
+        if transport is not None and send_mode != "sync":
+            raise ValueError("transport replaces send_mode, leave send_mode='sync'")
+        if max_batch_size > 1 and send_mode in ("sync", "collector", "file"):
+            raise ValueError("max_batch_size > 1 requires send_mode='background' or 'async'")
+        if (collector_socket is not None) != (send_mode == "collector"):
+            raise ValueError("send_mode='collector' requires collector_socket to be set")
+        if (hit_log_dir is not None) != (send_mode == "file"):
+            raise ValueError("send_mode='file' requires hit_log_dir to be set")
+        if client is not None and isinstance(client, httpx.AsyncClient) != (
+            send_mode == "async"
+        ):
+            raise ValueError("send_mode='async' requires client to be a 'httpx.AsyncClient'")
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError(
+                f"overflow_policy must be one of {OVERFLOW_POLICIES}, got '{overflow_policy}'"
+            )
+        if rate_limit_policy not in RATE_LIMIT_POLICIES:
+            raise ValueError(
+                f"rate_limit_policy must be one of {RATE_LIMIT_POLICIES}, "
+                f"got '{rate_limit_policy}'"
+            )
+        if rate_limit_max_wait is not None and rate_limit_max_wait < 0:
+            raise ValueError("rate_limit_max_wait must be None or >= 0")
+        _check_sample_rate(sample_rate)
+        for route_details in (routes_details or {}).values():
+            if "sample_rate" in route_details:
+                _check_sample_rate(route_details["sample_rate"])
 
         self.app = app
         # Allow backend url with or without the filename part and/or trailing slash
@@ -101,12 +498,141 @@ class Matomo:
         self.ignored_ua_patterns = []
         if ignored_ua_patterns:
             self.ignored_ua_patterns = [re.compile(pattern) for pattern in ignored_ua_patterns]
+        # the User-Agent verdicts are cached, since real traffic has few distinct User-Agents
+        self._ignored_ua_matcher: typing.Optional[typing.Callable[[str], bool]] = None
+        ua_matcher = _compile_matcher(self.ignored_ua_patterns)
+        if ua_matcher is not None and ua_cache_size > 0:
+            # bounded, the User-Agent header is chosen by the client
+            self._ignored_ua_matcher = functools.lru_cache(maxsize=ua_cache_size)(ua_matcher)
+        else:
+            self._ignored_ua_matcher = ua_matcher
         self.ignored_routes: typing.List[str] = ignored_routes or []
-        self.routes_details: typing.Dict[str, typing.Dict[str, str]] = routes_details or {}
-        self.client = client or httpx.Client()
+        self.metrics_path = metrics_path
+        self.defer_streamed_responses = defer_streamed_responses
+        if metrics_path is not None and metrics_path not in self.ignored_routes:
+            self.ignored_routes.append(metrics_path)
+        self.routes_details: typing.Dict[str, typing.Dict[str, typing.Any]] = (
+            routes_details or {}
+        )
+        self.send_mode = send_mode
+        self.slow_request_ms = slow_request_ms
+        self.client_limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self.client_timeout = httpx.Timeout(
+            read_timeout, connect=connect_timeout, pool=pool_timeout
+        )
+        self.http2 = http2
+        # a client created here is recreated in forked processes, see `after_fork`
+        self._owns_client = client is None
+        self.client = client or self._create_client()
         self.ignored_patterns = []
         if ignored_patterns:
             self.ignored_patterns = [re.compile(pattern) for pattern in ignored_patterns]
+        self._ignored_patterns_matcher = _compile_matcher(self.ignored_patterns)
+        # the decision to ignore a route is cached per url_rule, cleared by `ignore`
+        self._ignored_rules: typing.Dict[str, bool] = {}
+        self.sample_rate = sample_rate
+        # the sample rate per url_rule, cleared by `details`
+        self._sample_rates: typing.Dict[str, float] = {}
+        self.encoder = HitEncoder()
+        # the static part of the tracking data per url_rule, cleared by `details`
+        self._hit_templates: typing.Dict[str, typing.Dict[str, typing.Any]] = {}
+
+        self.retry_policy = RetryPolicy(
+            max_retries=max_retries,
+            backoff_base=retry_backoff,
+            backoff_max=retry_backoff_max,
+        )
+        self.circuit_breaker: typing.Optional[CircuitBreaker] = None
+        if circuit_breaker_threshold is not None:
+            self.circuit_breaker = CircuitBreaker(
+                failure_threshold=circuit_breaker_threshold,
+                reset_timeout=circuit_breaker_timeout,
+            )
+
+        self.rate_limiter: typing.Optional[RateLimiter] = None
+        if max_hits_per_second is not None or max_bytes_per_second is not None:
+            self.rate_limiter = RateLimiter(
+                hits_per_second=max_hits_per_second,
+                bytes_per_second=max_bytes_per_second,
+                burst=rate_limit_burst,
+            )
+        self.rate_limit_policy = rate_limit_policy
+        self.rate_limit_max_wait = rate_limit_max_wait
+
+        self.metrics = PipelineMetrics()
+        if self._activated:
+            self.aggregator.stop()
+            self.transport.close()
+            if self.spool is not None:
+                self.spool.close()
+        self._activated = True
+        self.aggregator = Aggregator(self._send_route_stats, interval=aggregate_interval)
+        self.spool = None
+        if spool_dir is not None:
+            self.spool = Spool(
+                spool_dir,
+                max_segment_bytes=spool_max_segment_bytes,
+                max_segments=spool_max_segments,
+            )
+        # hits that couldn't be sent and weren't spooled because there is no spool
+        self._unspooled_hits = 0
+        self.collector: typing.Optional[CollectorClient] = None
+        if collector_socket is not None:
+            self.collector = CollectorClient(collector_socket)
+        self.hit_log: typing.Optional[HitLog] = None
+        if hit_log_dir is not None:
+            self.hit_log = HitLog(
+                hit_log_dir,
+                max_bytes=hit_log_max_bytes,
+                max_age=hit_log_max_age,
+                compress=hit_log_compress,
+                fsync_interval=hit_log_fsync_interval,
+            )
+        self.dispatcher: typing.Optional[typing.Union[BackgroundDispatcher, AsyncDispatcher]] = (
+            None
+        )
+        if send_mode in ("background", "async"):
+            tracking_queue = TrackingQueue(
+                max_items=max_queue_size,
+                max_bytes=max_queue_bytes,
+                overflow_policy=overflow_policy,
+                block_timeout=block_timeout,
+                on_drop=self._spool_hit if self.spool is not None else None,
+                lanes=PRIORITY_LANES,
+                classify=self._classify_hit,
+            )
+        if send_mode == "background":
+            self.dispatcher = BackgroundDispatcher(
+                lambda tracking_data: self.track(tracking_data=tracking_data),
+                send_batch=lambda tracking_data: self.track_bulk(tracking_data=tracking_data),
+                max_batch_size=max_batch_size,
+                max_batch_delay=max_batch_delay,
+                tracking_queue=tracking_queue,
+                shutdown_timeout=shutdown_timeout,
+            )
+        elif send_mode == "async":
+            self.dispatcher = AsyncDispatcher(
+                lambda tracking_data: self.atrack(tracking_data=tracking_data),
+                send_batch=lambda tracking_data: self.atrack_bulk(tracking_data=tracking_data),
+                max_batch_size=max_batch_size,
+                max_batch_delay=max_batch_delay,
+                max_concurrency=max_concurrency,
+                tracking_queue=tracking_queue,
+                shutdown_timeout=shutdown_timeout,
+                on_stop=self._aclose_client,
+            )
+        self.shutdown_timeout = shutdown_timeout
+        self.transport = transport if transport is not None else self._default_transport()
+
+        self._register_gauges()
+
+        if not getattr(self, "_hooks_registered", False):
+            _register_hooks(self)
+            self._hooks_registered = True
 
         if not self.token_auth:
             logger.warning("'token_auth' not given, NOT tracking ip-address")
@@ -119,94 +645,382 @@ class Matomo:
         app.before_request(self.before_request)
         app.after_request(self.after_request)
         app.teardown_request(self.teardown_request)
+        app.cli.add_command(create_cli(self))
+        if self.metrics_path is not None:
+            app.add_url_rule(self.metrics_path, "flask_matomo2_metrics", self.metrics_view)
+
+    def _default_transport(self) -> Transport:
+        """Return the transport of `send_mode`."""
+        if self.dispatcher is not None:
+            return DispatcherTransport(self.dispatcher)
+        if self.collector is not None:
+            return CollectorTransport(self.collector, self.encoder, spool=self.spool)
+        if self.hit_log is not None:
+            return FileTransport(self.hit_log)
+        return HttpTransport(self)
+
+    def _register_gauges(self) -> None:
+        """Add the metrics that are read from the dispatcher, circuit breaker etc."""
+        self.metrics.add_gauge(
+            "flask_matomo2_queue_depth",
+            "Hits waiting in the queue.",
+            lambda: len(self.dispatcher.queue) if self.dispatcher is not None else 0,
+        )
+        self.metrics.add_gauge(
+            "flask_matomo2_hits_dropped_total",
+            "Hits dropped because the queue was full or they couldn't be sent or spooled.",
+            lambda: self.dropped_hits,
+            type="counter",
+        )
+        if self.circuit_breaker is not None:
+            circuit_breaker = self.circuit_breaker
+            self.metrics.add_gauge(
+                "flask_matomo2_circuit_breaker_state",
+                "State of the circuit breaker, 0 closed, 1 half open and 2 open.",
+                lambda: CIRCUIT_BREAKER_STATES.index(circuit_breaker.state),
+            )
+            self.metrics.add_gauge(
+                "flask_matomo2_circuit_breaker_rejected_total",
+                "Calls to Matomo not made because the circuit breaker was open.",
+                lambda: circuit_breaker.rejected,
+                type="counter",
+            )
+        if self.rate_limiter is not None:
+            rate_limiter = self.rate_limiter
+            self.metrics.add_gauge(
+                "flask_matomo2_rate_limited_total",
+                "Hits delayed or rejected because of the rate limit.",
+                lambda: rate_limiter.limited,
+                type="counter",
+            )
+            if rate_limiter.hits_per_second is not None:
+                self.metrics.add_gauge(
+                    "flask_matomo2_rate_limit_hit_tokens",
+                    "Hits that may be sent now without waiting, negative when calls wait.",
+                    lambda: rate_limiter.tokens()["hits"],
+                )
+            if rate_limiter.bytes_per_second is not None:
+                self.metrics.add_gauge(
+                    "flask_matomo2_rate_limit_byte_tokens",
+                    "Bytes that may be sent now without waiting, negative when calls wait.",
+                    lambda: rate_limiter.tokens()["bytes"],
+                )
+
+    def metrics_view(self) -> flask.Response:
+        """Serve the metrics in the Prometheus text format, see `metrics_path`."""
+        return flask.Response(
+            self.metrics.render_prometheus(), content_type=PROMETHEUS_CONTENT_TYPE
+        )
+
+    def flush(self) -> None:
+        """Send the queued hits or write the buffered hits of the transport."""
+        self.transport.flush()
+
+    def close(self, timeout: typing.Optional[float] = None) -> None:
+        """Send all queued hits and close the transport and the spool, if any.
+
+        Parameters
+        ----------
+        timeout : Optional[float]
+            seconds to wait for queued hits to be sent. Default: None (wait forever)
+        """
+        self.aggregator.stop()
+        self.transport.close(timeout)
+        if self.spool is not None:
+            self.spool.close()
+
+    def after_fork(self) -> None:
+        """Reset the extension in a forked child process, e.g. a gunicorn or uWSGI worker.
+
+        Called automatically after `os.fork`. The child gets its own client, so that
+        connections aren't shared with the parent, and its own queue and dispatcher, which
+        are started on the first hit. Hits queued in the parent are left to the parent.
+        """
+        if self._owns_client:
+            # the inherited client isn't closed, its connections belong to the parent
+            self.client = self._create_client()
+        else:
+            logger.warning(
+                "The httpx client was created before forking and is shared with the parent "
+                "process, create the Matomo extension in each worker to avoid this"
+            )
+        self.aggregator.after_fork()
+        self.transport.after_fork()
+        if self.spool is not None:
+            self.spool.after_fork()
+        if self.circuit_breaker is not None:
+            self.circuit_breaker.after_fork()
+        if self.rate_limiter is not None:
+            self.rate_limiter.after_fork()
+        self._unspooled_hits = 0
+        self.metrics.after_fork()
+
+    def _flush_aggregates(self) -> None:
+        """Send the aggregated stats and close the transport when the process exits."""
+        self.aggregator.stop()
+        # the dispatcher may already be stopped at exit and restarted by the flush
+        self.transport.close(self.shutdown_timeout)
+
+    async def _aclose_client(self) -> None:
+        """Close the async client in the event loop of the dispatcher when it stops.
+
+        The connections of an `httpx.AsyncClient` belong to the loop they were opened in,
+        so a restarted dispatcher, e.g. to send the aggregated stats at exit, gets a new
+        client. A client given by the user is left open.
+        """
+        if not self._owns_client:
+            return
+        client = typing.cast(httpx.AsyncClient, self.client)
+        self.client = self._create_client()
+        await client.aclose()
+
+    def _create_client(self) -> typing.Union[httpx.Client, httpx.AsyncClient]:
+        client_class = httpx.AsyncClient if self.send_mode == "async" else httpx.Client
+        return client_class(
+            http2=self.http2, limits=self.client_limits, timeout=self.client_timeout
+        )
+
+    @property
+    def dropped_hits_by_lane(self) -> typing.Dict[str, int]:
+        """Number of hits dropped because the queue was full, per priority lane."""
+        if self.dispatcher is None:
+            return dict.fromkeys(PRIORITY_LANES, 0)
+        return dict(self.dispatcher.queue.dropped_by_lane)
+
+    def _classify_hit(self, tracking_data: typing.Dict) -> int:
+        """Return the index in `PRIORITY_LANES` of the lane to queue a hit in."""
+        cvar = tracking_data.get("cvar")
+        status_code = cvar.get("http_status_code") if isinstance(cvar, dict) else None
+        if status_code is not None and status_code >= 500:
+            return 0
+        gt_ms = tracking_data.get("gt_ms")
+        if (
+            self.slow_request_ms is not None
+            and gt_ms is not None
+            and gt_ms >= self.slow_request_ms
+        ):
+            return 1
+        return 2
+
+    @property
+    def dropped_hits(self) -> int:
+        """Number of hits dropped because the queue was full or they couldn't be delivered.
+
+        Hits that can't be sent to Matomo or the collector, e.g. because the circuit breaker
+        is open, the rate limit is reached or the call failed, are dropped if there is no
+        spool.
+        """
+        if isinstance(self.transport, CollectorTransport):
+            return self.transport.dropped
+        if self.dispatcher is not None:
+            return self.dispatcher.queue.dropped + self._unspooled_hits
+        return self._unspooled_hits
 
     def before_request(self):
         """Executed before every request, parses details about request"""
+        start_ns = time.perf_counter_ns()
+        try:
+            self._before_request()
+        finally:
+            self.metrics.before_request_duration.observe(
+                (time.perf_counter_ns() - start_ns) / 1e9
+            )
+
+    def _before_request(self) -> None:
         # Don't track track request, if user used ignore() decorator for route
-        url_rule = str(request.url_rule)
-        if url_rule in self.ignored_routes:
+        url_rule = request.url_rule.rule if request.url_rule else "None"
+        if self._is_rule_ignored(url_rule):
+            self.metrics.hits_ignored.inc()
             return
-        if any(
-            ua_pattern.match(str(request.user_agent)) for ua_pattern in self.ignored_ua_patterns
+        if self._ignored_ua_matcher is not None and self._ignored_ua_matcher(
+            request.user_agent.string
         ):
+            self.metrics.hits_ignored.inc()
+            return
+
+        route_details = self.routes_details.get(url_rule)
+        if route_details is not None and route_details.get("aggregate"):
+            g.flask_matomo2 = TrackingState(
+                start_ns=time.perf_counter_ns(),
+                tracking_data={},
+                tracking=False,
+                aggregate=url_rule,
+            )
+            self.metrics.hits_aggregated.inc()
             return
-        if any(pattern.match(url_rule) for pattern in self.ignored_patterns):
+
+        sample_rate = self._sample_rates.get(url_rule)
+        if sample_rate is None:
+            sample_rate = self._sample_rates[url_rule] = self.routes_details.get(
+                url_rule, {}
+            ).get("sample_rate", self.sample_rate)
+        if sample_rate < 1.0 and random.random() >= sample_rate:  # noqa: S311
+            self.metrics.hits_sampled_out.inc()
+            # views may still use `g.flask_matomo2`, e.g. with `PerfMsTracker`
+            g.flask_matomo2 = TrackingState(
+                start_ns=time.perf_counter_ns(), tracking_data={}, tracking=False
+            )
             return
 
-        url = self.base_url + request.path if self.base_url else request.url
-        action_name = url_rule if request.url_rule else "Not Found"
-        user_agent = request.user_agent
-        # If request was forwarded (e.g. by a proxy), then get origin IP from
-        # HTTP_X_FORWARDED_FOR. If this header field doesn't exist, return
-        # remote_addr.
-        ip_address = request.environ.get("HTTP_X_FORWARDED_FOR", request.remote_addr)
+        template = self._hit_templates.get(url_rule)
+        if template is None:
+            template = self._hit_templates[url_rule] = self._build_hit_template(
+                url_rule if request.url_rule else "Not Found"
+            )
+
+        data = template.copy()
+        # request data
+        data["ua"] = request.user_agent
+        data["url"] = self.base_url + request.path if self.base_url else request.url
+        data["cvar"] = {"http_status_code": None, "http_method": request.method}
+        if sample_rate < 1.0:
+            data["cvar"]["sample_weight"] = 1 / sample_rate
+        # random data
+        data["rand"] = random.getrandbits(32)
+        if self.token_auth:
+            # If request was forwarded (e.g. by a proxy), then get origin IP from
+            # HTTP_X_FORWARDED_FOR. If this header field doesn't exist, return
+            # remote_addr.
+            data["cip"] = request.environ.get("HTTP_X_FORWARDED_FOR", request.remote_addr)
+
+        if request.accept_languages:
+            data["lang"] = request.accept_languages[0][0]
+
+        if request.referrer:
+            data["urlref"] = request.referrer
+
+        g.flask_matomo2 = TrackingState(start_ns=time.perf_counter_ns(), tracking_data=data)
 
-        data = {
+    def _build_hit_template(self, action_name: str) -> typing.Dict[str, typing.Any]:
+        """Build the part of the tracking data that is the same for every request to a route."""
+        template: typing.Dict[str, typing.Any] = {
             # site data
             "idsite": str(self.id_site),
             "rec": "1",
             "apiv": "1",
             "send_image": "0",
-            # request data
-            "ua": user_agent,
             "action_name": action_name,
-            "url": url,
-            # "_id": id,
-            "cvar": {
-                "http_status_code": None,
-                "http_method": str(request.method),
-            },
-            # random data
-            "rand": random.getrandbits(32),
         }
         if self.token_auth:
-            data["token_auth"] = self.token_auth
-            data["cip"] = ip_address
+            template["token_auth"] = self.token_auth
 
-        if request.accept_languages:
-            data["lang"] = request.accept_languages[0][0]
+        # Overwrite action_name, if it was configured with details()
+        route_details = self.routes_details.get(action_name)
+        if route_details and route_details.get("action_name"):
+            template["action_name"] = route_details["action_name"]
+        return template
 
-        if request.referrer:
-            data["urlref"] = request.referrer
+    def ua_cache_info(self) -> typing.Optional[typing.Any]:
+        """Return hits, misses, maxsize and currsize of the User-Agent cache.
 
-        # Overwrite action_name, if it was configured with details()
-        if self.routes_details.get(action_name) and self.routes_details.get(action_name, {}).get(
-            "action_name"
-        ):
-            data["action_name"] = self.routes_details.get(action_name, {}).get("action_name")
+        Returns None if no `ignored_ua_patterns` are given or `ua_cache_size` is 0.
+        """
+        cache_info = getattr(self._ignored_ua_matcher, "cache_info", None)
+        return cache_info() if cache_info is not None else None
 
-        g.flask_matomo2 = {
-            "tracking": True,
-            "start_ns": time.perf_counter_ns(),
-            "tracking_data": data,
-        }
+    def _is_rule_ignored(self, url_rule: str) -> bool:
+        ignored = self._ignored_rules.get(url_rule)
+        if ignored is None:
+            ignored = url_rule in self.ignored_routes or (
+                self._ignored_patterns_matcher is not None
+                and self._ignored_patterns_matcher(url_rule)
+            )
+            self._ignored_rules[url_rule] = ignored
+        return ignored
 
     def after_request(self, response: flask.Response):
         """Collect tracking data about current request."""
-        tracking_state = g.get("flask_matomo2", {})
-        if not tracking_state.get("tracking", False):
+        tracking_state: typing.Optional[TrackingState] = g.get("flask_matomo2")
+        if tracking_state is None:
+            return response
+        if tracking_state.aggregate is not None:
+            gt_ms = (time.perf_counter_ns() - tracking_state.start_ns) / 1_000_000
+            self.aggregator.record(tracking_state.aggregate, response.status_code, gt_ms)
+            return response
+        if not tracking_state.tracking:
             return response
 
         end_ns = time.perf_counter_ns()
-        gt_ms = (end_ns - g.flask_matomo2["start_ns"]) / 1000
-        g.flask_matomo2["tracking_data"]["gt_ms"] = gt_ms
-        g.flask_matomo2["tracking_data"]["cvar"]["http_status_code"] = response.status_code
+        tracking_data = tracking_state.tracking_data
+        tracking_data["cvar"]["http_status_code"] = response.status_code
+        if self.defer_streamed_responses and response.is_streamed:
+            self._defer_hit(tracking_state, response, end_ns)
+            return response
+        tracking_data["gt_ms"] = (end_ns - tracking_state.start_ns) / 1_000_000
 
         return response
 
+    def _defer_hit(
+        self, tracking_state: TrackingState, response: flask.Response, stream_start_ns: int
+    ) -> None:
+        """Send the hit of a streamed response when the response is closed."""
+        tracking_state.deferred = True
+        counter: typing.Optional[_ByteCounter] = None
+        if not response.direct_passthrough:
+            # e.g. files from send_file are passed to the server as is, to allow sendfile
+            counter = _ByteCounter(response.response)
+            # yields the chunks of the wrapped body unchanged, str or bytes
+            response.response = typing.cast(typing.Iterable[bytes], counter)
+
+        def on_close() -> None:
+            end_ns = time.perf_counter_ns()
+            tracking_data = tracking_state.tracking_data
+            tracking_data["gt_ms"] = (end_ns - tracking_state.start_ns) / 1_000_000
+            tracking_data["cvar"]["stream_ms"] = (end_ns - stream_start_ns) / 1_000_000
+            tracking_data["cvar"]["stream_bytes"] = (
+                counter.bytes_sent if counter is not None else response.content_length
+            )
+            self._finish_request(tracking_state)
+
+        response.call_on_close(on_close)
+
     def teardown_request(self, exc: typing.Optional[Exception] = None) -> None:
-        tracking_state = g.get("flask_matomo2", {})
-        if not tracking_state.get("tracking", False):
+        tracking_state: typing.Optional[TrackingState] = g.get("flask_matomo2")
+        if tracking_state is None or not tracking_state.tracking or tracking_state.deferred:
             return
-        logger.debug(f"{tracking_state=}")
-        tracking_data = tracking_state["tracking_data"]
-        for key, value in tracking_state.get("custom_tracking_data", {}).items():
-            if key == "cvar" and "cvar" in tracking_data:
-                tracking_data["cvar"].update(value)
-            else:
-                tracking_data[key] = value
+        self._finish_request(tracking_state)
+
+    def _finish_request(self, tracking_state: TrackingState) -> None:
+        start_ns = time.perf_counter_ns()
+        try:
+            self._teardown_request(tracking_state)
+        finally:
+            self.metrics.teardown_request_duration.observe(
+                (time.perf_counter_ns() - start_ns) / 1e9
+            )
+
+    def _teardown_request(self, tracking_state: TrackingState) -> None:
+        logger.debug("tracking_state=%r", tracking_state)
+        tracking_data = tracking_state.tracking_data
+        if tracking_state.custom_tracking_data:
+            for key, value in tracking_state.custom_tracking_data.items():
+                if key == "cvar" and "cvar" in tracking_data:
+                    tracking_data["cvar"].update(value)
+                else:
+                    tracking_data[key] = value
+        self._send_hit(tracking_data)
 
-        self.track(tracking_data=tracking_data)
+    def _send_hit(self, tracking_data: typing.Dict) -> None:
+        """Send a hit with the transport."""
+        self.metrics.hits_tracked.inc()
+        self.transport.send(tracking_data)
+
+    def _send_route_stats(self, route: str, stats: RouteStats) -> None:
+        """Send the aggregated stats of a route as one event."""
+        tracking_data = self._build_hit_template(route)
+        tracking_data.update(
+            {
+                "e_c": "flask_matomo2",
+                "e_a": "aggregate",
+                "e_n": tracking_data["action_name"],
+                "e_v": stats.count,
+                "rand": random.getrandbits(32),
+                "cvar": stats.summary(),
+            }
+        )
+        if self.base_url:
+            tracking_data["url"] = self.base_url + route
+        self._send_hit(tracking_data)
 
     def track(
         self,
@@ -230,23 +1044,329 @@ class Matomo:
         lang : Optional[str]
             The client's preferred language, defaults to None.
         """
-        if "cvar" in tracking_data:
-            cvar = tracking_data.pop("cvar")
-            tracking_data["cvar"] = json.dumps(cvar)
+        _encode_cvar(tracking_data)
         logger.debug("calling '%s' with '%s'", self.matomo_url, tracking_data)
         try:
-            r = self.client.post(self.matomo_url, data=tracking_data)
+            r = self._post(data=tracking_data)
+        except (CircuitOpenError, RateLimitedError, httpx.HTTPError) as exc:
+            self._handle_track_error(exc, tracking_data)
+            return
+        if self._handle_track_response(r, tracking_data):
+            self._drain_spool_after_success()
 
-            if r.status_code >= 300:
-                logger.error(
-                    "Tracking call failed (status_code=%d)",
-                    r.status_code,
-                    extra={"status_code": r.status_code, "text": r.text},
-                )
-                # raise MatomoError(r.text)
-        except httpx.HTTPError as exc:
+    async def atrack(
+        self,
+        *,
+        tracking_data: typing.Dict,
+    ):
+        """Send request to Matomo without blocking the event loop.
+
+        Same as `track`, but requires `client` to be a `httpx.AsyncClient`.
+        """
+        _encode_cvar(tracking_data)
+        logger.debug("calling '%s' with '%s'", self.matomo_url, tracking_data)
+        try:
+            r = await self._apost(data=tracking_data)
+        except (CircuitOpenError, RateLimitedError, httpx.HTTPError) as exc:
+            self._handle_track_error(exc, tracking_data)
+            return
+        if self._handle_track_response(r, tracking_data):
+            await self._adrain_spool_after_success()
+
+    def _handle_track_response(self, r: httpx.Response, tracking_data: typing.Dict) -> bool:
+        """Log failed tracking calls, returns True if the call succeeded."""
+        if r.status_code >= 300:
+            logger.error(
+                "Tracking call failed (status_code=%d)",
+                r.status_code,
+                extra={"status_code": r.status_code, "text": r.text},
+            )
+            # raise MatomoError(r.text)
+            if r.status_code >= 500:
+                self._spool_hit(tracking_data)
+            return False
+        return True
+
+    def _handle_track_error(self, exc: Exception, tracking_data: typing.Dict) -> None:
+        if isinstance(exc, CircuitOpenError):
+            logger.debug("Circuit breaker is open, not calling Matomo")
+        elif isinstance(exc, RateLimitedError):
+            logger.debug("Rate limit reached, not calling Matomo")
+        else:
             logger.exception("Tracking call failed:", extra={"exc": exc})
             logger.exception(exc)
+        self._spool_hit(tracking_data)
+
+    def track_bulk(
+        self,
+        *,
+        tracking_data: typing.List[typing.Dict],
+    ):
+        """Send several hits to Matomo in one request using the bulk tracking api.
+
+        Parameters
+        ----------
+        tracking_data : list[dict]
+            the hits to send, each in the same format as given to `track`
+        """
+        self.track_records([self.encoder.encode(data) for data in tracking_data])
+
+    def track_records(self, records: typing.List[bytes]) -> None:
+        """Send hits encoded by `HitEncoder` to Matomo in one bulk request.
+
+        Used by the collector to forward the hits it received, hits that can't be sent are
+        spooled (if `spool_dir` is set).
+        """
+        if self._send_bulk(records, spool=True):
+            self._drain_spool_after_success()
+
+    async def atrack_bulk(
+        self,
+        *,
+        tracking_data: typing.List[typing.Dict],
+    ):
+        """Send several hits to Matomo in one request without blocking the event loop.
+
+        Same as `track_bulk`, but requires `client` to be a `httpx.AsyncClient`.
+        """
+        records = [self.encoder.encode(data) for data in tracking_data]
+        if await self._asend_bulk(records, spool=True):
+            await self._adrain_spool_after_success()
+
+    def _bulk_payload(self, records: typing.List[bytes]) -> bytes:
+        logger.debug("calling '%s' with %d hits", self.matomo_url, len(records))
+        self.metrics.batch_size.observe(len(records))
+        return self.encoder.encode_bulk(records, token_auth=self.token_auth)
+
+    def _send_bulk(self, records: typing.List[bytes], *, spool: bool = False) -> bool:
+        """Send url-encoded hits with the bulk tracking api.
+
+        Returns True if Matomo accepted the hits (a 2xx response). With `spool` the hits
+        are spooled if the call failed, but not if Matomo rejected them (a 4xx response).
+        """
+        payload = self._bulk_payload(records)
+        try:
+            r = self._post(hits=len(records), content=payload, headers=BULK_HEADERS)
+        except (CircuitOpenError, RateLimitedError, httpx.HTTPError) as exc:
+            self._handle_bulk_error(exc, records, spool=spool)
+            return False
+        return self._handle_bulk_response(r, records, spool=spool)
+
+    async def _asend_bulk(self, records: typing.List[bytes], *, spool: bool = False) -> bool:
+        payload = self._bulk_payload(records)
+        try:
+            r = await self._apost(hits=len(records), content=payload, headers=BULK_HEADERS)
+        except (CircuitOpenError, RateLimitedError, httpx.HTTPError) as exc:
+            self._handle_bulk_error(exc, records, spool=spool)
+            return False
+        return self._handle_bulk_response(r, records, spool=spool)
+
+    def _handle_bulk_response(
+        self, r: httpx.Response, records: typing.List[bytes], *, spool: bool
+    ) -> bool:
+        """Log failed hits, returns True if Matomo accepted the hits."""
+        if r.status_code >= 300:
+            logger.error(
+                "Tracking call failed (status_code=%d)",
+                r.status_code,
+                extra={"status_code": r.status_code, "text": r.text},
+            )
+            if spool and r.status_code >= 500:
+                self._spool_records(records)
+            return False
+        try:
+            result = json.loads(r.text)
+        except ValueError:
+            return True
+        for index in result.get("invalid_indices", []):
+            logger.error(
+                "Tracking call failed (index=%d)",
+                index,
+                extra={"index": index, "request": records[index]},
+            )
+        return True
+
+    def _handle_bulk_error(
+        self, exc: Exception, records: typing.List[bytes], *, spool: bool
+    ) -> None:
+        if isinstance(exc, CircuitOpenError):
+            logger.debug("Circuit breaker is open, not calling Matomo")
+        elif isinstance(exc, RateLimitedError):
+            logger.debug("Rate limit reached, not calling Matomo")
+        else:
+            logger.exception("Tracking call failed:", extra={"exc": exc})
+            logger.exception(exc)
+        if spool:
+            self._spool_records(records)
+
+    def _post(self, *, hits: int = 1, **kwargs) -> httpx.Response:
+        """Post to Matomo, retrying connection errors and 5xx responses.
+
+        Raises `CircuitOpenError` if the circuit breaker is open and `RateLimitedError` if
+        the rate limit is reached and `rate_limit_policy` is "spool", or the call would
+        have to wait longer than `rate_limit_max_wait`.
+        """
+        # the rate limit is checked first, a call that the breaker lets through as the
+        # half-open trial must be made so that the breaker is closed or opened again
+        delay = self._check_rate_limit(hits, kwargs)
+        if delay > 0:
+            time.sleep(delay)
+        self._check_circuit_breaker()
+        client = typing.cast(httpx.Client, self.client)
+        attempt = 0
+        while True:
+            start = time.perf_counter()
+            try:
+                r = client.post(self.matomo_url, **kwargs)
+            except httpx.HTTPError as exc:
+                if not self._should_retry(attempt, exc=exc):
+                    raise
+            else:
+                if not self._should_retry(attempt, status_code=r.status_code):
+                    return r
+            finally:
+                self.metrics.send_latency.observe(time.perf_counter() - start)
+            time.sleep(self._backoff(attempt))
+            attempt += 1
+
+    async def _apost(self, *, hits: int = 1, **kwargs) -> httpx.Response:
+        """Post to Matomo with `httpx.AsyncClient`, same as `_post`."""
+        delay = self._check_rate_limit(hits, kwargs)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        self._check_circuit_breaker()
+        client = typing.cast(httpx.AsyncClient, self.client)
+        attempt = 0
+        while True:
+            start = time.perf_counter()
+            try:
+                r = await client.post(self.matomo_url, **kwargs)
+            except httpx.HTTPError as exc:
+                if not self._should_retry(attempt, exc=exc):
+                    raise
+            else:
+                if not self._should_retry(attempt, status_code=r.status_code):
+                    return r
+            finally:
+                self.metrics.send_latency.observe(time.perf_counter() - start)
+            await asyncio.sleep(self._backoff(attempt))
+            attempt += 1
+
+    def _check_circuit_breaker(self) -> None:
+        if self.circuit_breaker is not None and not self.circuit_breaker.allow_request():
+            raise CircuitOpenError()
+
+    def _check_rate_limit(self, hits: int, kwargs: typing.Dict[str, typing.Any]) -> float:
+        """Return the seconds to wait before the call, or raise `RateLimitedError`."""
+        if self.rate_limiter is None:
+            return 0.0
+        nbytes = 0
+        if self.rate_limiter.bytes_per_second is not None:
+            content = kwargs.get("content")
+            nbytes = (
+                len(content) if content is not None else len(self.encoder.encode(kwargs["data"]))
+            )
+        if self.rate_limit_policy == "wait":
+            delay = self.rate_limiter.reserve(
+                hits=hits, nbytes=nbytes, max_wait=self.rate_limit_max_wait
+            )
+            if delay is None:
+                raise RateLimitedError()
+            return delay
+        if not self.rate_limiter.try_acquire(hits=hits, nbytes=nbytes):
+            raise RateLimitedError()
+        return 0.0
+
+    def _should_retry(
+        self,
+        attempt: int,
+        *,
+        status_code: typing.Optional[int] = None,
+        exc: typing.Optional[Exception] = None,
+    ) -> bool:
+        """Decide if a call should be retried, the outcome is recorded if not."""
+        if exc is not None:
+            failed = True
+            retryable = isinstance(exc, httpx.TransportError)
+        else:
+            failed = retryable = status_code is not None and status_code >= 500
+        if retryable and attempt < self.retry_policy.max_retries:
+            return True
+        if failed:
+            self.metrics.send_errors.inc()
+        if self.circuit_breaker is not None:
+            if failed:
+                self.circuit_breaker.record_failure()
+            else:
+                self.circuit_breaker.record_success()
+        return False
+
+    def _backoff(self, attempt: int) -> float:
+        delay = self.retry_policy.backoff(attempt)
+        self.metrics.retries.inc()
+        logger.debug("Retrying tracking call in %.2f seconds (attempt=%d)", delay, attempt + 1)
+        return delay
+
+    def drain_spool(self, *, max_batches: typing.Optional[int] = None) -> int:
+        """Send spooled hits to Matomo with the bulk tracking api.
+
+        Stops at the first batch that Matomo doesn't accept, e.g. with a 4xx response
+        because of an invalid `token_auth`, the hits of that batch stay in the spool.
+
+        Parameters
+        ----------
+        max_batches : Optional[int]
+            maximum number of bulk requests to make. Default: None (drain the whole spool)
+
+        Returns
+        -------
+        int
+            number of hits sent
+        """
+        if self.spool is None:
+            return 0
+        if self.send_mode == "async":
+            raise RuntimeError("use 'adrain_spool' when send_mode is 'async'")
+        return self.spool.drain(self._send_bulk, max_batches=max_batches)
+
+    async def adrain_spool(self, *, max_batches: typing.Optional[int] = None) -> int:
+        """Send spooled hits to Matomo with the bulk tracking api, same as `drain_spool`.
+
+        The spool is read in a worker thread, so the event loop isn't blocked.
+        """
+        if self.spool is None:
+            return 0
+        loop = asyncio.get_running_loop()
+
+        def send_batch(records: typing.List[bytes]) -> bool:
+            return asyncio.run_coroutine_threadsafe(self._asend_bulk(records), loop).result()
+
+        return await loop.run_in_executor(
+            None, functools.partial(self.spool.drain, send_batch, max_batches=max_batches)
+        )
+
+    def _spool_hit(self, tracking_data: typing.Dict) -> None:
+        if self.spool is not None:
+            self.spool.append(self.encoder.encode(tracking_data))
+        else:
+            self._unspooled_hits += 1
+
+    def _spool_records(self, records: typing.List[bytes]) -> None:
+        if self.spool is not None:
+            self.spool.extend(records)
+        else:
+            self._unspooled_hits += len(records)
+
+    def _drain_spool_after_success(self) -> None:
+        if self.spool is None or not self.spool.pending:
+            return
+        # Only drain one batch at a time from the request thread
+        self.drain_spool(max_batches=None if self.dispatcher is not None else 1)
+
+    async def _adrain_spool_after_success(self) -> None:
+        if self.spool is None or not self.spool.pending:
+            return
+        await self.adrain_spool()
 
     def ignore(self, route: typing.Optional[str] = None):
         """Ignore a route and don't track it.
@@ -266,6 +1386,7 @@ class Matomo:
         def wrap(f):
             route_name = route or self.guess_route_name(f.__name__)
             self.ignored_routes.append(route_name)
+            self._ignored_rules.clear()
             return f
 
         return wrap
@@ -278,6 +1399,8 @@ class Matomo:
         route: typing.Optional[str] = None,
         *,
         action_name: typing.Optional[str] = None,
+        sample_rate: typing.Optional[float] = None,
+        aggregate: bool = False,
     ):
         """Set details like action_name for a route
 
@@ -287,6 +1410,13 @@ class Matomo:
             name of the route.
         action_name : str
             name of the site
+        sample_rate : float
+            fraction of the requests to the route to track, overrides `sample_rate`
+            given to `activate`
+        aggregate : bool
+            don't track every request to the route, instead send the number of requests,
+            the status classes and `gt_ms` percentiles as one event every
+            `aggregate_interval` seconds
 
         Examples:
             @app.route("/users")
@@ -296,13 +1426,20 @@ class Matomo:
         """
 
         def wrap(f):
-            route_details = {}
+            route_details: typing.Dict[str, typing.Any] = {}
             if action_name:
                 route_details["action_name"] = action_name
+            if sample_rate is not None:
+                _check_sample_rate(sample_rate)
+                route_details["sample_rate"] = sample_rate
+            if aggregate:
+                route_details["aggregate"] = True
 
             if route_details:
                 route_name = route or self.guess_route_name(f.__name__)
                 self.routes_details[route_name] = route_details
+                self._hit_templates.clear()
+                self._sample_rates.clear()
             return f
 
         return wrap
@@ -0,0 +1,405 @@
+import asyncio
+import atexit
+import logging
+import queue
+import threading
+import time
+import typing
+
+from flask_matomo2.queues import TrackingQueue
+
+logger = logging.getLogger("flask_matomo2")
+
+_STOP = object()
+
+# the hits sent by a `BackgroundDispatcher`, dicts or e.g. records encoded by `HitEncoder`
+T = typing.TypeVar("T")
+
+
+def _abandon_queued(tracking_queue: TrackingQueue, timeout: typing.Optional[float]) -> None:
+    """Hand hits that weren't sent in time to the queue's `on_drop`, e.g. to spool them."""
+    abandoned = tracking_queue.drain_nowait()
+    logger.warning(
+        "Dispatcher didn't stop within %s seconds, %d queued hits not sent",
+        timeout,
+        len(abandoned),
+    )
+    if tracking_queue.on_drop is not None:
+        for tracking_data in abandoned:
+            tracking_queue.on_drop(tracking_data)
+
+
+class BackgroundDispatcher(typing.Generic[T]):
+    """Send tracking data from a dedicated thread instead of the request thread.
+
+    Hits are put on an in-process queue by `submit` and sent by the dispatcher thread,
+    so the latency of Matomo doesn't affect the latency of the app.
+
+    If `send_batch` is given and `max_batch_size` > 1, queued hits are collected and sent
+    together when `max_batch_size` hits are collected or `max_batch_delay` seconds have
+    passed since the first hit in the batch, whichever comes first.
+
+    >>> sent = []
+    >>> dispatcher = BackgroundDispatcher(sent.append)
+    >>> dispatcher.submit({"idsite": "1"})
+    True
+    >>> dispatcher.stop()
+    >>> sent
+    [{'idsite': '1'}]
+
+    The hits are usually dicts, but can be of any type that `send` accepts, e.g. the
+    collector sends encoded records.
+
+    Parameters
+    ----------
+    send : Callable[[T], Any]
+        function that sends one hit, typically `Matomo.track`
+    send_batch : Callable[[list[T]], Any]
+        function that sends several hits at once, typically `Matomo.track_bulk`. Default: None.
+    max_batch_size : int
+        maximum number of hits to send in one batch. Default: 1.
+    max_batch_delay : float
+        maximum number of seconds to wait for a batch to fill up. Default: 1.0.
+    tracking_queue : Optional[TrackingQueue]
+        the queue to buffer hits in. Default: an unbounded `TrackingQueue`
+    shutdown_timeout : Optional[float]
+        seconds to wait for queued hits to be sent when the interpreter exits. Default: 5.0
+    name : str
+        name of the dispatcher thread. Default: "flask_matomo2-dispatcher"
+    """
+
+    def __init__(
+        self,
+        send: typing.Callable[[T], typing.Any],
+        *,
+        send_batch: typing.Optional[typing.Callable[[typing.List[T]], typing.Any]] = None,
+        max_batch_size: int = 1,
+        max_batch_delay: float = 1.0,
+        tracking_queue: typing.Optional[TrackingQueue] = None,
+        shutdown_timeout: typing.Optional[float] = 5.0,
+        name: str = "flask_matomo2-dispatcher",
+    ) -> None:
+        if max_batch_size < 1:
+            raise ValueError("max_batch_size must be at least 1")
+        self.send = send
+        self.send_batch = send_batch
+        self.max_batch_size = max_batch_size
+        self.max_batch_delay = max_batch_delay
+        self.shutdown_timeout = shutdown_timeout
+        self.name = name
+        self.queue = tracking_queue if tracking_queue is not None else TrackingQueue()
+        self._thread: typing.Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self) -> None:
+        """Start the dispatcher thread, if not already running."""
+        with self._lock:
+            if self.is_running:
+                return
+            self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self._thread.start()
+            atexit.register(self.stop, self.shutdown_timeout)
+
+    def submit(self, tracking_data: T) -> bool:
+        """Queue tracking data for sending, starts the dispatcher if needed.
+
+        Returns False if the hit was dropped because the queue is full.
+        """
+        if not self.is_running:
+            self.start()
+        return self.queue.put(tracking_data)
+
+    def join(self) -> None:
+        """Block until all queued hits are sent."""
+        self.queue.join()
+
+    def stop(self, timeout: typing.Optional[float] = None) -> None:
+        """Send all queued hits and stop the dispatcher thread.
+
+        Parameters
+        ----------
+        timeout : Optional[float]
+            seconds to wait for the queue to be drained. Default: None (wait forever)
+        """
+        with self._lock:
+            thread = self._thread
+            if thread is None:
+                return
+            self.queue.put_control(_STOP)
+            thread.join(timeout)
+            if thread.is_alive():
+                _abandon_queued(self.queue, timeout)
+            self._thread = None
+            atexit.unregister(self.stop)
+
+    def after_fork(self) -> None:
+        """Reset the dispatcher in a forked child process.
+
+        The dispatcher thread doesn't survive a fork and the locks may be held by threads
+        of the parent, so the dispatcher is reset to a fresh, stopped state. The hits queued
+        in the parent are dropped, since the parent will send them.
+        """
+        self.queue.after_fork()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def _run(self) -> None:
+        while True:
+            batch, stop = self._collect_batch()
+            try:
+                if len(batch) > 1 and self.send_batch is not None:
+                    self.send_batch(batch)
+                elif batch:
+                    self.send(batch[0])
+            except Exception:
+                logger.exception("Dispatching tracking data failed")
+            finally:
+                for _ in range(len(batch) + stop):
+                    self.queue.task_done()
+            if stop:
+                return
+
+    def _collect_batch(self) -> typing.Tuple[typing.List[T], bool]:
+        """Wait for the next batch of hits, returns the batch and if stop was requested."""
+        item = self.queue.get()
+        if item is _STOP:
+            return [], True
+        batch = [item]
+        if self.send_batch is None:
+            return batch, False
+        deadline = time.monotonic() + self.max_batch_delay
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self.queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is _STOP:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+
+class AsyncDispatcher:
+    """Send tracking data from an event loop running in a dedicated thread.
+
+    Works like `BackgroundDispatcher`, but `send` and `send_batch` are coroutine functions,
+    typically using a `httpx.AsyncClient`, and up to `max_concurrency` hits or batches are
+    sent concurrently. `submit` never waits for the event loop, so it can be called from
+    both sync and async code.
+
+    Parameters
+    ----------
+    send : Callable[[dict], Awaitable[Any]]
+        coroutine function that sends one hit, typically `Matomo.atrack`
+    send_batch : Callable[[list[dict]], Awaitable[Any]]
+        coroutine function that sends several hits at once, typically `Matomo.atrack_bulk`.
+        Default: None.
+    max_batch_size : int
+        maximum number of hits to send in one batch. Default: 1.
+    max_batch_delay : float
+        maximum number of seconds to wait for a batch to fill up. Default: 1.0.
+    max_concurrency : int
+        maximum number of hits or batches to send concurrently. Default: 10.
+    tracking_queue : Optional[TrackingQueue]
+        the queue to buffer hits in. Default: an unbounded `TrackingQueue`
+    shutdown_timeout : Optional[float]
+        seconds to wait for queued hits to be sent when the interpreter exits. Default: 5.0
+    name : str
+        name of the dispatcher thread. Default: "flask_matomo2-async-dispatcher"
+    on_stop : Optional[Callable[[], Awaitable[Any]]]
+        coroutine function awaited in the event loop when the dispatcher stops, before the
+        loop is closed, e.g. to close a client that can't be used in another loop.
+        Default: None.
+    """
+
+    def __init__(
+        self,
+        send: typing.Callable[[typing.Dict], typing.Awaitable[typing.Any]],
+        *,
+        send_batch: typing.Optional[
+            typing.Callable[[typing.List[typing.Dict]], typing.Awaitable[typing.Any]]
+        ] = None,
+        max_batch_size: int = 1,
+        max_batch_delay: float = 1.0,
+        max_concurrency: int = 10,
+        tracking_queue: typing.Optional[TrackingQueue] = None,
+        shutdown_timeout: typing.Optional[float] = 5.0,
+        name: str = "flask_matomo2-async-dispatcher",
+        on_stop: typing.Optional[typing.Callable[[], typing.Awaitable[typing.Any]]] = None,
+    ) -> None:
+        if max_batch_size < 1:
+            raise ValueError("max_batch_size must be at least 1")
+        if max_concurrency < 1:
+            raise ValueError("max_concurrency must be at least 1")
+        self.send = send
+        self.send_batch = send_batch
+        self.max_batch_size = max_batch_size
+        self.max_batch_delay = max_batch_delay
+        self.max_concurrency = max_concurrency
+        self.shutdown_timeout = shutdown_timeout
+        self.name = name
+        self.on_stop = on_stop
+        self.queue = tracking_queue if tracking_queue is not None else TrackingQueue()
+        self._thread: typing.Optional[threading.Thread] = None
+        self._loop: typing.Optional[asyncio.AbstractEventLoop] = None
+        self._wakeup: typing.Optional[asyncio.Event] = None
+        self._stopping = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self) -> None:
+        """Start the event loop thread, if not already running."""
+        with self._lock:
+            if self.is_running:
+                return
+            self._stopping = False
+            self._loop = asyncio.new_event_loop()
+            ready = threading.Event()
+            self._thread = threading.Thread(
+                target=self._run, args=(self._loop, ready), name=self.name, daemon=True
+            )
+            self._thread.start()
+            ready.wait()
+            atexit.register(self.stop, self.shutdown_timeout)
+
+    def submit(self, tracking_data: typing.Dict) -> bool:
+        """Queue tracking data for sending, starts the dispatcher if needed.
+
+        Returns False if the hit was dropped because the queue is full.
+        """
+        if not self.is_running:
+            self.start()
+        accepted = self.queue.put(tracking_data)
+        if accepted:
+            self._call_in_loop(self._wake)
+        return accepted
+
+    def join(self) -> None:
+        """Block until all queued hits are sent."""
+        self.queue.join()
+
+    def stop(self, timeout: typing.Optional[float] = None) -> None:
+        """Send all queued hits and stop the event loop thread.
+
+        Parameters
+        ----------
+        timeout : Optional[float]
+            seconds to wait for the queue to be drained. Default: None (wait forever)
+        """
+        with self._lock:
+            thread = self._thread
+            if thread is None:
+                return
+            self._call_in_loop(self._request_stop)
+            thread.join(timeout)
+            if thread.is_alive():
+                _abandon_queued(self.queue, timeout)
+            self._thread = None
+            atexit.unregister(self.stop)
+
+    def after_fork(self) -> None:
+        """Reset the dispatcher in a forked child process, see `BackgroundDispatcher.after_fork`."""
+        self.queue.after_fork()
+        self._thread = None
+        self._loop = None
+        self._wakeup = None
+        self._lock = threading.Lock()
+
+    def _call_in_loop(self, callback: typing.Callable[[], None]) -> None:
+        if self._loop is None:
+            return
+        try:
+            self._loop.call_soon_threadsafe(callback)
+        except RuntimeError:
+            # the loop is already closed
+            pass
+
+    def _wake(self) -> None:
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _request_stop(self) -> None:
+        self._stopping = True
+        self._wake()
+
+    def _run(self, loop: asyncio.AbstractEventLoop, ready: threading.Event) -> None:
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(self._dispatch(ready))
+        finally:
+            loop.close()
+
+    def _take(self, limit: int) -> typing.List[typing.Dict]:
+        batch: typing.List[typing.Dict] = []
+        while len(batch) < limit:
+            try:
+                batch.append(self.queue.get(timeout=0))
+            except queue.Empty:
+                break
+        return batch
+
+    async def _dispatch(self, ready: threading.Event) -> None:
+        self._wakeup = wakeup = asyncio.Event()
+        ready.set()
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        in_flight: typing.Set[asyncio.Future] = set()
+        batch_limit = self.max_batch_size if self.send_batch is not None else 1
+
+        def done(task: asyncio.Future) -> None:
+            in_flight.discard(task)
+            semaphore.release()
+
+        while True:
+            batch = self._take(batch_limit)
+            if not batch:
+                if self._stopping:
+                    break
+                await wakeup.wait()
+                wakeup.clear()
+                continue
+            deadline = loop.time() + self.max_batch_delay
+            while len(batch) < batch_limit and not self._stopping:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    await asyncio.wait_for(wakeup.wait(), remaining)
+                except asyncio.TimeoutError:
+                    break
+                wakeup.clear()
+                batch.extend(self._take(batch_limit - len(batch)))
+            await semaphore.acquire()
+            task = asyncio.ensure_future(self._send(batch))
+            in_flight.add(task)
+            task.add_done_callback(done)
+
+        if in_flight:
+            await asyncio.gather(*in_flight)
+        if self.on_stop is not None:
+            try:
+                await self.on_stop()
+            except Exception:
+                logger.exception("Stopping the dispatcher failed")
+
+    async def _send(self, batch: typing.List[typing.Dict]) -> None:
+        try:
+            if len(batch) > 1 and self.send_batch is not None:
+                await self.send_batch(batch)
+            else:
+                await self.send(batch[0])
+        except Exception:
+            logger.exception("Dispatching tracking data failed")
+        finally:
+            for _ in batch:
+                self.queue.task_done()
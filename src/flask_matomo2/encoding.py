@@ -0,0 +1,142 @@
+import json
+import typing
+import urllib.parse
+
+# Default separators of `json.dumps`, url-encoded
+_CVAR_START = b"%7B"
+_CVAR_SEPARATOR = b"%2C+"
+_CVAR_END = b"%7D"
+
+
+class HitEncoder:
+    """Encode hits as the exact bytes that are sent to Matomo.
+
+    A hit is encoded as an url-encoded query string, with `cvar` encoded as json, the
+    same as `urllib.parse.urlencode` would give after `json.dumps` of `cvar`. The encoding
+    of keys, custom variable names and frequently repeated values (e.g. the action name or
+    the User-Agent) is cached, so that encoding a hit is mostly joining cached bytes.
+
+    >>> encoder = HitEncoder()
+    >>> hit = {"idsite": "1", "action_name": "/foo", "cvar": {"http_status_code": 200}}
+    >>> encoder.encode(hit)
+    b'idsite=1&action_name=%2Ffoo&cvar=%7B%22http_status_code%22%3A+200%7D'
+    >>> encoder.encode_bulk([encoder.encode(hit)], token_auth="TOKEN")
+    b'{"requests":["?idsite=1&action_name=%2Ffoo&cvar=%7B%22http_status_code%22%3A+200%7D"],"token_auth":"TOKEN"}'
+
+    Parameters
+    ----------
+    exclude : Collection[str]
+        keys to leave out of the encoded hit. Default: ("token_auth",)
+    max_cached_values : int
+        maximum number of encoded values to cache. Default: 4096
+    """
+
+    def __init__(
+        self,
+        *,
+        exclude: typing.Collection[str] = ("token_auth",),
+        max_cached_values: int = 4096,
+    ) -> None:
+        self.exclude = frozenset(exclude)
+        self.max_cached_values = max_cached_values
+        # encoded keys, without and with the separator before them
+        self._keys: typing.Dict[str, typing.Tuple[bytes, bytes]] = {}
+        self._cvar_keys: typing.Dict[str, typing.Tuple[bytes, bytes]] = {}
+        self._values: typing.Dict[str, bytes] = {}
+        self._cvar_values: typing.Dict[typing.Tuple[type, typing.Any], bytes] = {}
+
+    def encode(self, tracking_data: typing.Mapping[str, typing.Any]) -> bytes:
+        """Encode a hit as an url-encoded query string."""
+        chunks: typing.List[bytes] = []
+        self.encode_into(chunks, tracking_data)
+        return b"".join(chunks)
+
+    def encode_into(
+        self, chunks: typing.List[bytes], tracking_data: typing.Mapping[str, typing.Any]
+    ) -> None:
+        """Append the encoded hit to `chunks`, to be joined by the caller."""
+        first = True
+        for key, value in tracking_data.items():
+            if key in self.exclude:
+                continue
+            encoded_keys = self._keys.get(key)
+            if encoded_keys is None:
+                encoded_key = _quote(key) + b"="
+                encoded_keys = self._keys[key] = (encoded_key, b"&" + encoded_key)
+            chunks.append(encoded_keys[0] if first else encoded_keys[1])
+            first = False
+            if key == "cvar" and isinstance(value, dict):
+                self._encode_cvar_into(chunks, value)
+            else:
+                chunks.append(self._encode_value(value))
+
+    def encode_bulk(
+        self,
+        records: typing.Iterable[bytes],
+        token_auth: typing.Optional[str] = None,
+    ) -> bytes:
+        """Encode encoded hits as a json body for the bulk tracking api.
+
+        The url-encoded hits only contain characters that are safe in a json string, so
+        they are written without further escaping.
+        """
+        chunks = [b'{"requests":[']
+        for index, record in enumerate(records):
+            chunks.append(b'"?' if index == 0 else b',"?')
+            chunks.append(record)
+            chunks.append(b'"')
+        chunks.append(b"]")
+        if token_auth:
+            chunks.append(b',"token_auth":')
+            chunks.append(json.dumps(token_auth).encode("ascii"))
+        chunks.append(b"}")
+        return b"".join(chunks)
+
+    def _encode_value(self, value: typing.Any) -> bytes:
+        if isinstance(value, int):
+            # digits and "-" don't need quoting, and e.g. `rand` would flood the cache
+            return str(value).encode("ascii")
+        if isinstance(value, float):
+            return _quote(str(value))
+        text = value if isinstance(value, str) else str(value)
+        encoded = self._values.get(text)
+        if encoded is None:
+            encoded = _quote(text)
+            if len(self._values) >= self.max_cached_values:
+                self._values.clear()
+            self._values[text] = encoded
+        return encoded
+
+    def _encode_cvar_into(
+        self, chunks: typing.List[bytes], cvar: typing.Dict[str, typing.Any]
+    ) -> None:
+        chunks.append(_CVAR_START)
+        first = True
+        for key, value in cvar.items():
+            encoded_keys = self._cvar_keys.get(key)
+            if encoded_keys is None:
+                encoded_key = _quote(f"{json.dumps(key)}: ")
+                encoded_keys = self._cvar_keys[key] = (
+                    encoded_key,
+                    _CVAR_SEPARATOR + encoded_key,
+                )
+            chunks.append(encoded_keys[0] if first else encoded_keys[1])
+            first = False
+            chunks.append(self._encode_cvar_value(value))
+        chunks.append(_CVAR_END)
+
+    def _encode_cvar_value(self, value: typing.Any) -> bytes:
+        if value is not None and not isinstance(value, (str, int)):
+            return _quote(json.dumps(value))
+        cache_key = (type(value), value)
+        encoded = self._cvar_values.get(cache_key)
+        if encoded is None:
+            encoded = _quote(json.dumps(value))
+            if len(self._cvar_values) >= self.max_cached_values:
+                self._cvar_values.clear()
+            self._cvar_values[cache_key] = encoded
+        return encoded
+
+
+def _quote(value: str) -> bytes:
+    return urllib.parse.quote_plus(value, safe="").encode("ascii")
@@ -0,0 +1,277 @@
+import gzip
+import json
+import logging
+import os
+import pathlib
+import threading
+import time
+import typing
+import zlib
+
+logger = logging.getLogger("flask_matomo2")
+
+LOG_SUFFIX = ".ndjson"
+GZIP_SUFFIX = ".gz"
+# the file that is written to has this suffix, it is removed when the file is rotated
+OPEN_SUFFIX = ".open"
+
+
+def _json_default(value: typing.Any) -> str:
+    # e.g. werkzeug's UserAgent
+    return str(value)
+
+
+def encode_hit(tracking_data: typing.Dict, *, timestamp: typing.Optional[float] = None) -> bytes:
+    """Encode a hit as one NDJSON line, without `token_auth`.
+
+    The time of the hit is stored in `cdt`, so that Matomo records it at that time when it
+    is imported later.
+
+    >>> encode_hit({"idsite": "1", "token_auth": "secret", "cvar": {"a": 1}}, timestamp=1.5)
+    b'{"idsite":"1","cvar":{"a":1},"cdt":1}\\n'
+    """
+    hit = {key: value for key, value in tracking_data.items() if key != "token_auth"}
+    if "cdt" not in hit and timestamp is not None:
+        hit["cdt"] = int(timestamp)
+    line = json.dumps(hit, separators=(",", ":"), ensure_ascii=False, default=_json_default)
+    return line.encode("utf-8") + b"\n"
+
+
+def read_hits(path: typing.Union[str, os.PathLike]) -> typing.Iterator[typing.Dict]:
+    """Iterate over the hits in a hit log file, compressed or not.
+
+    A truncated last line or gzip stream (e.g. of a file that is still written) is skipped.
+    """
+    path = pathlib.Path(path)
+    compressed = GZIP_SUFFIX in path.suffixes
+    with gzip.open(path, "rb") if compressed else open(path, "rb") as fp:  # noqa: SIM115
+        try:
+            for line in fp:
+                if not line.endswith(b"\n"):
+                    logger.warning("Skipping truncated hit in hit log '%s'", path)
+                    return
+                yield json.loads(line)
+        except EOFError:
+            logger.warning("Skipping truncated end of hit log '%s'", path)
+
+
+class HitLog:
+    """Append hits as NDJSON lines to rotating, optionally gzip compressed, files.
+
+    Lines are buffered and written when `buffer_bytes` are collected. A sync thread, started
+    by the first hit, writes the buffered lines and syncs the file to disk every
+    `fsync_interval` seconds, so that hits of a quiet app reach the disk too. The file is
+    rotated when it holds `max_bytes` (uncompressed) or is `max_age` seconds old, the age
+    is also checked by the sync thread. The file that is written
+    to has the suffix ".open", which is removed when it is rotated or closed, so files
+    without it are complete and can be shipped and imported with `flask matomo replay`.
+
+    Every process (e.g. forked gunicorn worker) writes to its own files, so several
+    processes can share a directory.
+
+    >>> import tempfile
+    >>> hit_log = HitLog(tempfile.mkdtemp())
+    >>> hit_log.append({"idsite": "1", "rec": "1"})
+    >>> hit_log.close()
+    >>> [hit["idsite"] for path in hit_log.files() for hit in read_hits(path)]
+    ['1']
+
+    Parameters
+    ----------
+    directory : str | os.PathLike
+        directory to write the files to, created if missing
+    max_bytes : Optional[int]
+        maximum uncompressed size of a file in bytes. Default: 64 MiB
+    max_age : Optional[float]
+        maximum number of seconds to write to a file. Default: 3600.0
+    compress : bool
+        gzip compress the files. Default: False
+    buffer_bytes : int
+        number of bytes to collect before writing them to the file. Default: 64 KiB
+    fsync_interval : Optional[float]
+        seconds between syncs of the file to disk. Default: 1.0 (None leaves it to the
+        operating system, the buffered lines are then written every second)
+    clock : Callable[[], float]
+        function returning the current time in seconds. Default: `time.time`
+    """
+
+    def __init__(
+        self,
+        directory: typing.Union[str, os.PathLike],
+        *,
+        max_bytes: typing.Optional[int] = 64 * 1024 * 1024,
+        max_age: typing.Optional[float] = 3600.0,
+        compress: bool = False,
+        buffer_bytes: int = 64 * 1024,
+        fsync_interval: typing.Optional[float] = 1.0,
+        clock: typing.Callable[[], float] = time.time,
+    ) -> None:
+        self.directory = pathlib.Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.compress = compress
+        self.buffer_bytes = buffer_bytes
+        self.fsync_interval = fsync_interval
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._thread: typing.Optional[threading.Thread] = None
+        self._stopping = threading.Event()
+        self._seq = 0
+        self._reset()
+
+    def _reset(self) -> None:
+        # the file is written with os.write, so no buffered data of the parent is written
+        # by a forked child
+        self._fd: typing.Optional[int] = None
+        self._path: typing.Optional[pathlib.Path] = None
+        self._compressor: typing.Optional[typing.Any] = None
+        self._buffer = bytearray()
+        self._file_bytes = 0
+        self._opened_at = 0.0
+        # hits were appended since the file was last synced
+        self._unsynced = False
+
+    def files(self) -> typing.List[pathlib.Path]:
+        """Return the complete files, oldest first."""
+        return sorted(
+            path
+            for path in self.directory.glob(f"*{LOG_SUFFIX}*")
+            if not path.name.endswith(OPEN_SUFFIX)
+        )
+
+    def append(self, tracking_data: typing.Dict) -> None:
+        """Append one hit to the log."""
+        if self._thread is None:
+            self.start()
+        now = self.clock()
+        line = encode_hit(tracking_data, timestamp=now)
+        with self._lock:
+            if self._fd is None or self._should_rotate(now, len(line)):
+                self._rotate(now)
+            self._file_bytes += len(line)
+            if self._compressor is not None:
+                self._buffer += self._compressor.compress(line)
+            else:
+                self._buffer += line
+            self._unsynced = True
+            if len(self._buffer) >= self.buffer_bytes:
+                self._flush(sync=False)
+
+    def flush(self) -> None:
+        """Write the buffered hits and sync the file to disk."""
+        with self._lock:
+            if self._fd is not None:
+                self._flush(sync=True)
+                self._unsynced = False
+
+    def rotate(self) -> None:
+        """Complete the current file, the next hit starts a new file."""
+        with self._lock:
+            self._close_file()
+
+    def start(self) -> None:
+        """Start the sync thread."""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._stopping.clear()
+            self._thread = threading.Thread(
+                target=self._run, name="flask_matomo2-hitlog", daemon=True
+            )
+            self._thread.start()
+
+    def close(self) -> None:
+        """Stop the sync thread and complete the current file."""
+        thread = self._thread
+        if thread is not None:
+            self._stopping.set()
+            thread.join()
+            self._thread = None
+        self.rotate()
+
+    def after_fork(self) -> None:
+        """Reset the log in a forked child process, the current file belongs to the parent.
+
+        The child closes its copy of the file without writing the parent's buffered hits
+        and starts its own file and sync thread on the next append.
+        """
+        if self._fd is not None:
+            os.close(self._fd)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stopping = threading.Event()
+        self._reset()
+
+    def _run(self) -> None:
+        interval = self.fsync_interval if self.fsync_interval is not None else 1.0
+        while not self._stopping.wait(interval):
+            try:
+                self._sync()
+            except OSError:
+                logger.exception("Syncing hit log '%s' failed", self._path)
+
+    def _sync(self) -> None:
+        """Rotate the file if it is too old, or else write and sync the appended hits."""
+        with self._lock:
+            if self._fd is None:
+                return
+            if self.max_age is not None and self.clock() - self._opened_at >= self.max_age:
+                self._close_file()
+                return
+            if not self._unsynced:
+                return
+            self._unsynced = False
+            sync = self.fsync_interval is not None
+            if sync and self._compressor is not None:
+                self._buffer += self._compressor.flush(zlib.Z_SYNC_FLUSH)
+            self._flush(sync=False)
+            # synced outside the lock so that appending hits doesn't wait for the disk
+            fd = os.dup(self._fd) if sync else None
+        if fd is not None:
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def _should_rotate(self, now: float, size: int) -> bool:
+        if self.max_bytes is not None and self._file_bytes + size > self.max_bytes:
+            return self._file_bytes > 0
+        return self.max_age is not None and now - self._opened_at >= self.max_age
+
+    def _rotate(self, now: float) -> None:
+        self._close_file()
+        stamp = time.strftime("%Y%m%dT%H%M%S", time.gmtime(now))
+        suffix = LOG_SUFFIX + (GZIP_SUFFIX if self.compress else "")
+        # the pid keeps processes sharing the directory from writing to the same file
+        name = f"hits-{stamp}-{os.getpid()}-{self._seq:04d}{suffix}"
+        self._seq += 1
+        self._path = self.directory / (name + OPEN_SUFFIX)
+        self._fd = os.open(self._path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        if self.compress:
+            self._compressor = zlib.compressobj(wbits=zlib.MAX_WBITS | 16)
+        self._file_bytes = 0
+        self._opened_at = now
+
+    def _flush(self, *, sync: bool) -> None:
+        if sync and self._compressor is not None:
+            # makes everything written so far readable, at some cost in compression
+            self._buffer += self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        if self._buffer:
+            os.write(self._fd, self._buffer)  # type: ignore[arg-type]
+            self._buffer = bytearray()
+        if sync:
+            os.fsync(self._fd)  # type: ignore[arg-type]
+
+    def _close_file(self) -> None:
+        if self._fd is None:
+            return
+        if self._compressor is not None:
+            self._buffer += self._compressor.flush(zlib.Z_FINISH)
+            self._compressor = None
+        self._flush(sync=self.fsync_interval is not None)
+        os.close(self._fd)
+        self._fd = None
+        if self._path is not None:
+            self._path.rename(self._path.with_name(self._path.name[: -len(OPEN_SUFFIX)]))
+            self._path = None
@@ -0,0 +1,243 @@
+import bisect
+import threading
+import typing
+
+# upper bounds in seconds of the latency histograms
+LATENCY_BUCKETS = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+BATCH_SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+class Counter:
+    """A monotonically increasing count.
+
+    >>> counter = Counter("hits_total", "Number of hits")
+    >>> counter.inc()
+    >>> counter.inc(2)
+    >>> counter.value
+    3
+    """
+
+    type = "counter"
+
+    def __init__(self, name: str, help: str) -> None:  # noqa: A002
+        self.name = name
+        self.help = help
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: int = 1) -> None:
+        with self._lock:
+            self.value += amount
+
+    def samples(self) -> typing.List[typing.Tuple[str, str, float]]:
+        return [(self.name, "", self.value)]
+
+    def snapshot(self) -> typing.Any:
+        return self.value
+
+    def reset(self) -> None:
+        self.value = 0
+        self._lock = threading.Lock()
+
+
+class Gauge:
+    """A value that is read from `read` when the metrics are collected.
+
+    Parameters
+    ----------
+    type : str
+        the Prometheus type, "gauge" or "counter" for a count kept elsewhere.
+        Default: "gauge"
+    """
+
+    def __init__(
+        self,
+        name: str,
+        help: str,  # noqa: A002
+        read: typing.Callable[[], float],
+        *,
+        type: str = "gauge",  # noqa: A002
+    ) -> None:
+        self.name = name
+        self.help = help
+        self.read = read
+        self.type = type
+
+    def samples(self) -> typing.List[typing.Tuple[str, str, float]]:
+        return [(self.name, "", self.read())]
+
+    def snapshot(self) -> typing.Any:
+        return self.read()
+
+    def reset(self) -> None:
+        pass
+
+
+class Histogram:
+    """Count observations in fixed buckets, in constant memory.
+
+    >>> histogram = Histogram("batch_size", "Hits per batch", buckets=(1, 10, 100))
+    >>> for size in (1, 5, 50):
+    ...     histogram.observe(size)
+    >>> histogram.snapshot()
+    {'count': 3, 'sum': 56, 'buckets': {1: 1, 10: 2, 100: 3}}
+    """
+
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,  # noqa: A002
+        *,
+        buckets: typing.Sequence[float] = LATENCY_BUCKETS,
+    ) -> None:
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.reset()
+
+    def observe(self, value: float) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self.count += 1
+            self.sum += value
+
+    def _cumulative(self) -> typing.List[int]:
+        cumulative = []
+        seen = 0
+        for bucket_count in self._counts[:-1]:
+            seen += bucket_count
+            cumulative.append(seen)
+        return cumulative
+
+    def samples(self) -> typing.List[typing.Tuple[str, str, float]]:
+        with self._lock:
+            cumulative = self._cumulative()
+            count, total = self.count, self.sum
+        samples: typing.List[typing.Tuple[str, str, float]] = [
+            (f"{self.name}_bucket", f'le="{bound}"', seen)
+            for bound, seen in zip(self.buckets, cumulative)
+        ]
+        samples.append((f"{self.name}_bucket", 'le="+Inf"', count))
+        samples.append((f"{self.name}_sum", "", total))
+        samples.append((f"{self.name}_count", "", count))
+        return samples
+
+    def snapshot(self) -> typing.Any:
+        with self._lock:
+            return {
+                "count": self.count,
+                "sum": self.sum,
+                "buckets": dict(zip(self.buckets, self._cumulative())),
+            }
+
+    def reset(self) -> None:
+        self.count = 0
+        self.sum: float = 0
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._lock = threading.Lock()
+
+
+class PipelineMetrics:
+    """Counters and histograms of the tracking pipeline of a `Matomo` extension.
+
+    >>> metrics = PipelineMetrics()
+    >>> metrics.hits_tracked.inc()
+    >>> metrics.snapshot()["flask_matomo2_hits_tracked_total"]
+    1
+    >>> print(metrics.render_prometheus().splitlines()[0])
+    # HELP flask_matomo2_hits_tracked_total Hits handed to the send path.
+    """
+
+    def __init__(self) -> None:
+        self.hits_tracked = Counter(
+            "flask_matomo2_hits_tracked_total", "Hits handed to the send path."
+        )
+        self.hits_ignored = Counter(
+            "flask_matomo2_hits_ignored_total", "Requests not tracked because of ignore rules."
+        )
+        self.hits_sampled_out = Counter(
+            "flask_matomo2_hits_sampled_out_total", "Requests not tracked because of sampling."
+        )
+        self.hits_aggregated = Counter(
+            "flask_matomo2_hits_aggregated_total", "Requests counted in aggregated routes."
+        )
+        self.send_errors = Counter(
+            "flask_matomo2_send_errors_total", "Calls to Matomo that failed after all retries."
+        )
+        self.retries = Counter(
+            "flask_matomo2_retries_total", "Calls to Matomo that were retried."
+        )
+        self.send_latency = Histogram(
+            "flask_matomo2_send_latency_seconds", "Duration of the calls to Matomo."
+        )
+        self.batch_size = Histogram(
+            "flask_matomo2_batch_size", "Hits per bulk request.", buckets=BATCH_SIZE_BUCKETS
+        )
+        self.before_request_duration = Histogram(
+            "flask_matomo2_before_request_seconds", "Time spent in before_request."
+        )
+        self.teardown_request_duration = Histogram(
+            "flask_matomo2_teardown_request_seconds", "Time spent in teardown_request."
+        )
+        self._metrics: typing.List[typing.Union[Counter, Gauge, Histogram]] = [
+            self.hits_tracked,
+            self.hits_ignored,
+            self.hits_sampled_out,
+            self.hits_aggregated,
+            self.send_errors,
+            self.retries,
+            self.send_latency,
+            self.batch_size,
+            self.before_request_duration,
+            self.teardown_request_duration,
+        ]
+
+    def add_gauge(
+        self,
+        name: str,
+        help: str,  # noqa: A002
+        read: typing.Callable[[], float],
+        *,
+        type: str = "gauge",  # noqa: A002
+    ) -> None:
+        """Add a value that is read when the metrics are collected, e.g. the queue depth."""
+        self._metrics.append(Gauge(name, help, read, type=type))
+
+    def snapshot(self) -> typing.Dict[str, typing.Any]:
+        """Return the current value of all metrics by name."""
+        return {metric.name: metric.snapshot() for metric in self._metrics}
+
+    def render_prometheus(self) -> str:
+        """Render all metrics in the Prometheus text exposition format."""
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{{{labels}}} {value}" if labels else f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    def after_fork(self) -> None:
+        """Reset the counters in a forked child process, they count the parent's hits."""
+        for metric in self._metrics:
+            metric.reset()
@@ -0,0 +1,250 @@
+import collections
+import logging
+import queue
+import threading
+import time
+import typing
+
+logger = logging.getLogger("flask_matomo2")
+
+OVERFLOW_POLICIES = ("drop_newest", "drop_oldest", "block")
+
+
+def estimate_size(tracking_data: typing.Any) -> int:
+    """Estimate the number of bytes a hit occupies when encoded.
+
+    >>> estimate_size({"idsite": "1", "rec": "1"})
+    15
+    """
+    if not isinstance(tracking_data, dict):
+        return len(str(tracking_data))
+    return sum(len(key) + len(str(value)) + 2 for key, value in tracking_data.items())
+
+
+class TrackingQueue:
+    """A queue for hits that is bounded by number of items and/or bytes.
+
+    When the queue is full, the `overflow_policy` decides what happens:
+
+    - "drop_newest": the hit that is put is dropped.
+    - "drop_oldest": the oldest hit in the queue is dropped to make room.
+    - "block": wait at most `block_timeout` seconds for room, then drop the hit that is put.
+
+    Dropped hits are counted in `dropped`.
+
+    If `lanes` and `classify` are given, every hit is put in the priority lane that
+    `classify` returns, the first lane having the highest priority. Hits are taken from the
+    highest priority lane first, and when the queue is full, hits of lower lanes are dropped
+    to make room before `overflow_policy` applies. The dropped hits are also counted per lane
+    in `dropped_by_lane`.
+
+    >>> q = TrackingQueue(max_items=1)
+    >>> q.put({"rand": 0}), q.put({"rand": 1})
+    (True, False)
+    >>> q.dropped
+    1
+
+    Parameters
+    ----------
+    max_items : Optional[int]
+        maximum number of hits in the queue. Default: None (unbounded)
+    max_bytes : Optional[int]
+        maximum estimated size in bytes of the hits in the queue. Default: None (unbounded)
+    overflow_policy : str
+        one of "drop_newest", "drop_oldest" or "block". Default: "drop_newest"
+    block_timeout : float
+        seconds to wait for room when overflow_policy is "block". Default: 1.0
+    size_of : Callable[[Any], int]
+        function to estimate the size of a hit. Default: `estimate_size`
+    on_drop : Optional[Callable[[Any], Any]]
+        called with every dropped hit, e.g. to spool it. Default: None
+    lanes : Sequence[str]
+        names of the priority lanes, highest priority first. Default: ("default",)
+    classify : Optional[Callable[[Any], int]]
+        returns the index of the lane of a hit. Default: None (all hits in the first lane)
+    """
+
+    def __init__(
+        self,
+        *,
+        max_items: typing.Optional[int] = None,
+        max_bytes: typing.Optional[int] = None,
+        overflow_policy: str = "drop_newest",
+        block_timeout: float = 1.0,
+        size_of: typing.Callable[[typing.Any], int] = estimate_size,
+        on_drop: typing.Optional[typing.Callable[[typing.Any], typing.Any]] = None,
+        lanes: typing.Sequence[str] = ("default",),
+        classify: typing.Optional[typing.Callable[[typing.Any], int]] = None,
+    ) -> None:
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError(
+                f"overflow_policy must be one of {OVERFLOW_POLICIES}, got '{overflow_policy}'"
+            )
+        if not lanes:
+            raise ValueError("lanes must not be empty")
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.overflow_policy = overflow_policy
+        self.block_timeout = block_timeout
+        self.size_of = size_of
+        self.on_drop = on_drop
+        self.lanes = tuple(lanes)
+        self.classify = classify
+        self.dropped = 0
+        self.dropped_by_lane = dict.fromkeys(self.lanes, 0)
+        self._reset()
+
+    def _reset(self) -> None:
+        self.bytes = 0
+        self._lanes: typing.List[typing.Deque[typing.Tuple[typing.Any, int]]] = [
+            collections.deque() for _ in self.lanes
+        ]
+        # control items are taken when no hits are left
+        self._control: typing.Deque[typing.Any] = collections.deque()
+        self._count = 0
+        self._unfinished = 0
+        self._mutex = threading.Lock()
+        self._not_empty = threading.Condition(self._mutex)
+        self._not_full = threading.Condition(self._mutex)
+        self._all_done = threading.Condition(self._mutex)
+
+    def __len__(self) -> int:
+        return self._count + len(self._control)
+
+    def _has_room(self, size: int) -> bool:
+        if self.max_items is not None and self._count >= self.max_items:
+            return False
+        if self.max_bytes is not None and self._count and self.bytes + size > self.max_bytes:
+            return False
+        return True
+
+    def _pop_oldest(self, min_lane: int) -> typing.Optional[typing.Tuple[typing.Any, int]]:
+        """Remove the oldest hit of the lowest non-empty lane from `min_lane` down."""
+        for lane in range(len(self._lanes) - 1, min_lane - 1, -1):
+            if self._lanes[lane]:
+                item, size = self._lanes[lane].popleft()
+                self._count -= 1
+                self.bytes -= size
+                self._unfinished -= 1
+                self.dropped_by_lane[self.lanes[lane]] += 1
+                return item
+        return None
+
+    def put(self, item: typing.Any) -> bool:
+        """Put a hit on the queue, returns False if a hit was dropped instead."""
+        size = self.size_of(item) if self.max_bytes is not None else 0
+        lane = self.classify(item) if self.classify is not None else 0
+        accepted = True
+        dropped = []
+        with self._mutex:
+            # shed hits of lower priority lanes first
+            while not self._has_room(size):
+                oldest = self._pop_oldest(lane + 1)
+                if oldest is None:
+                    break
+                dropped.append(oldest)
+            if not self._has_room(size):
+                if self.overflow_policy == "drop_newest":
+                    accepted = False
+                elif self.overflow_policy == "drop_oldest":
+                    while not self._has_room(size):
+                        oldest = self._pop_oldest(lane)
+                        if oldest is None:
+                            # only hits of higher priority are queued
+                            accepted = False
+                            break
+                        dropped.append(oldest)
+                else:
+                    deadline = time.monotonic() + self.block_timeout
+                    while accepted and not self._has_room(size):
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            accepted = False
+                        else:
+                            self._not_full.wait(remaining)
+            if accepted:
+                self._lanes[lane].append((item, size))
+                self._count += 1
+                self.bytes += size
+                self._unfinished += 1
+                self._not_empty.notify()
+            else:
+                dropped.append(item)
+                self.dropped_by_lane[self.lanes[lane]] += 1
+            self.dropped += len(dropped)
+        if dropped:
+            self._handle_dropped(dropped)
+        return accepted
+
+    def put_control(self, item: typing.Any) -> None:
+        """Put a control item on the queue, ignoring the limits.
+
+        Control items are taken after all hits that are queued.
+        """
+        with self._mutex:
+            self._control.append(item)
+            self._unfinished += 1
+            self._not_empty.notify()
+
+    def _handle_dropped(self, dropped: typing.List[typing.Any]) -> None:
+        logger.debug("Tracking queue is full, dropped hits (dropped=%d)", self.dropped)
+        if self.on_drop is not None:
+            for item in dropped:
+                self.on_drop(item)
+
+    def get(self, timeout: typing.Optional[float] = None) -> typing.Any:
+        """Remove and return the oldest item of the highest priority lane.
+
+        Raises `queue.Empty` on timeout.
+        """
+        with self._not_empty:
+            if timeout is None:
+                while not self._count and not self._control:
+                    self._not_empty.wait()
+            else:
+                deadline = time.monotonic() + timeout
+                while not self._count and not self._control:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise queue.Empty
+                    self._not_empty.wait(remaining)
+            for items in self._lanes:
+                if items:
+                    item, size = items.popleft()
+                    self._count -= 1
+                    self.bytes -= size
+                    self._not_full.notify()
+                    return item
+            return self._control.popleft()
+
+    def drain_nowait(self) -> typing.List[typing.Any]:
+        """Remove and return all queued hits, control items are discarded."""
+        with self._mutex:
+            items = [item for items in self._lanes for item, _ in items]
+            self._unfinished -= self._count + len(self._control)
+            for lane_items in self._lanes:
+                lane_items.clear()
+            self._control.clear()
+            self._count = 0
+            self.bytes = 0
+            self._not_full.notify_all()
+            if self._unfinished <= 0:
+                self._all_done.notify_all()
+        return items
+
+    def after_fork(self) -> None:
+        """Reset the queue in a forked child process, dropping the hits of the parent."""
+        self._reset()
+
+    def task_done(self) -> None:
+        """Mark an item returned by `get` as processed."""
+        with self._all_done:
+            self._unfinished -= 1
+            if self._unfinished <= 0:
+                self._all_done.notify_all()
+
+    def join(self) -> None:
+        """Block until all items put on the queue are processed."""
+        with self._all_done:
+            while self._unfinished > 0:
+                self._all_done.wait()
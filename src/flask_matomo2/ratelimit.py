@@ -0,0 +1,152 @@
+import threading
+import time
+import typing
+
+RATE_LIMIT_POLICIES = ("wait", "spool")
+
+
+class RateLimitedError(Exception):
+    """Raised when a call to Matomo is not made because the rate limit is reached."""
+
+
+class _Bucket:
+    __slots__ = ("capacity", "rate", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float, now: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def has(self, amount: float) -> bool:
+        # a call bigger than the bucket is let through when the bucket is full
+        return self.tokens >= min(amount, self.capacity)
+
+    def wait_time(self, amount: float) -> float:
+        # like `has`, a call bigger than the bucket only waits until the bucket is full
+        return max(0.0, (min(amount, self.capacity) - self.tokens) / self.rate)
+
+
+class RateLimiter:
+    """Limit the hits and/or bytes per second sent to Matomo with token buckets.
+
+    Each bucket holds at most `burst` seconds worth of tokens, a call bigger than that is
+    let through when the bucket is full and paid off by the following calls. `try_acquire`
+    takes the tokens for a call if they are available, `reserve` takes them and returns the
+    number of seconds to wait before making the call, unless that is longer than
+    `max_wait`.
+
+    >>> limiter = RateLimiter(hits_per_second=10, clock=lambda: 0.0)
+    >>> limiter.try_acquire(hits=10), limiter.try_acquire(hits=1)
+    (True, False)
+    >>> limiter.reserve(hits=5)
+    0.5
+    >>> limiter.reserve(hits=10, max_wait=1.0) is None
+    True
+
+    Parameters
+    ----------
+    hits_per_second : Optional[float]
+        maximum number of hits per second. Default: None (no limit)
+    bytes_per_second : Optional[float]
+        maximum number of bytes per second. Default: None (no limit)
+    burst : float
+        number of seconds worth of hits and bytes that may be sent at once. Default: 1.0
+    clock : Callable[[], float]
+        function returning the current time in seconds. Default: `time.monotonic`
+    """
+
+    def __init__(
+        self,
+        *,
+        hits_per_second: typing.Optional[float] = None,
+        bytes_per_second: typing.Optional[float] = None,
+        burst: float = 1.0,
+        clock: typing.Callable[[], float] = time.monotonic,
+    ) -> None:
+        if hits_per_second is None and bytes_per_second is None:
+            raise ValueError("hits_per_second or bytes_per_second must be set")
+        if burst <= 0:
+            raise ValueError("burst must be positive")
+        self.hits_per_second = hits_per_second
+        self.bytes_per_second = bytes_per_second
+        self.clock = clock
+        # number of hits that were delayed or rejected
+        self.limited = 0
+        now = clock()
+        self._hits = (
+            _Bucket(hits_per_second, hits_per_second * burst, now)
+            if hits_per_second is not None
+            else None
+        )
+        self._bytes = (
+            _Bucket(bytes_per_second, bytes_per_second * burst, now)
+            if bytes_per_second is not None
+            else None
+        )
+        self._lock = threading.Lock()
+
+    def try_acquire(self, *, hits: int = 1, nbytes: int = 0) -> bool:
+        """Take the tokens for a call, returns False if they aren't available."""
+        with self._lock:
+            now = self.clock()
+            for bucket, amount in self._amounts(hits, nbytes):
+                bucket.refill(now)
+                if not bucket.has(amount):
+                    self.limited += hits
+                    return False
+            for bucket, amount in self._amounts(hits, nbytes):
+                bucket.tokens -= amount
+            return True
+
+    def reserve(
+        self, *, hits: int = 1, nbytes: int = 0, max_wait: typing.Optional[float] = None
+    ) -> typing.Optional[float]:
+        """Take the tokens for a call, returns the number of seconds to wait before it.
+
+        Returns None without taking the tokens if the call would have to wait more than
+        `max_wait` seconds.
+        """
+        with self._lock:
+            now = self.clock()
+            amounts = self._amounts(hits, nbytes)
+            delay = 0.0
+            for bucket, amount in amounts:
+                bucket.refill(now)
+                delay = max(delay, bucket.wait_time(amount))
+            if delay > 0:
+                self.limited += hits
+            if max_wait is not None and delay > max_wait:
+                return None
+            for bucket, amount in amounts:
+                bucket.tokens -= amount
+            return delay
+
+    def tokens(self) -> typing.Dict[str, float]:
+        """Return the currently available hits and bytes tokens, for monitoring."""
+        with self._lock:
+            now = self.clock()
+            tokens = {}
+            if self._hits is not None:
+                self._hits.refill(now)
+                tokens["hits"] = self._hits.tokens
+            if self._bytes is not None:
+                self._bytes.refill(now)
+                tokens["bytes"] = self._bytes.tokens
+            return tokens
+
+    def after_fork(self) -> None:
+        """Replace the lock in a forked child process, it may be held by a thread of the parent."""
+        self._lock = threading.Lock()
+
+    def _amounts(self, hits: int, nbytes: int) -> typing.List[typing.Tuple[_Bucket, int]]:
+        amounts = []
+        if self._hits is not None:
+            amounts.append((self._hits, hits))
+        if self._bytes is not None:
+            amounts.append((self._bytes, nbytes))
+        return amounts
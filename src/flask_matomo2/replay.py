@@ -0,0 +1,243 @@
+import collections
+import concurrent.futures
+import itertools
+import json
+import logging
+import os
+import pathlib
+import time
+import typing
+
+import click
+
+from flask_matomo2.encoding import HitEncoder
+from flask_matomo2.hitlog import LOG_SUFFIX, OPEN_SUFFIX, read_hits
+from flask_matomo2.spool import SEGMENT_SUFFIX, iter_records
+
+if typing.TYPE_CHECKING:  # pragma: no cover
+    from flask_matomo2.core import Matomo
+
+logger = logging.getLogger("flask_matomo2")
+
+# the index of a file in the sorted list of files and the offset after a record in it
+Position = typing.Tuple[int, int]
+
+
+def source_files(
+    paths: typing.Iterable[typing.Union[str, os.PathLike]],
+) -> typing.List[pathlib.Path]:
+    """Return the spool segments and complete hit log files in `paths`, sorted by name.
+
+    Directories are searched for files, files are used as given.
+    """
+    files = set()
+    for path in map(pathlib.Path, paths):
+        if not path.is_dir():
+            files.add(path)
+            continue
+        for child in path.iterdir():
+            if child.name.endswith(OPEN_SUFFIX):
+                continue
+            if child.name.endswith(SEGMENT_SUFFIX) or LOG_SUFFIX in child.suffixes:
+                files.add(child)
+    return sorted(files, key=lambda path: (path.name, str(path)))
+
+
+def iter_stored_records(
+    files: typing.Sequence[pathlib.Path],
+    encoder: HitEncoder,
+    *,
+    start: typing.Optional[Position] = None,
+) -> typing.Iterator[typing.Tuple[Position, bytes]]:
+    """Iterate over the hits in spool segments and hit log files as encoded records.
+
+    The offset is the end offset of a spool record and the line number of a hit in a hit
+    log. Records up to and including `start` are skipped.
+    """
+    for index, path in enumerate(files):
+        if start is not None and index < start[0]:
+            continue
+        skip_until = start[1] if start is not None and index == start[0] else 0
+        if path.name.endswith(SEGMENT_SUFFIX):
+            records: typing.Iterator[typing.Tuple[int, bytes]] = iter_records(path)
+        else:
+            records = (
+                (line, encoder.encode(hit)) for line, hit in enumerate(read_hits(path), start=1)
+            )
+        for offset, record in records:
+            if offset > skip_until:
+                yield (index, offset), bytes(record)
+
+
+def batched(
+    records: typing.Iterable[typing.Tuple[Position, bytes]], batch_size: int
+) -> typing.Iterator[typing.Tuple[Position, typing.List[bytes]]]:
+    """Group records in batches, yields the position of the last record and the batch.
+
+    >>> list(batched([((0, 1), b"a"), ((0, 2), b"b"), ((1, 1), b"c")], 2))
+    [((0, 2), [b'a', b'b']), ((1, 1), [b'c'])]
+    """
+    iterator = iter(records)
+    while True:
+        chunk = list(itertools.islice(iterator, batch_size))
+        if not chunk:
+            return
+        yield chunk[-1][0], [record for _, record in chunk]
+
+
+class Checkpoint:
+    """The position up to which hits are sent, stored in a json file.
+
+    The files are identified by name, so the position stays valid when new files are
+    added to the directory, since they sort after the files that are replayed.
+    """
+
+    def __init__(self, path: typing.Union[str, os.PathLike]) -> None:
+        self.path = pathlib.Path(path)
+
+    def load(self, files: typing.Sequence[pathlib.Path]) -> typing.Optional[Position]:
+        try:
+            data = json.loads(self.path.read_text())
+        except FileNotFoundError:
+            return None
+        names = [path.name for path in files]
+        if data["file"] not in names:
+            # the file is gone, start with the files that sort after it
+            return sum(name < data["file"] for name in names), 0
+        return names.index(data["file"]), data["offset"]
+
+    def save(self, files: typing.Sequence[pathlib.Path], position: Position) -> None:
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        tmp_path.write_text(json.dumps({"file": files[position[0]].name, "offset": position[1]}))
+        os.replace(tmp_path, self.path)
+
+
+class ReplayResult(typing.NamedTuple):
+    sent: int
+    batches: int
+    failed: bool
+    position: typing.Optional[Position]
+
+
+def replay(
+    batches: typing.Iterable[typing.Tuple[Position, typing.List[bytes]]],
+    send_batch: typing.Callable[[typing.List[bytes]], bool],
+    *,
+    concurrency: int = 4,
+    on_progress: typing.Optional[typing.Callable[[Position, int], typing.Any]] = None,
+) -> ReplayResult:
+    """Send batches with up to `concurrency` concurrent calls.
+
+    `on_progress` is called with the position up to which all batches are sent and the
+    number of hits sent, e.g. to save a checkpoint. Stops at the first batch that
+    `send_batch` fails to send, the batches sent after it are sent again when resuming.
+    """
+    sent = 0
+    sent_batches = 0
+    failed = False
+    position = None
+    # in flight, in the order they were read, so that the position only advances over
+    # batches that are all sent
+    in_flight: typing.Deque[typing.Tuple[Position, int, concurrent.futures.Future]] = (
+        collections.deque()
+    )
+
+    def complete_oldest() -> None:
+        nonlocal sent, sent_batches, failed, position
+        batch_position, size, future = in_flight.popleft()
+        if failed:
+            future.cancel()
+            return
+        if not future.result():
+            failed = True
+            return
+        sent += size
+        sent_batches += 1
+        position = batch_position
+        if on_progress is not None:
+            on_progress(position, sent)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for batch_position, batch in batches:
+            while len(in_flight) >= concurrency * 2 and not failed:
+                complete_oldest()
+            if failed:
+                break
+            in_flight.append((batch_position, len(batch), executor.submit(send_batch, batch)))
+        while in_flight:
+            complete_oldest()
+    return ReplayResult(sent, sent_batches, failed, position)
+
+
+def create_cli(matomo: "Matomo") -> click.Group:
+    """Create the `flask matomo` commands for `matomo`."""
+
+    @click.group("matomo", help="Commands of flask-matomo2.")
+    def cli() -> None:
+        pass
+
+    @cli.command("replay")
+    @click.argument("paths", nargs=-1, required=True, type=click.Path(exists=True))
+    @click.option("--batch-size", default=100, show_default=True, help="Hits per request.")
+    @click.option("--concurrency", default=4, show_default=True, help="Concurrent requests.")
+    @click.option("--max-retries", default=3, show_default=True, help="Retries per request.")
+    @click.option(
+        "--checkpoint",
+        type=click.Path(),
+        help="File to resume from and to store the progress in.",
+    )
+    def replay_command(
+        paths: typing.Tuple[str, ...],
+        batch_size: int,
+        concurrency: int,
+        max_retries: int,
+        checkpoint: typing.Optional[str],
+    ) -> None:
+        """Send the hits in spool segments and hit log files to Matomo.
+
+        PATHS are files or directories of spool segments (*.spool) and hit logs
+        (*.ndjson, *.ndjson.gz), the hits are sent in file name order with the bulk
+        tracking api. The files aren't removed. The replay stops at the first batch that
+        Matomo doesn't accept with a 2xx response, e.g. because of an invalid token_auth.
+        """
+        from flask_matomo2.core import Matomo
+
+        files = source_files(paths)
+        checkpoint_file = Checkpoint(checkpoint) if checkpoint is not None else None
+        start = checkpoint_file.load(files) if checkpoint_file is not None else None
+        if start is not None:
+            click.echo(f"Resuming after hit {start[1]} of {files[start[0]].name}")
+        # a client with a connection per concurrent request, the app's client may be async
+        sender = Matomo(
+            matomo_url=matomo.matomo_url,
+            token_auth=matomo.token_auth,
+            http2=matomo.http2,
+            max_connections=concurrency,
+            max_keepalive_connections=concurrency,
+            max_retries=max_retries,
+            retry_backoff=matomo.retry_policy.backoff_base,
+            retry_backoff_max=matomo.retry_policy.backoff_max,
+        )
+
+        def on_progress(position: Position, sent: int) -> None:
+            if checkpoint_file is not None:
+                checkpoint_file.save(files, position)
+
+        started = time.perf_counter()
+        result = replay(
+            batched(iter_stored_records(files, sender.encoder, start=start), batch_size),
+            # returns False unless Matomo accepted the batch, also on a 4xx response
+            sender._send_bulk,
+            concurrency=concurrency,
+            on_progress=on_progress,
+        )
+        elapsed = time.perf_counter() - started
+        sender.close()
+        click.echo(
+            f"Sent {result.sent} hits in {result.batches} requests in {elapsed:.1f} s "
+            f"({result.sent / max(elapsed, 1e-9):.0f} hits/s)"
+        )
+        if result.failed:
+            raise click.ClickException("Sending to Matomo failed, run again to resume")
+
+    return cli
@@ -0,0 +1,140 @@
+import logging
+import random
+import threading
+import time
+import typing
+
+logger = logging.getLogger("flask_matomo2")
+
+
+class CircuitOpenError(Exception):
+    """Raised when a call to Matomo is not made because the circuit breaker is open."""
+
+
+class RetryPolicy:
+    """Decide how many times and how long to wait before retrying a failed tracking call.
+
+    The delay before retry number `attempt` (starting at 0) is drawn uniformly from
+    `[0, min(backoff_max, backoff_base * 2 ** attempt)]` ("full jitter"), or is exactly the
+    upper bound if `jitter` is False.
+
+    >>> policy = RetryPolicy(max_retries=3, backoff_base=0.5, jitter=False)
+    >>> [policy.backoff(attempt) for attempt in range(3)]
+    [0.5, 1.0, 2.0]
+
+    Parameters
+    ----------
+    max_retries : int
+        number of retries after the first attempt. Default: 0 (don't retry)
+    backoff_base : float
+        seconds to wait before the first retry. Default: 0.5
+    backoff_max : float
+        maximum number of seconds to wait between retries. Default: 30.0
+    jitter : bool
+        randomize the delays, to avoid many workers retrying at the same time. Default: True
+    """
+
+    def __init__(
+        self,
+        *,
+        max_retries: int = 0,
+        backoff_base: float = 0.5,
+        backoff_max: float = 30.0,
+        jitter: bool = True,
+    ) -> None:
+        if max_retries < 0:
+            raise ValueError("max_retries must not be negative")
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.jitter = jitter
+
+    def backoff(self, attempt: int) -> float:
+        """Return the number of seconds to wait before retry number `attempt`."""
+        delay = min(self.backoff_max, self.backoff_base * 2**attempt)
+        return random.uniform(0, delay) if self.jitter else delay  # noqa: S311
+
+
+class CircuitBreaker:
+    """Stop calling Matomo for a while after repeated failures.
+
+    The breaker starts "closed" and lets all calls through. After `failure_threshold`
+    consecutive failures it "opens" and rejects all calls for `reset_timeout` seconds.
+    Then it is "half_open" and lets one trial call through, if that call succeeds the
+    breaker closes again, otherwise it opens for another `reset_timeout` seconds.
+
+    >>> breaker = CircuitBreaker(failure_threshold=1, reset_timeout=60.0)
+    >>> breaker.record_failure()
+    >>> breaker.state, breaker.allow_request()
+    ('open', False)
+
+    Parameters
+    ----------
+    failure_threshold : int
+        number of consecutive failures that opens the breaker. Default: 5
+    reset_timeout : float
+        seconds to reject calls when the breaker is open. Default: 30.0
+    clock : Callable[[], float]
+        function returning the current time in seconds. Default: `time.monotonic`
+    """
+
+    def __init__(
+        self,
+        *,
+        failure_threshold: int = 5,
+        reset_timeout: float = 30.0,
+        clock: typing.Callable[[], float] = time.monotonic,
+    ) -> None:
+        if failure_threshold < 1:
+            raise ValueError("failure_threshold must be at least 1")
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.rejected = 0
+        self._state = "closed"
+        self._failures = 0
+        self._opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def after_fork(self) -> None:
+        """Replace the lock in a forked child process, it may be held by a thread of the parent."""
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        """One of "closed", "open" or "half_open"."""
+        if self._state == "open" and self.clock() >= self._opened_at + self.reset_timeout:
+            return "half_open"
+        return self._state
+
+    def allow_request(self) -> bool:
+        """Return True if a call to Matomo may be made now."""
+        with self._lock:
+            if self._state == "closed":
+                return True
+            if self._state == "open" and self.clock() >= self._opened_at + self.reset_timeout:
+                # let one trial call through
+                self._state = "half_open"
+                return True
+            self.rejected += 1
+            return False
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self._state != "closed":
+                logger.info("Matomo is reachable again, closing circuit breaker")
+            self._state = "closed"
+            self._failures = 0
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if self._state == "half_open" or self._failures >= self.failure_threshold:
+                if self._state != "open":
+                    logger.warning(
+                        "Tracking calls failed %d times, not calling Matomo for %s seconds",
+                        self._failures,
+                        self.reset_timeout,
+                    )
+                self._state = "open"
+                self._opened_at = self.clock()
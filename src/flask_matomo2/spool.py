@@ -0,0 +1,287 @@
+import logging
+import mmap
+import os
+import pathlib
+import struct
+import threading
+import time
+import typing
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - not available on Windows
+    fcntl = None  # type: ignore[assignment]
+
+logger = logging.getLogger("flask_matomo2")
+
+SEGMENT_SUFFIX = ".spool"
+RECORD_HEADER = struct.Struct("<I")
+
+
+def iter_records(
+    path: typing.Union[str, os.PathLike],
+) -> typing.Iterator[typing.Tuple[int, bytes]]:
+    """Iterate over the records in a spool segment, yields the end offset and the record.
+
+    Each record is stored as a 4 byte little-endian length followed by the record.
+    A truncated record at the end of the segment (e.g. after a crash) is skipped.
+    """
+    with open(path, "rb") as fp:
+        if os.fstat(fp.fileno()).st_size == 0:
+            return
+        with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            offset = 0
+            end = len(buf)
+            while offset + RECORD_HEADER.size <= end:
+                (length,) = RECORD_HEADER.unpack_from(buf, offset)
+                start = offset + RECORD_HEADER.size
+                if start + length > end:
+                    logger.warning("Skipping truncated record in spool segment '%s'", path)
+                    return
+                offset = start + length
+                yield offset, buf[start:offset]
+
+
+def _try_lock(fp: typing.IO) -> bool:
+    """Try to take an exclusive lock on an open segment, without blocking."""
+    if fcntl is None:
+        return True
+    try:
+        fcntl.flock(fp.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        return False
+    return True
+
+
+def _segment_seq(path: pathlib.Path) -> int:
+    return int(path.stem.split("-", 1)[0])
+
+
+class Spool:
+    """Durable on-disk storage for hits that couldn't be sent to Matomo.
+
+    Hits are appended as length-prefixed records to segment files in `directory`, a record
+    is typically a hit encoded by `HitEncoder`.
+    When the current segment would grow beyond `max_segment_bytes` a new segment is
+    started, and if there are more than `max_segments` segments, the oldest is removed.
+
+    Several processes (e.g. forked gunicorn workers) can share a spool directory: every
+    process writes to its own segments, which are locked while they are written or drained,
+    so a segment is never drained while it is written to or by two processes at once.
+    Segments written by other processes are noticed within `rescan_interval` seconds.
+
+    >>> import tempfile
+    >>> spool = Spool(tempfile.mkdtemp())
+    >>> spool.append(b"idsite=1&rec=1")
+    >>> spool.drain(lambda records: True)
+    1
+    >>> spool.pending
+    False
+
+    Parameters
+    ----------
+    directory : str | os.PathLike
+        directory to store the segments in, created if missing
+    max_segment_bytes : int
+        maximum size of one segment in bytes. Default: 4 MiB
+    max_segments : Optional[int]
+        maximum number of segments to keep. Default: None (no limit)
+    rescan_interval : float
+        minimum number of seconds between looking for segments of other processes when
+        nothing is pending. Default: 1.0
+    """
+
+    def __init__(
+        self,
+        directory: typing.Union[str, os.PathLike],
+        *,
+        max_segment_bytes: int = 4 * 1024 * 1024,
+        max_segments: typing.Optional[int] = None,
+        rescan_interval: float = 1.0,
+    ) -> None:
+        self.directory = pathlib.Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_segment_bytes = max_segment_bytes
+        self.max_segments = max_segments
+        self.rescan_interval = rescan_interval
+        self.dropped_segments = 0
+        self._lock = threading.Lock()
+        self._drain_lock = threading.Lock()
+        self._fp: typing.Optional[typing.BinaryIO] = None
+        self._segment_bytes = 0
+        # offsets of partially drained segments
+        self._drained_offsets: typing.Dict[pathlib.Path, int] = {}
+        segments = self.segments()
+        self._next_seq = _segment_seq(segments[-1]) + 1 if segments else 0
+        self._pending = bool(segments)
+        self._rescan_at = time.monotonic() + rescan_interval
+
+    def segments(self) -> typing.List[pathlib.Path]:
+        """Return the segment files, oldest first."""
+        return sorted(self.directory.glob(f"*{SEGMENT_SUFFIX}"))
+
+    @property
+    def pending(self) -> bool:
+        """True if there are spooled hits that haven't been drained."""
+        if not self._pending and time.monotonic() >= self._rescan_at:
+            self._rescan_at = time.monotonic() + self.rescan_interval
+            self._pending = bool(self.segments())
+        return self._pending
+
+    def append(self, record: bytes) -> None:
+        """Append one record to the spool."""
+        self.extend([record])
+
+    def extend(self, records: typing.Iterable[bytes]) -> None:
+        """Append records to the spool."""
+        with self._lock:
+            fp = self._fp
+            # the records are written unbuffered, one write per segment
+            chunks: typing.List[bytes] = []
+            for record in records:
+                size = RECORD_HEADER.size + len(record)
+                if fp is None or (
+                    self._segment_bytes > 0
+                    and self._segment_bytes + size > self.max_segment_bytes
+                ):
+                    if fp is not None and chunks:
+                        fp.write(b"".join(chunks))
+                        chunks = []
+                    fp = self._rotate()
+                chunks.append(RECORD_HEADER.pack(len(record)))
+                chunks.append(record)
+                self._segment_bytes += size
+            if fp is not None and chunks:
+                fp.write(b"".join(chunks))
+                self._pending = True
+
+    def _rotate(self) -> typing.BinaryIO:
+        self._close_segment()
+        # the pid keeps processes sharing the directory from writing to the same segment
+        path = self.directory / f"{self._next_seq:012d}-{os.getpid()}{SEGMENT_SUFFIX}"
+        self._next_seq += 1
+        fp = self._fp = open(path, "ab", buffering=0)  # noqa: SIM115
+        _try_lock(fp)
+        self._segment_bytes = 0
+        if self.max_segments is not None:
+            segments = self.segments()
+            for segment in segments[: max(len(segments) - self.max_segments, 0)]:
+                if segment == path or not self._remove_unlocked(segment):
+                    continue
+                logger.warning("Spool is full, removed segment '%s'", segment)
+                self._drained_offsets.pop(segment, None)
+                self.dropped_segments += 1
+        return fp
+
+    @staticmethod
+    def _remove_unlocked(segment: pathlib.Path) -> bool:
+        """Remove a segment unless another process is writing or draining it."""
+        try:
+            with open(segment, "rb") as lock_fp:
+                if not _try_lock(lock_fp):
+                    return False
+                segment.unlink(missing_ok=True)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def _close_segment(self) -> None:
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+
+    def close(self) -> None:
+        """Close the current segment."""
+        with self._lock:
+            self._close_segment()
+
+    def after_fork(self) -> None:
+        """Reset the spool in a forked child process.
+
+        The child closes its copy of the parent's segment and starts its own segment on the
+        next append, the locks are replaced since they may be held by threads of the parent.
+        """
+        if self._fp is not None:
+            # closing the inherited file doesn't release the lock the parent holds
+            self._fp.close()
+            self._fp = None
+        self._segment_bytes = 0
+        self._drained_offsets = {}
+        self._lock = threading.Lock()
+        self._drain_lock = threading.Lock()
+
+    def drain(
+        self,
+        send_batch: typing.Callable[[typing.List[bytes]], bool],
+        *,
+        batch_size: int = 100,
+        max_batches: typing.Optional[int] = None,
+    ) -> int:
+        """Send spooled records in batches, oldest first.
+
+        Stops at the first batch that `send_batch` fails to send (returns False), those
+        records are kept in the spool. Fully sent segments are removed.
+
+        Parameters
+        ----------
+        send_batch : Callable[[list[bytes]], bool]
+            function that sends the records and returns True on success
+        batch_size : int
+            maximum number of records per batch. Default: 100
+        max_batches : Optional[int]
+            maximum number of batches to send. Default: None (drain everything)
+
+        Returns
+        -------
+        int
+            number of records sent
+        """
+        if not self._drain_lock.acquire(blocking=False):
+            return 0
+        try:
+            with self._lock:
+                self._close_segment()
+                segments = self.segments()
+            sent = 0
+            batches = 0
+            for segment in segments:
+                try:
+                    lock_fp = open(segment, "rb")  # noqa: SIM115
+                except FileNotFoundError:
+                    # drained by another process
+                    continue
+                with lock_fp:
+                    if not _try_lock(lock_fp):
+                        # written or drained by another process
+                        continue
+                    start = self._drained_offsets.get(segment, 0)
+                    batch: typing.List[bytes] = []
+                    offset = start
+                    for end, record in iter_records(segment):
+                        if end <= start:
+                            continue
+                        batch.append(record)
+                        offset = end
+                        if len(batch) >= batch_size:
+                            if not send_batch(batch):
+                                return sent
+                            sent += len(batch)
+                            batches += 1
+                            batch = []
+                            self._drained_offsets[segment] = offset
+                            if max_batches is not None and batches >= max_batches:
+                                return sent
+                    if batch:
+                        if not send_batch(batch):
+                            return sent
+                        sent += len(batch)
+                        batches += 1
+                    self._drained_offsets.pop(segment, None)
+                    segment.unlink(missing_ok=True)
+                if max_batches is not None and batches >= max_batches:
+                    return sent
+            return sent
+        finally:
+            with self._lock:
+                self._pending = self._fp is not None or bool(self.segments())
+            self._drain_lock.release()
@@ -0,0 +1,74 @@
+import typing
+
+
+class TrackingState:
+    """Tracking state of the current request, stored in `flask.g.flask_matomo2`.
+
+    The state also supports item access, so that existing code using
+    `flask.g.flask_matomo2["custom_tracking_data"]` or `PerfMsTracker` keeps working.
+
+    >>> state = TrackingState(start_ns=0, tracking_data={"idsite": "1"})
+    >>> state["custom_tracking_data"] = {"e_a": "Playing"}
+    >>> state.custom_tracking_data
+    {'e_a': 'Playing'}
+    >>> state.get("unknown", "default")
+    'default'
+    """
+
+    __slots__ = (
+        "aggregate",
+        "custom_tracking_data",
+        "deferred",
+        "spans",
+        "start_ns",
+        "tracking",
+        "tracking_data",
+    )
+
+    def __init__(
+        self,
+        *,
+        start_ns: int,
+        tracking_data: typing.Dict[str, typing.Any],
+        tracking: bool = True,
+        aggregate: typing.Optional[str] = None,
+    ) -> None:
+        self.tracking = tracking
+        # the route to aggregate the request in, instead of tracking it
+        self.aggregate = aggregate
+        self.start_ns = start_ns
+        self.tracking_data = tracking_data
+        self.custom_tracking_data: typing.Optional[typing.Dict[str, typing.Any]] = None
+        # the hit is sent when the streamed response is closed, not at teardown
+        self.deferred = False
+        # the names of the open `trackers.Span`s, outermost first
+        self.spans: typing.Optional[typing.List[str]] = None
+
+    def __getitem__(self, key: str) -> typing.Any:
+        if key not in self.__slots__:
+            raise KeyError(key)
+        value = getattr(self, key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key: str, value: typing.Any) -> None:
+        if key not in self.__slots__:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key: object) -> bool:
+        return key in self.__slots__ and getattr(self, key) is not None  # type: ignore[arg-type]
+
+    def get(self, key: str, default: typing.Any = None) -> typing.Any:
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __repr__(self) -> str:
+        return (
+            f"TrackingState(tracking={self.tracking!r}, start_ns={self.start_ns!r}, "
+            f"tracking_data={self.tracking_data!r}, "
+            f"custom_tracking_data={self.custom_tracking_data!r})"
+        )
@@ -0,0 +1,267 @@
+"""A local stand-in for Matomo, for tests and load tests.
+
+`FakeMatomo` serves matomo.php on localhost, understands single and bulk tracking requests
+and records the hits it receives. Its latency, error rate and outages can be scripted, to
+see how batching, retries and backpressure behave when Matomo is slow or down.
+
+Run it from the command line with:
+
+    python -m flask_matomo2.testing --port 8080 --latency-ms 20 --error-rate 0.01
+"""
+
+import argparse
+import http.server
+import json
+import logging
+import random
+import threading
+import time
+import typing
+import urllib.parse
+
+logger = logging.getLogger("flask_matomo2")
+
+
+class Phase(typing.NamedTuple):
+    """How `FakeMatomo` behaves for `duration` seconds, see `FakeMatomo.script`.
+
+    Attributes
+    ----------
+    duration : float
+        seconds the phase lasts
+    latency_ms : float
+        milliseconds to wait before answering a request. Default: 0.0
+    error_rate : float
+        fraction of the requests to answer with `error_status`. Default: 0.0
+    down : bool
+        close connections without answering, like an unreachable Matomo. Default: False
+    """
+
+    duration: float
+    latency_ms: float = 0.0
+    error_rate: float = 0.0
+    down: bool = False
+
+
+class FakeMatomo:
+    """Serve matomo.php on localhost from a thread and record the received hits.
+
+    A hit without `idsite` is invalid, it is answered with 400 in a single request and
+    reported in `invalid_indices` in a bulk request, like Matomo does.
+
+    >>> import httpx
+    >>> with FakeMatomo() as fake:
+    ...     r = httpx.post(fake.url, data={"idsite": "1", "rec": "1"})
+    ...     r = httpx.post(fake.url, json={"requests": ["?idsite=1&rand=1", "?rec=1"]})
+    >>> fake.hits
+    [{'idsite': '1', 'rec': '1'}, {'idsite': '1', 'rand': '1'}]
+    >>> r.json()["invalid_indices"]
+    [1]
+
+    Parameters
+    ----------
+    latency_ms : float
+        milliseconds to wait before answering a request. Default: 0.0
+    error_rate : float
+        fraction of the requests to answer with `error_status`. Default: 0.0
+    error_status : int
+        status code of failed requests. Default: 503
+    port : int
+        port to listen on. Default: 0 (any free port)
+    seed : Optional[int]
+        seed of the random errors, for reproducible runs. Default: None
+    """
+
+    def __init__(
+        self,
+        *,
+        latency_ms: float = 0.0,
+        error_rate: float = 0.0,
+        error_status: int = 503,
+        port: int = 0,
+        seed: typing.Optional[int] = None,
+    ) -> None:
+        self.latency_ms = latency_ms
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.down = False
+        # (time.perf_counter() when received, hit)
+        self.received: typing.List[typing.Tuple[float, typing.Dict[str, str]]] = []
+        self.requests = 0
+        self.bulk_requests = 0
+        self.errors = 0
+        self._random = random.Random(seed)  # noqa: S311
+        self._phases: typing.List[typing.Tuple[float, Phase]] = []
+        self._lock = threading.Lock()
+        self._server = http.server.ThreadingHTTPServer(("127.0.0.1", port), _handler(self))
+        self._server.daemon_threads = True
+        self._thread: typing.Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        if isinstance(host, bytes):
+            host = host.decode()
+        return f"http://{host}:{port}/matomo.php"
+
+    @property
+    def hits(self) -> typing.List[typing.Dict[str, str]]:
+        """The received hits, in the order they were received."""
+        with self._lock:
+            return [hit for _, hit in self.received]
+
+    def script(self, phases: typing.Sequence[Phase]) -> None:
+        """Behave like `phases`, one after the other starting now.
+
+        After the last phase the latency and error rate given to `FakeMatomo` apply again.
+
+        >>> fake = FakeMatomo()
+        >>> fake.script([Phase(10.0, down=True), Phase(5.0, error_rate=0.5)])
+        >>> fake.behaviour().down
+        True
+        >>> fake.stop()
+        """
+        start = time.monotonic()
+        scheduled = []
+        for phase in phases:
+            start += phase.duration
+            scheduled.append((start, phase))
+        with self._lock:
+            self._phases = scheduled
+
+    def outage(self, duration: float) -> None:
+        """Be unreachable for `duration` seconds, starting now."""
+        self.script([Phase(duration, down=True)])
+
+    def behaviour(self) -> Phase:
+        """Return how requests are answered right now."""
+        now = time.monotonic()
+        with self._lock:
+            while self._phases and self._phases[0][0] <= now:
+                self._phases.pop(0)
+            if self._phases:
+                return self._phases[0][1]
+        return Phase(0.0, self.latency_ms, self.error_rate, self.down)
+
+    def wait_for_hits(self, count: int, timeout: float = 10.0) -> bool:
+        """Wait until `count` hits are received, returns False on timeout."""
+        deadline = time.monotonic() + timeout
+        while len(self.received) < count:
+            if time.monotonic() > deadline:
+                return False
+            time.sleep(0.001)
+        return True
+
+    def reset(self) -> None:
+        """Forget the received hits and counts."""
+        with self._lock:
+            self.received = []
+            self.requests = self.bulk_requests = self.errors = 0
+
+    def start(self) -> "FakeMatomo":
+        self._thread = threading.Thread(
+            target=self._server.serve_forever,
+            kwargs={"poll_interval": 0.05},
+            name="flask_matomo2-fake-matomo",
+            daemon=True,
+        )
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        if self._thread is not None:
+            self._server.shutdown()
+            self._thread = None
+        self._server.server_close()
+
+    def __enter__(self) -> "FakeMatomo":
+        return self.start()
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+    def _answer(self, records: typing.List[str], *, bulk: bool) -> typing.Tuple[int, bytes]:
+        """Record the valid hits of a request, returns the status code and body."""
+        behaviour = self.behaviour()
+        if behaviour.latency_ms:
+            time.sleep(behaviour.latency_ms / 1000)
+        failed = behaviour.error_rate > 0 and self._random.random() < behaviour.error_rate
+        now = time.perf_counter()
+        invalid_indices = []
+        with self._lock:
+            self.requests += 1
+            if bulk:
+                self.bulk_requests += 1
+            if failed:
+                self.errors += 1
+                return self.error_status, b'{"status":"error"}'
+            for index, record in enumerate(records):
+                hit = dict(urllib.parse.parse_qsl(record.lstrip("?")))
+                if "idsite" in hit:
+                    self.received.append((now, hit))
+                else:
+                    invalid_indices.append(index)
+        if not bulk and invalid_indices:
+            return 400, b'{"status":"error","message":"idsite is missing"}'
+        result = {
+            "status": "success",
+            "tracked": len(records) - len(invalid_indices),
+            "invalid": len(invalid_indices),
+            "invalid_indices": invalid_indices,
+        }
+        return 200, json.dumps(result).encode()
+
+
+def _handler(fake: FakeMatomo) -> typing.Type[http.server.BaseHTTPRequestHandler]:
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # answer without waiting for the client's delayed ACK
+        disable_nagle_algorithm = True
+
+        def do_GET(self) -> None:
+            self._track([urllib.parse.urlsplit(self.path).query], bulk=False)
+
+        def do_POST(self) -> None:
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode()
+            if self.headers.get("Content-Type", "").startswith("application/json"):
+                self._track(json.loads(body).get("requests", []), bulk=True)
+            else:
+                self._track([body], bulk=False)
+
+        def _track(self, records: typing.List[str], *, bulk: bool) -> None:
+            if fake.behaviour().down:
+                self.close_connection = True
+                return
+            status_code, body = fake._answer(records, bulk=bulk)
+            self.send_response(status_code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format: str, *args: typing.Any) -> None:  # noqa: A002
+            logger.debug("FakeMatomo: " + format, *args)
+
+    return Handler
+
+
+def main(argv: typing.Optional[typing.List[str]] = None) -> None:
+    """Serve a `FakeMatomo` until interrupted."""
+    parser = argparse.ArgumentParser(description="Serve a fake matomo.php on localhost.")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    args = parser.parse_args(argv)
+    fake = FakeMatomo(latency_ms=args.latency_ms, error_rate=args.error_rate, port=args.port)
+    print(f"serving {fake.url}")  # noqa: T201
+    try:
+        fake._server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        fake.stop()
+        print(f"received {len(fake.received)} hits in {fake.requests} requests")  # noqa: T201
+
+
+if __name__ == "__main__":
+    main()
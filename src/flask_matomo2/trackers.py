@@ -1,23 +1,44 @@
+import asyncio
+import functools
 import time
 import typing
 
+import flask
+
+from flask_matomo2.state import TrackingState
+
+F = typing.TypeVar("F", bound=typing.Callable[..., typing.Any])
+
+
+def _tracked_state() -> typing.Optional[TrackingState]:
+    """Return the tracking state of the current request, None if it isn't tracked."""
+    if not flask.has_request_context():
+        return None
+    state = flask.g.get("flask_matomo2")
+    if state is None or not state.tracking:
+        return None
+    return state
+
 
 class PerfMsTracker:
     """
     Measure time between enter and exit and records it in state.
 
+    Without `scope` the time is recorded in the tracking state of the current request, if
+    it is tracked.
+
     >>> scope = {"tracking_data": {}}
     >>> with PerfMsTracker(scope, key="pf_srv"):
     ...     _a = 2 + 2 # do computation
     >>> assert "pf_srv" in scope["tracking_data"]
     """
 
-    def __init__(self, scope: typing.MutableMapping[str, typing.Any], key: str) -> None:
+    def __init__(
+        self,
+        scope: typing.Optional[typing.MutableMapping[str, typing.Any]] = None,
+        key: str = "pf_srv",
+    ) -> None:
         self.start_ns = 0.0
-        # if "state" not in scope:
-        # scope["state"] = {}
-        # if "flask_matomo2" not in scope:
-        #     scope["flask_matomo2"] = {}
         self.scope = scope
         self.key = key
 
@@ -34,5 +55,100 @@ class PerfMsTracker:
         self._record_time(self.key, time.perf_counter_ns())
 
     def _record_time(self, key: str, end_ns: float) -> None:
-        elapsed_time_ms = (end_ns - self.start_ns) / 1000.0
-        self.scope["tracking_data"][key] = elapsed_time_ms
+        scope = self.scope if self.scope is not None else _tracked_state()
+        if scope is None:
+            return
+        elapsed_time_ms = (end_ns - self.start_ns) / 1_000_000
+        scope["tracking_data"][key] = elapsed_time_ms
+
+
+class Span:
+    """Measure a part of the current request, as a context manager or a decorator.
+
+    The milliseconds spent in the span are added to `key` of the hit, e.g. a `pf_*` field
+    like "pf_srv" or a custom dimension like "dimension3". Without `key` they are added to
+    the custom variable "<name>_ms", where the name of a nested span is prefixed with the
+    names of the spans around it, e.g. "db.query_ms". A span that is entered several times
+    in a request, e.g. in a loop, records the total time.
+
+    Nothing is measured if there is no current request or it isn't tracked, e.g. because
+    it is ignored or sampled out.
+
+    >>> app = flask.Flask(__name__)
+    >>> with app.test_request_context():
+    ...     flask.g.flask_matomo2 = TrackingState(start_ns=0, tracking_data={"cvar": {}})
+    ...     with Span("db"):
+    ...         with Span("query"):
+    ...             pass
+    ...     sorted(flask.g.flask_matomo2.tracking_data["cvar"])
+    ['db.query_ms', 'db_ms']
+
+    Parameters
+    ----------
+    name : str
+        name of the span
+    key : Optional[str]
+        key of the hit to record the milliseconds in. Default: None (a custom variable)
+    """
+
+    __slots__ = ("_start_ns", "_state", "key", "name")
+
+    def __init__(self, name: str, *, key: typing.Optional[str] = None) -> None:
+        self.name = name
+        self.key = key
+        self._state: typing.Optional[TrackingState] = None
+        self._start_ns = 0
+
+    def __enter__(self) -> "Span":
+        state = _tracked_state()
+        if state is None:
+            return self
+        self._state = state
+        if state.spans is None:
+            state.spans = []
+        state.spans.append(self.name)
+        self._start_ns = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb) -> None:
+        state = self._state
+        if state is None:
+            return
+        elapsed_ms = (time.perf_counter_ns() - self._start_ns) / 1_000_000
+        self._state = None
+        # set by __enter__
+        spans: typing.List[str] = state.spans  # type: ignore[assignment]
+        if self.key is not None:
+            target = state.tracking_data
+            key = self.key
+        else:
+            target = state.tracking_data.setdefault("cvar", {})
+            key = ".".join(spans) + "_ms"
+        spans.pop()
+        target[key] = target.get(key, 0.0) + elapsed_ms
+
+    async def __aenter__(self) -> "Span":
+        return self.__enter__()
+
+    async def __aexit__(self, exc_type, exc_value, exc_tb) -> None:
+        self.__exit__(exc_type, exc_value, exc_tb)
+
+    def __call__(self, func: F) -> F:
+        """Measure every call of `func`, with a new span per call."""
+        name, key = self.name, self.key
+
+        if asyncio.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with Span(name, key=key):
+                    return await func(*args, **kwargs)
+
+            return typing.cast(F, async_wrapper)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with Span(name, key=key):
+                return func(*args, **kwargs)
+
+        return typing.cast(F, wrapper)
@@ -0,0 +1,168 @@
+import abc
+import threading
+import typing
+
+if typing.TYPE_CHECKING:  # pragma: no cover
+    from flask_matomo2.collector import CollectorClient
+    from flask_matomo2.core import Matomo
+    from flask_matomo2.dispatchers import AsyncDispatcher, BackgroundDispatcher
+    from flask_matomo2.encoding import HitEncoder
+    from flask_matomo2.hitlog import HitLog
+    from flask_matomo2.spool import Spool
+
+
+class Transport(abc.ABC):
+    """How the hits of a `Matomo` extension are delivered, see `transport` of `Matomo`.
+
+    Subclasses implement `send` and override the other methods as needed. A transport
+    handles its own errors, hits that can't be delivered are spooled or dropped.
+    """
+
+    @abc.abstractmethod
+    def send(self, hit: typing.Dict) -> None:
+        """Deliver one hit."""
+
+    def send_batch(self, hits: typing.List[typing.Dict]) -> None:
+        """Deliver several hits, by default one at a time."""
+        for hit in hits:
+            self.send(hit)
+
+    def flush(self) -> None:  # noqa: B027
+        """Deliver the hits that are buffered or queued."""
+
+    def close(self, timeout: typing.Optional[float] = None) -> None:
+        """Deliver the buffered hits and release the resources of the transport.
+
+        Parameters
+        ----------
+        timeout : Optional[float]
+            seconds to wait for queued hits to be delivered. Default: None (wait forever)
+        """
+        self.flush()
+
+    def after_fork(self) -> None:  # noqa: B027
+        """Reset the transport in a forked child process."""
+
+
+class HttpTransport(Transport):
+    """Call Matomo from the calling thread, `send_mode="sync"`.
+
+    Uses the client, retries, circuit breaker, rate limiter and spool of `matomo`.
+    """
+
+    def __init__(self, matomo: "Matomo") -> None:
+        self.matomo = matomo
+
+    def send(self, hit: typing.Dict) -> None:
+        self.matomo.track(tracking_data=hit)
+
+    def send_batch(self, hits: typing.List[typing.Dict]) -> None:
+        self.matomo.track_bulk(tracking_data=hits)
+
+
+class DispatcherTransport(Transport):
+    """Queue hits for a dispatcher thread, `send_mode="background"` and `send_mode="async"`."""
+
+    def __init__(
+        self, dispatcher: typing.Union["BackgroundDispatcher", "AsyncDispatcher"]
+    ) -> None:
+        self.dispatcher = dispatcher
+
+    def send(self, hit: typing.Dict) -> None:
+        self.dispatcher.submit(hit)
+
+    def flush(self) -> None:
+        if self.dispatcher.is_running:
+            self.dispatcher.join()
+
+    def close(self, timeout: typing.Optional[float] = None) -> None:
+        self.dispatcher.stop(timeout)
+
+    def after_fork(self) -> None:
+        self.dispatcher.after_fork()
+
+
+class CollectorTransport(Transport):
+    """Send hits to the collector process, `send_mode="collector"`.
+
+    Hits are spooled in `spool` if the collector can't be reached, or else counted in
+    `dropped`. The spool segment is closed when the collector is reached again, so that the
+    collector can drain it, it skips segments that are still written to.
+    """
+
+    def __init__(
+        self,
+        client: "CollectorClient",
+        encoder: "HitEncoder",
+        *,
+        spool: typing.Optional["Spool"] = None,
+    ) -> None:
+        self.client = client
+        self.encoder = encoder
+        self.spool = spool
+        self.dropped = 0
+        self._spooled = False
+
+    def send(self, hit: typing.Dict) -> None:
+        record = self.encoder.encode(hit)
+        if self.client.send(record):
+            if self._spooled:
+                self._spooled = False
+                self.spool.close()  # type: ignore[union-attr]
+        elif self.spool is not None:
+            self.spool.append(record)
+            self._spooled = True
+        else:
+            self.dropped += 1
+
+    def close(self, timeout: typing.Optional[float] = None) -> None:
+        self.client.close()
+
+    def after_fork(self) -> None:
+        self.client.after_fork()
+        self.dropped = 0
+        self._spooled = False
+
+
+class FileTransport(Transport):
+    """Append hits to NDJSON files instead of calling Matomo, `send_mode="file"`."""
+
+    def __init__(self, hit_log: "HitLog") -> None:
+        self.hit_log = hit_log
+
+    def send(self, hit: typing.Dict) -> None:
+        self.hit_log.append(hit)
+
+    def flush(self) -> None:
+        self.hit_log.flush()
+
+    def close(self, timeout: typing.Optional[float] = None) -> None:
+        self.hit_log.close()
+
+    def after_fork(self) -> None:
+        self.hit_log.after_fork()
+
+
+class InMemoryTransport(Transport):
+    """Keep the hits in `hits`, for tests and for benchmarking the extension itself.
+
+    >>> transport = InMemoryTransport()
+    >>> transport.send_batch([{"idsite": "1", "rand": 1}, {"idsite": "1", "rand": 2}])
+    >>> [hit["rand"] for hit in transport.hits]
+    [1, 2]
+    """
+
+    def __init__(self) -> None:
+        self.hits: typing.List[typing.Dict] = []
+        self._lock = threading.Lock()
+
+    def send(self, hit: typing.Dict) -> None:
+        with self._lock:
+            self.hits.append(hit)
+
+    def send_batch(self, hits: typing.List[typing.Dict]) -> None:
+        with self._lock:
+            self.hits.extend(hits)
+
+    def after_fork(self) -> None:
+        self._lock = threading.Lock()
@@ -0,0 +1,54 @@
+import threading
+
+from flask_matomo2.aggregate import Aggregator, RouteStats
+
+
+def test_route_stats_summary():
+    stats = RouteStats()
+    for gt_ms in range(1, 101):
+        stats.record(200 if gt_ms <= 90 else 404, float(gt_ms))
+
+    summary = stats.summary()
+
+    assert summary["hits"] == 100
+    assert summary["status_2xx"] == 90
+    assert summary["status_4xx"] == 10
+    assert summary["gt_ms_avg"] == 50.5
+    assert summary["gt_ms_p50"] == 50
+    assert summary["gt_ms_p90"] == 100
+    assert summary["gt_ms_max"] == 100.0
+
+
+def test_route_stats_percentile_above_last_bucket_is_max():
+    stats = RouteStats()
+    stats.record(200, 25_000.0)
+
+    assert stats.percentile(99) == 25_000.0
+
+
+def test_aggregator_flushes_every_interval():
+    flushed = threading.Event()
+    sent = []
+
+    def send(route, stats):
+        sent.append((route, stats.count))
+        flushed.set()
+
+    aggregator = Aggregator(send, interval=0.05)
+    aggregator.record("/poll", 200, 1.0)
+    aggregator.record("/poll", 200, 2.0)
+
+    assert flushed.wait(1.0)
+    aggregator.stop()
+    assert sent == [("/poll", 2)]
+
+
+def test_aggregator_after_fork_drops_stats_of_parent():
+    sent = []
+    aggregator = Aggregator(lambda route, stats: sent.append(route))
+    aggregator.record("/poll", 200, 1.0)
+
+    aggregator.after_fork()
+    aggregator.stop()
+
+    assert sent == []
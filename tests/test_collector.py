@@ -0,0 +1,159 @@
+import json
+from unittest import mock
+
+import httpx
+import pytest
+from flask import Flask
+
+from flask_matomo2 import Matomo
+from flask_matomo2.collector import Collector, CollectorClient
+
+
+@pytest.fixture(name="socket_path")
+def fixture_socket_path(tmp_path):
+    return str(tmp_path / "matomo.sock")
+
+
+def test_collector_batches_hits_from_many_clients(socket_path):
+    batches = []
+    collector = Collector(
+        socket_path, lambda records: batches.append(records) or True, max_batch_size=10
+    )
+    collector.start()
+    clients = [CollectorClient(socket_path) for _ in range(4)]
+    for rand in range(20):
+        assert clients[rand % 4].send(f"idsite=1&rand={rand}".encode())
+
+    collector.stop()
+
+    assert collector.received == 20
+    assert sorted(record for batch in batches for record in batch) == sorted(
+        f"idsite=1&rand={rand}".encode() for rand in range(20)
+    )
+    assert all(len(batch) <= 10 for batch in batches)
+
+
+def test_collector_client_fails_without_collector(socket_path):
+    client = CollectorClient(socket_path)
+
+    assert not client.send(b"idsite=1")
+
+
+def test_collector_send_mode_sends_hit_to_collector(socket_path):
+    received = []
+    collector = Collector(socket_path, lambda records: received.extend(records) or True)
+    collector.start()
+    app = Flask(__name__)
+    matomo = Matomo(
+        app,
+        matomo_url="http://trackingserver",
+        id_site=1,
+        token_auth="FAKE_TOKEN",  # noqa: S106
+        send_mode="collector",
+        collector_socket=socket_path,
+    )
+
+    @app.route("/foo")
+    def foo():
+        return "foo"
+
+    with httpx.Client(
+        transport=httpx.WSGITransport(app=app), base_url="http://testserver"
+    ) as client:
+        client.get("/foo")
+    collector.stop()
+
+    assert len(received) == 1
+    assert b"url=http%3A%2F%2Ftestserver%2Ffoo" in received[0]
+    # the collector adds token_auth to the bulk request
+    assert b"token_auth" not in received[0]
+    assert matomo.dropped_hits == 0
+
+
+def test_collector_send_mode_spools_hit_without_collector(socket_path, tmp_path):
+    matomo = Matomo(
+        matomo_url="http://trackingserver",
+        id_site=1,
+        send_mode="collector",
+        collector_socket=socket_path,
+        spool_dir=tmp_path / "spool",
+    )
+    app = Flask(__name__)
+    matomo.init_app(app)
+
+    @app.route("/foo")
+    def foo():
+        return "foo"
+
+    app.test_client().get("/foo")
+
+    assert matomo.dropped_hits == 0
+    assert matomo.spool is not None
+    assert matomo.spool.pending
+
+
+def test_collector_send_mode_drops_hit_without_collector_and_spool(socket_path):
+    matomo = Matomo(
+        matomo_url="http://trackingserver",
+        id_site=1,
+        send_mode="collector",
+        collector_socket=socket_path,
+    )
+
+    matomo.transport.send({"idsite": "1"})
+
+    assert matomo.dropped_hits == 1
+
+
+def test_collector_drains_hits_spooled_by_worker_while_it_was_down(socket_path, tmp_path):
+    spool_dir = tmp_path / "spool"
+    worker = Matomo(
+        matomo_url="http://trackingserver",
+        id_site=1,
+        send_mode="collector",
+        collector_socket=socket_path,
+        spool_dir=spool_dir,
+    )
+    for rand in range(3):
+        worker.transport.send({"idsite": "1", "rand": rand})
+
+    matomo_client = mock.Mock(spec=httpx.Client)
+    matomo_client.post = mock.Mock(return_value=httpx.Response(200, text="{}"))
+    forwarder = Matomo(
+        client=matomo_client,
+        matomo_url="http://trackingserver",
+        spool_dir=spool_dir,
+    )
+    forwarder.spool.rescan_interval = 0.0  # type: ignore[union-attr]
+    collector = Collector(socket_path, forwarder.track_records, max_batch_delay=0.01)
+    collector.start()
+    worker.transport.send({"idsite": "1", "rand": 3})
+    worker.transport.send({"idsite": "1", "rand": 4})
+    collector.stop()
+
+    sent = [
+        record
+        for call in matomo_client.post.call_args_list
+        for record in json.loads(call.kwargs["content"])["requests"]
+    ]
+    assert sorted(sent) == [f"?idsite=1&rand={rand}" for rand in range(5)]
+    assert forwarder.spool.segments() == []  # type: ignore[union-attr]
+
+
+def test_collector_send_mode_requires_collector_socket():
+    with pytest.raises(ValueError, match="collector_socket"):
+        Matomo(matomo_url="http://trackingserver", id_site=1, send_mode="collector")
+
+
+def test_track_records_sends_one_bulk_request():
+    matomo_client = mock.Mock(spec=httpx.Client)
+    matomo_client.post = mock.Mock(return_value=httpx.Response(200, text="{}"))
+    matomo = Matomo(client=matomo_client, matomo_url="http://trackingserver", token_auth="TOKEN")  # noqa: S106
+
+    matomo.track_records([b"idsite=1&rand=0", b"idsite=1&rand=1"])
+
+    matomo_client.post.assert_called_once()
+    assert json.loads(matomo_client.post.call_args.kwargs["content"]) == {
+        "requests": ["?idsite=1&rand=0", "?idsite=1&rand=1"],
+        "token_auth": "TOKEN",
+    }
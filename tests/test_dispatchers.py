@@ -0,0 +1,216 @@
+import asyncio
+import threading
+import time
+
+from flask_matomo2.dispatchers import AsyncDispatcher, BackgroundDispatcher
+from flask_matomo2.queues import TrackingQueue
+
+
+def test_background_dispatcher_sends_from_other_thread():
+    sent = []
+
+    def send(tracking_data):
+        sent.append((threading.current_thread().name, tracking_data))
+
+    dispatcher = BackgroundDispatcher(send)
+    dispatcher.submit({"idsite": "1"})
+    dispatcher.join()
+
+    assert sent == [("flask_matomo2-dispatcher", {"idsite": "1"})]
+    dispatcher.stop()
+
+
+def test_background_dispatcher_submit_doesnt_wait_for_send():
+    release = threading.Event()
+    dispatcher = BackgroundDispatcher(lambda _tracking_data: release.wait())
+
+    start = time.perf_counter()
+    dispatcher.submit({"idsite": "1"})
+    assert time.perf_counter() - start < 0.5
+
+    release.set()
+    dispatcher.stop()
+
+
+def test_background_dispatcher_stop_drains_queue():
+    sent = []
+    dispatcher = BackgroundDispatcher(sent.append)
+    for i in range(10):
+        dispatcher.submit({"rand": i})
+
+    dispatcher.stop()
+
+    assert not dispatcher.is_running
+    assert [data["rand"] for data in sent] == list(range(10))
+
+
+def test_background_dispatcher_survives_failing_send():
+    sent = []
+
+    def send(tracking_data):
+        if tracking_data["rand"] == 0:
+            raise RuntimeError("boom")
+        sent.append(tracking_data)
+
+    dispatcher = BackgroundDispatcher(send)
+    dispatcher.submit({"rand": 0})
+    dispatcher.submit({"rand": 1})
+    dispatcher.stop()
+
+    assert sent == [{"rand": 1}]
+
+
+def test_background_dispatcher_can_be_restarted():
+    sent = []
+    dispatcher = BackgroundDispatcher(sent.append)
+    dispatcher.submit({"rand": 0})
+    dispatcher.stop()
+    dispatcher.submit({"rand": 1})
+    dispatcher.stop()
+
+    assert sent == [{"rand": 0}, {"rand": 1}]
+
+
+def test_background_dispatcher_hands_unsent_hits_to_on_drop_after_stop_timeout():
+    release = threading.Event()
+    dropped = []
+    dispatcher = BackgroundDispatcher(
+        lambda _tracking_data: release.wait(),
+        tracking_queue=TrackingQueue(on_drop=dropped.append),
+    )
+    for i in range(3):
+        dispatcher.submit({"rand": i})
+
+    dispatcher.stop(timeout=0.1)
+    release.set()
+
+    assert not dispatcher.is_running
+    # the first hit is being sent when the dispatcher is stopped
+    assert dropped == [{"rand": 1}, {"rand": 2}]
+
+
+def test_background_dispatcher_after_fork_resets_queue():
+    sent = []
+    dispatcher = BackgroundDispatcher(sent.append)
+    # hits queued by the parent process
+    dispatcher.queue.put({"rand": 0})
+    dispatcher.queue.put({"rand": 1})
+
+    dispatcher.after_fork()
+
+    assert not dispatcher.is_running
+    assert len(dispatcher.queue) == 0
+    dispatcher.submit({"rand": 2})
+    dispatcher.stop()
+    assert sent == [{"rand": 2}]
+
+
+def test_background_dispatcher_flushes_when_batch_is_full():
+    batches = []
+    dispatcher = BackgroundDispatcher(
+        lambda _tracking_data: None,
+        send_batch=batches.append,
+        max_batch_size=3,
+        max_batch_delay=60.0,
+    )
+    for i in range(6):
+        dispatcher.submit({"rand": i})
+    dispatcher.join()
+    dispatcher.stop()
+
+    assert [[data["rand"] for data in batch] for batch in batches] == [[0, 1, 2], [3, 4, 5]]
+
+
+def test_background_dispatcher_flushes_after_max_delay():
+    batches = []
+    dispatcher = BackgroundDispatcher(
+        lambda _tracking_data: None,
+        send_batch=batches.append,
+        max_batch_size=100,
+        max_batch_delay=0.05,
+    )
+    dispatcher.submit({"rand": 0})
+    dispatcher.submit({"rand": 1})
+    dispatcher.join()
+
+    assert batches == [[{"rand": 0}, {"rand": 1}]]
+    dispatcher.stop()
+
+
+def test_background_dispatcher_flushes_partial_batch_on_stop():
+    batches = []
+    dispatcher = BackgroundDispatcher(
+        lambda _tracking_data: None,
+        send_batch=batches.append,
+        max_batch_size=100,
+        max_batch_delay=60.0,
+    )
+    dispatcher.submit({"rand": 0})
+    dispatcher.submit({"rand": 1})
+    dispatcher.stop()
+
+    assert batches == [[{"rand": 0}, {"rand": 1}]]
+
+
+def test_async_dispatcher_sends_from_event_loop():
+    sent = []
+
+    async def send(tracking_data):
+        await asyncio.sleep(0)
+        sent.append(tracking_data)
+
+    dispatcher = AsyncDispatcher(send)
+    dispatcher.submit({"rand": 0})
+    dispatcher.submit({"rand": 1})
+    dispatcher.join()
+
+    assert sorted(data["rand"] for data in sent) == [0, 1]
+    dispatcher.stop()
+    assert not dispatcher.is_running
+
+
+def test_async_dispatcher_sends_batches_concurrently():
+    in_flight = 0
+    max_in_flight = 0
+    batches = []
+
+    async def send_batch(batch):
+        nonlocal in_flight, max_in_flight
+        in_flight += 1
+        max_in_flight = max(max_in_flight, in_flight)
+        await asyncio.sleep(0.05)
+        batches.append(batch)
+        in_flight -= 1
+
+    async def send(_tracking_data):
+        raise AssertionError("hits should be sent in batches")
+
+    dispatcher = AsyncDispatcher(
+        send, send_batch=send_batch, max_batch_size=2, max_batch_delay=60.0, max_concurrency=3
+    )
+    for i in range(6):
+        dispatcher.submit({"rand": i})
+    dispatcher.join()
+    dispatcher.stop()
+
+    assert sorted(len(batch) for batch in batches) == [2, 2, 2]
+    assert max_in_flight > 1
+
+
+def test_async_dispatcher_flushes_partial_batch_on_stop():
+    batches = []
+
+    async def send_batch(batch):
+        batches.append(batch)
+
+    async def send(tracking_data):
+        batches.append([tracking_data])
+
+    dispatcher = AsyncDispatcher(
+        send, send_batch=send_batch, max_batch_size=10, max_batch_delay=60.0
+    )
+    dispatcher.submit({"rand": 0})
+    dispatcher.submit({"rand": 1})
+    dispatcher.stop()
+
+    assert [data["rand"] for batch in batches for data in batch] == [0, 1]
@@ -0,0 +1,69 @@
+import json
+import urllib.parse
+
+import pytest
+
+from flask_matomo2.encoding import HitEncoder
+
+
+class UserAgent:
+    def __str__(self) -> str:
+        return "Mozilla/5.0 (X11; Linux x86_64) Åäö+&="
+
+
+def reference_encoding(tracking_data: dict) -> bytes:
+    data = {key: value for key, value in tracking_data.items() if key != "token_auth"}
+    if isinstance(data.get("cvar"), dict):
+        data["cvar"] = json.dumps(data["cvar"])
+    return urllib.parse.urlencode(data).encode("ascii")
+
+
+@pytest.mark.parametrize(
+    "tracking_data",
+    [
+        {"idsite": "1", "rec": "1", "action_name": "/foo/<int:id>", "rand": 4711},
+        {"url": "http://testserver/söme/path?a=1&b=2", "ua": UserAgent(), "gt_ms": 1.5e-07},
+        {"cvar": {"http_status_code": None, "http_method": "GET"}, "token_auth": "TOKEN"},
+        {"cvar": {"http_status_code": 500, "nested": {"list": [1, "ä"]}, "flag": True}},
+        {"cvar": {}, "e_a": "Playing", "negative": -1},
+        {"cvar": '{"http_status_code": 200}'},
+    ],
+)
+def test_hit_encoder_matches_urlencode(tracking_data: dict):
+    encoder = HitEncoder()
+
+    # encode twice to also use the cached encodings
+    assert encoder.encode(tracking_data) == reference_encoding(tracking_data)
+    assert encoder.encode(tracking_data) == reference_encoding(tracking_data)
+
+
+def test_hit_encoder_value_cache_is_bounded():
+    encoder = HitEncoder(max_cached_values=2)
+
+    for i in range(10):
+        assert (
+            encoder.encode({"action_name": f"/route/{i}"})
+            == f"action_name=%2Froute%2F{i}".encode()
+        )
+
+    assert len(encoder._values) <= 2
+
+
+def test_encode_bulk_is_valid_json():
+    encoder = HitEncoder()
+    records = [
+        encoder.encode({"idsite": "1", "url": f'http://testserver/"{i}"'}) for i in range(3)
+    ]
+
+    payload = json.loads(encoder.encode_bulk(records, token_auth='to"ken'))  # noqa: S106
+
+    assert payload == {
+        "requests": [f"?{record.decode()}" for record in records],
+        "token_auth": 'to"ken',
+    }
+
+
+def test_encode_bulk_without_token_auth():
+    encoder = HitEncoder()
+
+    assert encoder.encode_bulk([b"idsite=1"]) == b'{"requests":["?idsite=1"]}'
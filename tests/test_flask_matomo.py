@@ -1,5 +1,8 @@
+import asyncio
 import copy
 import json
+import os
+import threading
 import time
 import typing
 from dataclasses import dataclass
@@ -14,7 +17,9 @@ from syrupy.matchers import path_type
 from werkzeug import exceptions as werkzeug_exc
 
 from flask_matomo2 import Matomo
+from flask_matomo2.testing import FakeMatomo
 from flask_matomo2.trackers import PerfMsTracker
+from flask_matomo2.transports import InMemoryTransport
 
 
 @dataclass
@@ -275,3 +280,1002 @@ def test_matomo_client_gets_called_on_get_bar(
 
     matomo_client.post.assert_called()
     assert matomo_client.post.call_args.kwargs["data"] == snapshot_json(matcher=make_matcher())
+
+
+def test_background_send_mode_tracks_from_dispatcher(matomo_client):
+    app = Flask(__name__)
+    matomo = Matomo(
+        app,
+        client=matomo_client,
+        matomo_url="http://trackingserver",
+        id_site=1,
+        send_mode="background",
+    )
+
+    @app.route("/foo")
+    def foo():
+        return "foo"
+
+    with httpx.Client(
+        transport=httpx.WSGITransport(app=app), base_url="http://testserver"
+    ) as client:
+        response = client.get("/foo")
+    assert response.status_code == 200
+
+    matomo.close()
+
+    matomo_client.post.assert_called_once()
+    assert matomo_client.post.call_args.kwargs["data"]["url"] == "http://testserver/foo"
+
+
+def test_unknown_send_mode_raises():
+    with pytest.raises(ValueError):
+        Matomo(matomo_url="http://trackingserver", send_mode="carrier-pigeon")
+
+
+def test_track_bulk_sends_one_bulk_request(matomo_client, settings):
+    matomo = Matomo(
+        client=matomo_client,
+        matomo_url="http://trackingserver",
+        id_site=1,
+        token_auth=settings["token_auth"],
+    )
+
+    matomo.track_bulk(
+        tracking_data=[
+            {"idsite": "1", "url": "http://testserver/foo", "token_auth": "FAKE_TOKEN"},
+            {"idsite": "1", "url": "http://testserver/bar", "cvar": {"http_status_code": 200}},
+        ]
+    )
+
+    matomo_client.post.assert_called_once()
+    assert json.loads(matomo_client.post.call_args.kwargs["content"]) == {
+        "requests": [
+            "?idsite=1&url=http%3A%2F%2Ftestserver%2Ffoo",
+            "?idsite=1&url=http%3A%2F%2Ftestserver%2Fbar&cvar=%7B%22http_status_code%22%3A+200%7D",
+        ],
+        "token_auth": "FAKE_TOKEN",
+    }
+
+
+def test_track_bulk_logs_invalid_hits(matomo_client, caplog):
+    matomo_client.post = mock.Mock(
+        return_value=Response(
+            status_code=200,
+            text='{"status": "success", "tracked": 1, "invalid": 1, "invalid_indices": [1]}',
+        )
+    )
+    matomo = Matomo(client=matomo_client, matomo_url="http://trackingserver", id_site=1)
+
+    matomo.track_bulk(tracking_data=[{"idsite": "1"}, {"idsite": "-1"}])
+
+    assert "Tracking call failed (index=1)" in caplog.text
+
+
+def test_max_batch_size_requires_background_send_mode():
+    with pytest.raises(ValueError):
+        Matomo(matomo_url="http://trackingserver", max_batch_size=10)
+
+
+def test_failed_hits_are_spooled_and_drained_when_matomo_recovers(
+    matomo_client, settings, tmp_path
+):
+    matomo = Matomo(
+        client=matomo_client,
+        matomo_url="http://trackingserver",
+        id_site=1,
+        token_auth=settings["token_auth"],
+        spool_dir=tmp_path,
+    )
+    matomo_client.post = mock.Mock(side_effect=httpx.ConnectError("down"))
+    matomo.track(tracking_data={"idsite": "1", "rand": 1, "token_auth": "FAKE_TOKEN"})
+    matomo.track(tracking_data={"idsite": "1", "rand": 2, "token_auth": "FAKE_TOKEN"})
+
+    assert matomo.spool is not None
+    assert matomo.spool.pending
+
+    matomo_client.post = mock.Mock(return_value=Response(status_code=204))
+    matomo.track(tracking_data={"idsite": "1", "rand": 3, "token_auth": "FAKE_TOKEN"})
+
+    assert matomo_client.post.call_count == 2
+    assert json.loads(matomo_client.post.call_args.kwargs["content"]) == {
+        "requests": ["?idsite=1&rand=1", "?idsite=1&rand=2"],
+        "token_auth": "FAKE_TOKEN",
+    }
+    assert not matomo.spool.pending
+
+
+def test_hits_rejected_by_matomo_are_not_spooled(matomo_client, tmp_path):
+    matomo_client.post = mock.Mock(return_value=Response(status_code=400))
+    matomo = Matomo(
+        client=matomo_client, matomo_url="http://trackingserver", id_site=1, spool_dir=tmp_path
+    )
+
+    matomo.track(tracking_data={"idsite": "1"})
+
+    assert matomo.spool is not None
+    assert not matomo.spool.pending
+
+
+def test_bulk_hits_rejected_by_matomo_are_not_spooled_and_keep_the_spool(
+    matomo_client, tmp_path
+):
+    matomo = Matomo(
+        client=matomo_client, matomo_url="http://trackingserver", id_site=1, spool_dir=tmp_path
+    )
+    matomo_client.post = mock.Mock(return_value=Response(status_code=503))
+    matomo.track_records([b"idsite=1&rand=%d" % rand for rand in range(5)])
+    assert matomo.spool is not None
+    assert matomo.spool.pending
+
+    matomo_client.post = mock.Mock(return_value=Response(status_code=400))
+    matomo.track_records([b"idsite=1&rand=5"])
+    assert matomo.drain_spool() == 0
+
+    assert matomo_client.post.call_count == 2
+    received = []
+    matomo.spool.drain(lambda records: received.extend(records) or True)
+    assert len(received) == 5
+
+
+def test_tracking_call_is_retried_on_server_error(matomo_client):
+    matomo_client.post = mock.Mock(
+        side_effect=[
+            Response(status_code=503),
+            httpx.ConnectError("down"),
+            Response(status_code=204),
+        ]
+    )
+    matomo = Matomo(
+        client=matomo_client,
+        matomo_url="http://trackingserver",
+        id_site=1,
+        max_retries=2,
+        retry_backoff=0.0,
+    )
+
+    matomo.track(tracking_data={"idsite": "1"})
+
+    assert matomo_client.post.call_count == 3
+
+
+def test_tracking_call_is_not_retried_on_client_error(matomo_client):
+    matomo_client.post = mock.Mock(return_value=Response(status_code=400))
+    matomo = Matomo(
+        client=matomo_client,
+        matomo_url="http://trackingserver",
+        id_site=1,
+        max_retries=2,
+        retry_backoff=0.0,
+    )
+
+    matomo.track(tracking_data={"idsite": "1"})
+
+    assert matomo_client.post.call_count == 1
+
+
+def test_open_circuit_breaker_spools_hits_without_calling_matomo(matomo_client, tmp_path):
+    matomo_client.post = mock.Mock(side_effect=httpx.ConnectError("down"))
+    matomo = Matomo(
+        client=matomo_client,
+        matomo_url="http://trackingserver",
+        id_site=1,
+        spool_dir=tmp_path,
+        circuit_breaker_threshold=2,
+    )
+
+    for rand in range(5):
+        matomo.track(tracking_data={"idsite": "1", "rand": rand})
+
+    assert matomo_client.post.call_count == 2
+    assert matomo.circuit_breaker is not None
+    assert matomo.circuit_breaker.state == "open"
+    assert matomo.spool is not None
+    received = []
+    matomo.spool.drain(lambda records: received.extend(records) or True)
+    assert len(received) == 5
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="requires os.fork")
+def test_forked_process_gets_own_client_and_dispatcher(matomo_client):
+    matomo = Matomo(
+        matomo_url="http://trackingserver",
+        id_site=1,
+        send_mode="background",
+    )
+    matomo.dispatcher.submit({"idsite": "1"})
+    parent_client = matomo.client
+
+    pid = os.fork()
+    if pid == 0:
+        ok = (
+            matomo.client is not parent_client
+            and not matomo.dispatcher.is_running
+            and len(matomo.dispatcher.queue) == 0
+        )
+        os._exit(0 if ok else 1)
+    _, status = os.waitpid(pid, 0)
+
+    assert os.waitstatus_to_exitcode(status) == 0
+    assert matomo.client is parent_client
+    matomo.close(timeout=0)
+
+
+def test_after_fork_keeps_client_given_by_user(matomo_client, caplog):
+    matomo = Matomo(client=matomo_client, matomo_url="http://trackingserver", id_site=1)
+
+    matomo.after_fork()
+
+    assert matomo.client is matomo_client
+    assert "shared with the parent process" in caplog.text
+
+
+def test_close_spools_hits_not_sent_before_timeout(matomo_client, tmp_path):
+    release = threading.Event()
+    matomo_client.post = mock.Mock(side_effect=lambda *args, **kwargs: release.wait())
+    matomo = Matomo(
+        client=matomo_client,
+        matomo_url="http://trackingserver",
+        id_site=1,
+        send_mode="background",
+        spool_dir=tmp_path,
+    )
+    for rand in range(3):
+        matomo.dispatcher.submit({"idsite": "1", "rand": rand})
+
+    matomo.close(timeout=0.1)
+    release.set()
+
+    assert matomo.spool is not None
+    received = []
+    matomo.spool.drain(lambda records: received.extend(records) or True)
+    assert received == [b"idsite=1&rand=1", b"idsite=1&rand=2"]
+
+
+def test_async_send_mode_tracks_with_async_client():
+    async_client = mock.Mock(spec=httpx.AsyncClient)
+    async_client.post = mock.AsyncMock(return_value=Response(status_code=204))
+    app = Flask(__name__)
+    matomo = Matomo(
+        app,
+        client=async_client,
+        matomo_url="http://trackingserver",
+        id_site=1,
+        send_mode="async",
+    )
+
+    @app.route("/foo")
+    def foo():
+        return "foo"
+
+    with httpx.Client(
+        transport=httpx.WSGITransport(app=app), base_url="http://testserver"
+    ) as client:
+        response = client.get("/foo")
+    assert response.status_code == 200
+
+    matomo.close()
+
+    async_client.post.assert_awaited_once()
+    assert async_client.post.call_args.kwargs["data"]["url"] == "http://testserver/foo"
+
+
+def test_async_send_mode_requires_async_client(matomo_client):
+    with pytest.raises(ValueError):
+        Matomo(matomo_url="http://trackingserver", client=matomo_client, send_mode="async")
+
+
+def test_atrack_bulk_sends_one_bulk_request():
+    async_client = mock.Mock(spec=httpx.AsyncClient)
+    async_client.post = mock.AsyncMock(return_value=Response(status_code=200))
+    matomo = Matomo(
+        client=async_client, matomo_url="http://trackingserver", id_site=1, send_mode="async"
+    )
+
+    asyncio.run(matomo.atrack_bulk(tracking_data=[{"idsite": "1"}, {"idsite": "1"}]))
+
+    async_client.post.assert_awaited_once()
+    assert json.loads(async_client.post.call_args.kwargs["content"]) == {
+        "requests": ["?idsite=1", "?idsite=1"]
+    }
+
+
+def test_async_send_mode_gets_new_client_when_dispatcher_restarts(caplog):
+    with FakeMatomo() as fake_matomo:
+        matomo = Matomo(matomo_url=fake_matomo.url, id_site=1, send_mode="async")
+        assert matomo.dispatcher is not None
+        matomo.transport.send({"idsite": "1", "rand": 1})
+        matomo.flush()
+        client = matomo.client
+        matomo.dispatcher.stop()
+
+        # e.g. the flush of the aggregated stats at exit
+        matomo.transport.send({"idsite": "1", "rand": 2})
+        matomo.close()
+
+        assert [hit["rand"] for hit in fake_matomo.hits] == ["1", "2"]
+    assert matomo.client is not client
+    assert client.is_closed
+    assert "Dispatching tracking data failed" not in caplog.text
+
+
+def test_activate_again_stops_previous_dispatcher_and_spool(matomo_client, tmp_path):
+    matomo = Matomo(
+        client=matomo_client,
+        matomo_url="http://trackingserver",
+        id_site=1,
+        send_mode="background",
+        spool_dir=tmp_path,
+    )
+    dispatcher, spool = matomo.dispatcher, matomo.spool
+    assert dispatcher is not None
+    assert spool is not None
+    matomo.transport.send({"idsite": "1"})
+
+    with mock.patch.object(spool, "close", wraps=spool.close) as close_spool:
+        matomo.activate(client=matomo_client, matomo_url="http://trackingserver", id_site=1)
+
+    assert not dispatcher.is_running
+    close_spool.assert_called_once()
+    assert matomo.dispatcher is None
+    assert matomo.spool is None
+    assert matomo_client.post.call_count == 1
+
+
+def test_ignore_after_first_request_invalidates_cached_decision(matomo_client):
+    app = Flask(__name__)
+    matomo = Matomo(app, client=matomo_client, matomo_url="http://trackingserver", id_site=1)
+
+    def late():
+        return "late"
+
+    app.add_url_rule("/late", view_func=late)
+
+    with httpx.Client(
+        transport=httpx.WSGITransport(app=app), base_url="http://testserver"
+    ) as client:
+        client.get("/late")
+        assert matomo_client.post.call_count == 1
+
+        matomo.ignore()(late)
+        client.get("/late")
+        assert matomo_client.post.call_count == 1
+
+
+def test_ignored_patterns_with_backreferences_keep_their_meaning(matomo_client):
+    app = Flask(__name__)
+    Matomo(
+        app,
+        client=matomo_client,
+        matomo_url="http://trackingserver",
+        id_site=1,
+        ignored_patterns=["/(a)", r"/(x)/\1"],
+    )
+
+    @app.route("/x/x")
+    def repeated():
+        return "ignored"
+
+    app.test_client().get("/x/x")
+
+    matomo_client.post.assert_not_called()
+
+
+def test_many_ignored_patterns_are_combined(matomo_client):
+    app = Flask(__name__)
+    Matomo(
+        app,
+        client=matomo_client,
+        matomo_url="http://trackingserver",
+        id_site=1,
+        ignored_patterns=[f"/ignored{i}/.*" for i in range(300)] + ["(?i)/CASE.*"],
+    )
+
+    @app.route("/ignored299/foo")
+    def ignored():
+        return "ignored"
+
+    @app.route("/case/foo")
+    def case():
+        return "ignored"
+
+    @app.route("/tracked")
+    def tracked():
+        return "tracked"
+
+    with httpx.Client(
+        transport=httpx.WSGITransport(app=app), base_url="http://testserver"
+    ) as client:
+        client.get("/ignored299/foo")
+        client.get("/case/foo")
+        client.get("/tracked")
+
+    matomo_client.post.assert_called_once()
+
+
+def test_user_agent_verdicts_are_cached(matomo_client):
+    app = Flask(__name__)
+    matomo = Matomo(
+        app,
+        client=matomo_client,
+        matomo_url="http://trackingserver",
+        id_site=1,
+        ignored_ua_patterns=["creepy-bot.*", ".*spider.*"],
+    )
+
+    @app.route("/foo")
+    def foo():
+        return "foo"
+
+    with httpx.Client(
+        transport=httpx.WSGITransport(app=app), base_url="http://testserver"
+    ) as client:
+        for _ in range(3):
+            client.get("/foo", headers={"user-agent": "creepy-bot-with-suffix"})
+            client.get("/foo", headers={"user-agent": "friendly-browser"})
+
+    cache_info = matomo.ua_cache_info()
+    assert (cache_info.hits, cache_info.misses) == (4, 2)
+    assert matomo_client.post.call_count == 3
+
+
+def test_ua_cache_info_is_none_without_ignored_ua_patterns():
+    assert Matomo(matomo_url="http://trackingserver").ua_cache_info() is None
+
+
+def test_ua_cache_size_0_disables_the_cache(matomo_client):
+    app = Flask(__name__)
+    matomo = Matomo(
+        app,
+        client=matomo_client,
+        matomo_url="http://trackingserver",
+        id_site=1,
+        ignored_ua_patterns=["creepy-bot.*"],
+        ua_cache_size=0,
+    )
+
+    @app.route("/foo")
+    def foo():
+        return "foo"
+
+    client = app.test_client()
+    client.get("/foo", headers={"user-agent": "creepy-bot"})
+    client.get("/foo", headers={"user-agent": "friendly-browser"})
+
+    assert matomo.ua_cache_info() is None
+    assert matomo_client.post.call_count == 1
+
+
+@pytest.mark.parametrize("ua_cache_size", [None, -1])
+def test_unbounded_or_negative_ua_cache_size_raises(ua_cache_size):
+    with pytest.raises(ValueError, match="ua_cache_size"):
+        Matomo(matomo_url="http://trackingserver", ua_cache_size=ua_cache_size)
+
+
+def test_details_after_first_request_updates_action_name(matomo_client):
+    app = Flask(__name__)
+    matomo = Matomo(app, client=matomo_client, matomo_url="http://trackingserver", id_site=1)
+
+    def late():
+        return "late"
+
+    app.add_url_rule("/late", view_func=late)
+
+    with httpx.Client(
+        transport=httpx.WSGITransport(app=app), base_url="http://testserver"
+    ) as client:
+        client.get("/late")
+        assert matomo_client.post.call_args.kwargs["data"]["action_name"] == "/late"
+
+        matomo.details(action_name="Late")(late)
+        client.get("/late")
+        assert matomo_client.post.call_args.kwargs["data"]["action_name"] == "Late"
+
+
+def test_not_found_is_tracked_as_not_found(client, matomo_client):
+    response = client.get("/does/not/exist")
+    assert response.status_code == 404
+
+    data = matomo_client.post.call_args.kwargs["data"]
+    assert data["action_name"] == "Not Found"
+    assert data["url"] == "http://testserver/does/not/exist"
+
+
+def test_default_client_is_tuned_for_tracking():
+    with mock.patch("httpx.Client", wraps=httpx.Client) as client_class:
+        matomo = Matomo(matomo_url="http://trackingserver", id_site=1)
+
+    client_class.assert_called_once_with(
+        http2=False,
+        limits=httpx.Limits(
+            max_connections=20, max_keepalive_connections=20, keepalive_expiry=60.0
+        ),
+        timeout=httpx.Timeout(5.0, connect=2.0, pool=1.0),
+    )
+    assert matomo.client.timeout == httpx.Timeout(5.0, connect=2.0, pool=1.0)
+
+
+def test_default_client_can_be_configured():
+    matomo = Matomo(
+        matomo_url="http://trackingserver",
+        id_site=1,
+        send_mode="async",
+        max_connections=50,
+        keepalive_expiry=10.0,
+        connect_timeout=0.5,
+        read_timeout=1.0,
+    )
+
+    assert isinstance(matomo.client, httpx.AsyncClient)
+    assert matomo.client_limits.max_connections == 50
+    assert matomo.client_limits.keepalive_expiry == 10.0
+    assert matomo.client.timeout == httpx.Timeout(1.0, connect=0.5, pool=1.0)
+
+
+def test_sample_rate_tracks_fraction_of_requests_with_weight(matomo_client):
+    app = Flask(__name__)
+    Matomo(
+        app,
+        client=matomo_client,
+        matomo_url="http://trackingserver",
+        id_site=1,
+        sample_rate=0.25,
+    )
+
+    @app.route("/poll")
+    def poll():
+        return "poll"
+
+    client = app.test_client()
+    with mock.patch("random.random", side_effect=[0.1, 0.5, 0.3, 0.2]):
+        for _ in range(4):
+            client.get("/poll")
+
+    assert matomo_client.post.call_count == 2
+    cvar = json.loads(matomo_client.post.call_args.kwargs["data"]["cvar"])
+    assert cvar["sample_weight"] == 4.0
+
+
+def test_details_sample_rate_overrides_global_sample_rate(matomo_client):
+    app = Flask(__name__)
+    matomo = Matomo(app, client=matomo_client, matomo_url="http://trackingserver", id_site=1)
+
+    @app.route("/poll")
+    @matomo.details(sample_rate=0.1)
+    def poll():
+        return "poll"
+
+    @app.route("/foo")
+    def foo():
+        return "foo"
+
+    client = app.test_client()
+    with mock.patch("random.random", return_value=0.5):
+        client.get("/poll")
+        client.get("/foo")
+
+    matomo_client.post.assert_called_once()
+    assert "sample_weight" not in json.loads(matomo_client.post.call_args.kwargs["data"]["cvar"])
+
+
+def test_sampled_out_request_can_use_tracking_state(matomo_client):
+    app = Flask(__name__)
+    Matomo(
+        app, client=matomo_client, matomo_url="http://trackingserver", id_site=1, sample_rate=0.5
+    )
+
+    @app.route("/perf")
+    def perf():
+        with PerfMsTracker(scope=flask.g.flask_matomo2, key="pf_srv"):
+            flask.g.flask_matomo2["custom_tracking_data"] = {"e_a": "Playing"}
+        return "perf"
+
+    client = app.test_client()
+    with mock.patch("random.random", return_value=0.9):
+        response = client.get("/perf")
+
+    assert response.status_code == 200
+    matomo_client.post.assert_not_called()
+
+
+@pytest.mark.parametrize("sample_rate", [0, -0.5, 1.5])
+def test_invalid_sample_rate_raises(sample_rate):
+    with pytest.raises(ValueError, match="sample_rate"):
+        Matomo(matomo_url="http://trackingserver", id_site=1, sample_rate=sample_rate)
+
+
+def test_aggregated_route_is_sent_as_one_event(matomo_client):
+    app = Flask(__name__)
+    matomo = Matomo(
+        app,
+        client=matomo_client,
+        matomo_url="http://trackingserver",
+        id_site=1,
+        base_url="http://testserver",
+    )
+
+    @app.route("/poll")
+    @matomo.details(aggregate=True)
+    def poll():
+        return "poll"
+
+    client = app.test_client()
+    for _ in range(10):
+        client.get("/poll")
+    matomo_client.post.assert_not_called()
+
+    matomo.close()
+
+    matomo_client.post.assert_called_once()
+    data = matomo_client.post.call_args.kwargs["data"]
+    assert data["e_c"] == "flask_matomo2"
+    assert data["e_n"] == "/poll"
+    assert data["e_v"] == 10
+    assert data["url"] == "http://testserver/poll"
+    cvar = json.loads(data["cvar"])
+    assert cvar["hits"] == 10
+    assert cvar["status_2xx"] == 10
+
+
+def test_rate_limited_hits_are_spooled(matomo_client, tmp_path):
+    matomo = Matomo(
+        client=matomo_client,
+        matomo_url="http://trackingserver",
+        id_site=1,
+        spool_dir=tmp_path,
+        max_hits_per_second=2,
+        rate_limit_policy="spool",
+    )
+
+    for rand in range(5):
+        matomo.track(tracking_data={"idsite": "1", "rand": rand})
+
+    assert matomo_client.post.call_count == 2
+    assert matomo.rate_limiter is not None
+    assert matomo.rate_limiter.limited == 3
+    assert matomo.spool is not None
+    received = []
+    matomo.spool.drain(lambda records: received.extend(records) or True)
+    assert len(received) == 3
+
+
+def test_rate_limited_call_does_not_use_half_open_trial(matomo_client, tmp_path):
+    matomo_client.post = mock.Mock(side_effect=httpx.ConnectError("down"))
+    matomo = Matomo(
+        client=matomo_client,
+        matomo_url="http://trackingserver",
+        id_site=1,
+        spool_dir=tmp_path,
+        circuit_breaker_threshold=1,
+        circuit_breaker_timeout=30.0,
+        max_hits_per_second=1,
+        rate_limit_policy="spool",
+    )
+    assert matomo.circuit_breaker is not None
+    assert matomo.rate_limiter is not None
+    now = [matomo.rate_limiter.clock()]
+    matomo.circuit_breaker.clock = lambda: now[0]
+    matomo.rate_limiter.clock = lambda: now[0]
+
+    matomo.track(tracking_data={"idsite": "1", "rand": 1})
+    assert matomo.circuit_breaker.state == "open"
+
+    # the breaker is ready for a trial call, but the rate limit is reached
+    now[0] += 30.0
+    matomo.rate_limiter.try_acquire(hits=1)
+    matomo.track(tracking_data={"idsite": "1", "rand": 2})
+    assert matomo_client.post.call_count == 1
+
+    matomo_client.post = mock.Mock(return_value=httpx.Response(200))
+    now[0] += 1.0
+    matomo.track(tracking_data={"idsite": "1", "rand": 3})
+
+    assert matomo_client.post.call_count == 1
+    assert matomo.circuit_breaker.state == "closed"
+
+
+def test_rate_limited_calls_wait(matomo_client):
+    matomo = Matomo(
+        client=matomo_client,
+        matomo_url="http://trackingserver",
+        id_site=1,
+        max_hits_per_second=10,
+    )
+
+    with mock.patch("time.sleep") as sleep:
+        matomo.track_records([b"idsite=1"] * 10)
+        matomo.track(tracking_data={"idsite": "1"})
+
+    assert matomo_client.post.call_count == 2
+    sleep.assert_called_once()
+    assert sleep.call_args.args[0] == pytest.approx(0.1, abs=0.01)
+
+
+def test_rate_limited_calls_wait_at_most_rate_limit_max_wait(matomo_client, tmp_path):
+    matomo = Matomo(
+        client=matomo_client,
+        matomo_url="http://trackingserver",
+        id_site=1,
+        spool_dir=tmp_path,
+        max_hits_per_second=10,
+        rate_limit_max_wait=0.5,
+    )
+
+    with mock.patch("time.sleep") as sleep:
+        matomo.track_records([b"idsite=1"] * 10)
+        for rand in range(8):
+            matomo.track(tracking_data={"idsite": "1", "rand": rand})
+
+    assert matomo_client.post.call_count == 6
+    assert max(call.args[0] for call in sleep.call_args_list) <= 0.5
+    assert matomo.spool is not None
+    received = []
+    matomo.spool.drain(lambda records: received.extend(records) or True)
+    assert len(received) == 3
+    metrics = matomo.metrics.snapshot()
+    assert metrics["flask_matomo2_rate_limit_hit_tokens"] == pytest.approx(-5.0, abs=0.1)
+
+
+def test_batch_bigger_than_rate_limit_bucket_is_sent(matomo_client, tmp_path):
+    matomo = Matomo(
+        client=matomo_client,
+        matomo_url="http://trackingserver",
+        id_site=1,
+        spool_dir=tmp_path,
+        max_hits_per_second=20,
+    )
+
+    with mock.patch("time.sleep") as sleep:
+        matomo.track_records([b"idsite=1"] * 100)
+
+    assert matomo_client.post.call_count == 1
+    sleep.assert_not_called()
+    assert matomo.spool is not None
+    assert not matomo.spool.pending
+
+
+def test_negative_rate_limit_max_wait_raises():
+    with pytest.raises(ValueError, match="rate_limit_max_wait"):
+        Matomo(matomo_url="http://trackingserver", id_site=1, rate_limit_max_wait=-1)
+
+
+def test_unknown_rate_limit_policy_raises():
+    with pytest.raises(ValueError, match="rate_limit_policy"):
+        Matomo(matomo_url="http://trackingserver", id_site=1, rate_limit_policy="ignore")
+
+
+def test_background_queue_keeps_error_and_slow_hits_under_load(matomo_client):
+    matomo = Matomo(
+        client=matomo_client,
+        matomo_url="http://trackingserver",
+        id_site=1,
+        send_mode="background",
+        max_queue_size=2,
+        slow_request_ms=500.0,
+    )
+    assert matomo.dispatcher is not None
+    tracking_queue = matomo.dispatcher.queue
+
+    tracking_queue.put({"gt_ms": 10.0, "cvar": {"http_status_code": 200}})
+    tracking_queue.put({"gt_ms": 900.0, "cvar": {"http_status_code": 200}})
+    tracking_queue.put({"gt_ms": 10.0, "cvar": {"http_status_code": 502}})
+    tracking_queue.put({"gt_ms": 10.0, "cvar": {"http_status_code": 404}})
+
+    assert matomo.dropped_hits == 2
+    assert matomo.dropped_hits_by_lane == {"error": 0, "slow": 0, "normal": 2}
+    assert tracking_queue.get()["cvar"]["http_status_code"] == 502
+    assert tracking_queue.get()["gt_ms"] == 900.0
+
+
+def test_slow_request_ms_classifies_tracked_requests_in_milliseconds(matomo_client):
+    app = Flask(__name__)
+    matomo = Matomo(
+        app,
+        client=matomo_client,
+        matomo_url="http://trackingserver",
+        id_site=1,
+        slow_request_ms=50.0,
+    )
+
+    @app.route("/fast")
+    def fast():
+        time.sleep(0.005)
+        return "fast"
+
+    @app.route("/slow")
+    def slow():
+        time.sleep(0.06)
+        return "slow"
+
+    client = app.test_client()
+    with mock.patch.object(matomo, "_send_hit") as send_hit:
+        client.get("/fast")
+        client.get("/slow")
+
+    fast_hit, slow_hit = (call.args[0] for call in send_hit.call_args_list)
+    assert 5 <= fast_hit["gt_ms"] < 50
+    # the "normal" and "slow" lanes
+    assert matomo._classify_hit(fast_hit) == 2
+    assert matomo._classify_hit(slow_hit) == 1
+
+
+def test_metrics_count_tracked_ignored_and_sampled_hits(matomo_client):
+    app = Flask(__name__)
+    matomo = Matomo(
+        app,
+        client=matomo_client,
+        matomo_url="http://trackingserver",
+        id_site=1,
+        ignored_routes=["/health"],
+        ignored_ua_patterns=["creepy-bot.*"],
+    )
+
+    @app.route("/foo")
+    def foo():
+        return "foo"
+
+    @app.route("/health")
+    def health():
+        return "ok"
+
+    @app.route("/poll")
+    @matomo.details(sample_rate=0.1)
+    def poll():
+        return "poll"
+
+    client = app.test_client()
+    client.get("/foo")
+    client.get("/health")
+    client.get("/foo", headers={"user-agent": "creepy-bot"})
+    with mock.patch("random.random", return_value=0.5):
+        client.get("/poll")
+
+    metrics = matomo.metrics.snapshot()
+    assert metrics["flask_matomo2_hits_tracked_total"] == 1
+    assert metrics["flask_matomo2_hits_ignored_total"] == 2
+    assert metrics["flask_matomo2_hits_sampled_out_total"] == 1
+    assert metrics["flask_matomo2_hits_dropped_total"] == 0
+    assert metrics["flask_matomo2_send_latency_seconds"]["count"] == 1
+    assert metrics["flask_matomo2_before_request_seconds"]["count"] == 4
+    assert metrics["flask_matomo2_teardown_request_seconds"]["count"] == 1
+
+
+def test_metrics_count_hits_dropped_without_spool(matomo_client):
+    matomo_client.post = mock.Mock(side_effect=httpx.ConnectError("down"))
+    matomo = Matomo(
+        client=matomo_client,
+        matomo_url="http://trackingserver",
+        id_site=1,
+        circuit_breaker_threshold=1,
+    )
+
+    matomo.track(tracking_data={"idsite": "1"})
+    matomo.track(tracking_data={"idsite": "1"})
+    matomo.track_records([b"idsite=1"] * 3)
+
+    assert matomo_client.post.call_count == 1
+    assert matomo.dropped_hits == 5
+    assert matomo.metrics.snapshot()["flask_matomo2_hits_dropped_total"] == 5
+
+
+def test_metrics_count_retries_and_circuit_breaker_state(matomo_client):
+    matomo_client.post.return_value = Response(status_code=503)
+    matomo = Matomo(
+        client=matomo_client,
+        matomo_url="http://trackingserver",
+        id_site=1,
+        max_retries=2,
+        retry_backoff=0.0,
+        circuit_breaker_threshold=1,
+    )
+
+    matomo.track(tracking_data={"idsite": "1"})
+
+    metrics = matomo.metrics.snapshot()
+    assert metrics["flask_matomo2_retries_total"] == 2
+    assert metrics["flask_matomo2_send_errors_total"] == 1
+    assert metrics["flask_matomo2_send_latency_seconds"]["count"] == 3
+    assert metrics["flask_matomo2_circuit_breaker_state"] == 2
+
+
+def test_metrics_endpoint_serves_prometheus_text(matomo_client):
+    app = Flask(__name__)
+    Matomo(
+        app,
+        client=matomo_client,
+        matomo_url="http://trackingserver",
+        id_site=1,
+        send_mode="background",
+        metrics_path="/metrics",
+    )
+
+    response = app.test_client().get("/metrics")
+
+    assert response.status_code == 200
+    assert response.content_type.startswith("text/plain; version=0.0.4")
+    text = response.get_data(as_text=True)
+    assert "# TYPE flask_matomo2_hits_tracked_total counter\n" in text
+    assert "flask_matomo2_queue_depth 0\n" in text
+    assert 'flask_matomo2_send_latency_seconds_bucket{le="+Inf"} 0\n' in text
+    # the metrics endpoint itself isn't tracked
+    matomo_client.post.assert_not_called()
+
+
+def test_file_send_mode_writes_hits_instead_of_calling_matomo(matomo_client, tmp_path):
+    app = Flask(__name__)
+    matomo = Matomo(
+        app,
+        client=matomo_client,
+        matomo_url="http://trackingserver",
+        id_site=1,
+        token_auth="FAKE_TOKEN",  # noqa: S106
+        send_mode="file",
+        hit_log_dir=tmp_path,
+    )
+
+    @app.route("/foo")
+    def foo():
+        return "foo"
+
+    app.test_client().get("/foo")
+    matomo.close()
+
+    matomo_client.post.assert_not_called()
+    assert matomo.hit_log is not None
+    (path,) = matomo.hit_log.files()
+    (hit,) = (json.loads(line) for line in path.read_text().splitlines())
+    assert hit["url"] == "http://localhost/foo"
+    assert hit["cvar"] == {"http_status_code": 200, "http_method": "GET"}
+    assert "token_auth" not in hit
+    assert "cdt" in hit
+
+
+def test_file_send_mode_requires_hit_log_dir():
+    with pytest.raises(ValueError, match="hit_log_dir"):
+        Matomo(matomo_url="http://trackingserver", id_site=1, send_mode="file")
+
+
+def create_streaming_app(transport: InMemoryTransport, **kwargs) -> Flask:
+    app = Flask(__name__)
+    Matomo(app, matomo_url="http://trackingserver", id_site=1, transport=transport, **kwargs)
+
+    @app.route("/export")
+    def export():
+        @flask.stream_with_context
+        def generate():
+            for _ in range(3):
+                time.sleep(0.02)
+                yield "x" * 10
+            flask.g.flask_matomo2["custom_tracking_data"] = {"e_a": "Exported"}
+
+        return flask.Response(generate())
+
+    return app
+
+
+def test_streamed_response_is_tracked_when_closed():
+    transport = InMemoryTransport()
+    app = create_streaming_app(transport, defer_streamed_responses=True)
+
+    response = app.test_client().get("/export", buffered=False)
+    assert transport.hits == []
+    assert response.get_data() == b"x" * 30
+    response.close()
+
+    (hit,) = transport.hits
+    assert hit["e_a"] == "Exported"
+    assert hit["cvar"]["http_status_code"] == 200
+    assert hit["cvar"]["stream_bytes"] == 30
+    assert 60 <= hit["cvar"]["stream_ms"] <= hit["gt_ms"]
+
+
+def test_streamed_response_is_tracked_at_teardown_by_default():
+    transport = InMemoryTransport()
+    app = create_streaming_app(transport)
+
+    response = app.test_client().get("/export", buffered=False)
+    (hit,) = transport.hits
+    response.close()
+
+    assert hit["gt_ms"] < 60
+    assert "stream_bytes" not in hit["cvar"]
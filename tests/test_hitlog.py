@@ -0,0 +1,140 @@
+import gzip
+import os
+import threading
+import time
+from unittest import mock
+
+from flask_matomo2.hitlog import HitLog, read_hits
+
+
+class Clock:
+    def __init__(self) -> None:
+        self.now = 1_700_000_000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def read_all(hit_log: HitLog) -> list:
+    return [hit for path in hit_log.files() for hit in read_hits(path)]
+
+
+def test_hit_log_writes_ndjson_without_token_auth(tmp_path):
+    hit_log = HitLog(tmp_path, clock=Clock())
+    hit_log.append({"idsite": "1", "token_auth": "secret", "cvar": {"http_status_code": 200}})
+    hit_log.close()
+
+    assert read_all(hit_log) == [
+        {"idsite": "1", "cvar": {"http_status_code": 200}, "cdt": 1_700_000_000}
+    ]
+
+
+def test_hit_log_rotates_by_size(tmp_path):
+    hit_log = HitLog(tmp_path, max_bytes=70)
+    for rand in range(4):
+        hit_log.append({"idsite": "1", "rand": rand, "cdt": 0})
+    hit_log.close()
+
+    assert len(hit_log.files()) == 2
+    assert [hit["rand"] for hit in read_all(hit_log)] == [0, 1, 2, 3]
+
+
+def test_hit_log_rotates_by_age(tmp_path):
+    clock = Clock()
+    hit_log = HitLog(tmp_path, max_age=60.0, clock=clock)
+    hit_log.append({"idsite": "1", "rand": 0})
+    clock.now += 61.0
+    hit_log.append({"idsite": "1", "rand": 1})
+
+    # the first file is complete, the second is still written
+    assert len(hit_log.files()) == 1
+    assert len(list(tmp_path.iterdir())) == 2
+    hit_log.close()
+    assert [hit["rand"] for hit in read_all(hit_log)] == [0, 1]
+
+
+def test_hit_log_compresses_files(tmp_path):
+    hit_log = HitLog(tmp_path, compress=True)
+    for rand in range(100):
+        hit_log.append({"idsite": "1", "rand": rand})
+    hit_log.close()
+
+    (path,) = hit_log.files()
+    assert path.name.endswith(".ndjson.gz")
+    assert len(gzip.decompress(path.read_bytes()).splitlines()) == 100
+    assert [hit["rand"] for hit in read_hits(path)] == list(range(100))
+
+
+def wait_for(condition, timeout: float = 2.0) -> bool:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def test_hit_log_buffers_writes_until_sync_thread_runs(tmp_path):
+    hit_log = HitLog(tmp_path, fsync_interval=0.05)
+    with mock.patch("os.fsync") as fsync:
+        hit_log.append({"idsite": "1", "rand": 0})
+        hit_log.append({"idsite": "1", "rand": 1})
+        (path,) = tmp_path.iterdir()
+
+        # appending doesn't write or sync, the sync thread does
+        assert path.stat().st_size == 0
+        fsync.assert_not_called()
+        assert wait_for(lambda: path.stat().st_size > 0)
+        assert wait_for(lambda: fsync.called)
+    assert [hit["rand"] for hit in read_hits(path)] == [0, 1]
+    hit_log.close()
+
+
+def test_sync_thread_rotates_old_file_without_new_hits(tmp_path):
+    clock = Clock()
+    hit_log = HitLog(tmp_path, max_age=60.0, fsync_interval=0.01, clock=clock)
+    hit_log.append({"idsite": "1", "rand": 0})
+    assert hit_log.files() == []
+
+    clock.now += 61.0
+
+    assert wait_for(lambda: len(hit_log.files()) == 1)
+    assert [hit["rand"] for hit in read_all(hit_log)] == [0]
+    hit_log.close()
+
+
+def test_hit_log_close_stops_sync_thread(tmp_path):
+    hit_log = HitLog(tmp_path)
+    running = set(threading.enumerate())
+    hit_log.append({"idsite": "1"})
+    (thread,) = set(threading.enumerate()) - running
+    assert thread.name == "flask_matomo2-hitlog"
+
+    hit_log.close()
+
+    assert not thread.is_alive()
+
+
+def test_open_compressed_file_is_readable_up_to_last_sync(tmp_path):
+    clock = Clock()
+    hit_log = HitLog(tmp_path, compress=True, fsync_interval=10.0, clock=clock)
+    hit_log.append({"idsite": "1", "rand": 0})
+    hit_log.flush()
+    hit_log.append({"idsite": "1", "rand": 1})
+    (path,) = tmp_path.iterdir()
+
+    assert [hit["rand"] for hit in read_hits(path)] == [0]
+    hit_log.close()
+
+
+def test_hit_log_after_fork_drops_parents_buffer(tmp_path):
+    hit_log = HitLog(tmp_path, fsync_interval=None)
+    hit_log.append({"idsite": "1", "rand": 0})
+
+    hit_log.after_fork()
+    hit_log.append({"idsite": "1", "rand": 1})
+    hit_log.close()
+
+    # the parent's file is left open and not completed by the child
+    assert [hit["rand"] for hit in read_all(hit_log)] == [1]
+    assert len(os.listdir(tmp_path)) == 2
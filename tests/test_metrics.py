@@ -0,0 +1,56 @@
+import threading
+
+from flask_matomo2.metrics import Counter, Histogram, PipelineMetrics
+
+
+def test_histogram_counts_values_in_cumulative_buckets():
+    histogram = Histogram("latency_seconds", "Latency", buckets=(0.1, 1.0))
+
+    for value in (0.05, 0.1, 0.5, 2.0):
+        histogram.observe(value)
+
+    assert histogram.samples() == [
+        ("latency_seconds_bucket", 'le="0.1"', 2),
+        ("latency_seconds_bucket", 'le="1.0"', 3),
+        ("latency_seconds_bucket", 'le="+Inf"', 4),
+        ("latency_seconds_sum", "", 2.65),
+        ("latency_seconds_count", "", 4),
+    ]
+
+
+def test_render_prometheus_includes_gauges():
+    metrics = PipelineMetrics()
+    metrics.add_gauge("queue_depth", "Hits in the queue.", lambda: 7)
+    metrics.add_gauge("dropped_total", "Dropped hits.", lambda: 3, type="counter")
+
+    text = metrics.render_prometheus()
+
+    assert (
+        "# HELP queue_depth Hits in the queue.\n# TYPE queue_depth gauge\nqueue_depth 7\n"
+        in text
+    )
+    assert "# TYPE dropped_total counter\ndropped_total 3\n" in text
+
+
+def test_after_fork_resets_counters_and_histograms():
+    metrics = PipelineMetrics()
+    metrics.hits_tracked.inc(5)
+    metrics.send_latency.observe(0.01)
+
+    metrics.after_fork()
+
+    assert metrics.hits_tracked.value == 0
+    assert metrics.send_latency.snapshot()["count"] == 0
+
+
+def test_counter_is_thread_safe():
+    counter = Counter("hits_total", "Hits")
+    threads = [
+        threading.Thread(target=lambda: [counter.inc() for _ in range(1000)]) for _ in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert counter.value == 4000
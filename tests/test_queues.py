@@ -0,0 +1,105 @@
+import queue
+import threading
+
+import pytest
+
+from flask_matomo2.queues import TrackingQueue
+
+
+def test_tracking_queue_drop_newest_keeps_oldest():
+    q = TrackingQueue(max_items=2, overflow_policy="drop_newest")
+
+    assert [q.put({"rand": i}) for i in range(4)] == [True, True, False, False]
+
+    assert q.dropped == 2
+    assert [q.get(), q.get()] == [{"rand": 0}, {"rand": 1}]
+
+
+def test_tracking_queue_drop_oldest_keeps_newest():
+    q = TrackingQueue(max_items=2, overflow_policy="drop_oldest")
+
+    assert all(q.put({"rand": i}) for i in range(4))
+
+    assert q.dropped == 2
+    assert [q.get(), q.get()] == [{"rand": 2}, {"rand": 3}]
+
+
+def test_tracking_queue_block_drops_after_timeout():
+    q = TrackingQueue(max_items=1, overflow_policy="block", block_timeout=0.01)
+    q.put({"rand": 0})
+
+    assert not q.put({"rand": 1})
+    assert q.dropped == 1
+
+
+def test_tracking_queue_block_waits_for_room():
+    q = TrackingQueue(max_items=1, overflow_policy="block", block_timeout=5.0)
+    q.put({"rand": 0})
+    timer = threading.Timer(0.05, q.get)
+    timer.start()
+
+    assert q.put({"rand": 1})
+    assert q.dropped == 0
+    timer.join()
+
+
+def test_tracking_queue_is_bounded_by_bytes():
+    q = TrackingQueue(max_bytes=100, size_of=lambda _item: 40)
+
+    assert [q.put({"rand": i}) for i in range(3)] == [True, True, False]
+    assert q.bytes == 80
+
+    q.get()
+    assert q.bytes == 40
+
+
+def test_tracking_queue_put_control_ignores_limits():
+    q = TrackingQueue(max_items=1)
+    q.put({"rand": 0})
+    q.put_control("stop")
+
+    assert len(q) == 2
+    assert q.dropped == 0
+
+
+def test_tracking_queue_get_raises_empty_on_timeout():
+    q = TrackingQueue()
+    with pytest.raises(queue.Empty):
+        q.get(timeout=0.01)
+
+
+def test_tracking_queue_rejects_unknown_overflow_policy():
+    with pytest.raises(ValueError):
+        TrackingQueue(overflow_policy="drop_random")
+
+
+def test_tracking_queue_sheds_lower_lanes_first():
+    q = TrackingQueue(
+        max_items=2,
+        lanes=("error", "normal"),
+        classify=lambda item: 0 if item["status"] >= 500 else 1,
+    )
+    q.put({"status": 200, "rand": 0})
+    q.put({"status": 200, "rand": 1})
+
+    assert q.put({"status": 500, "rand": 2})
+    assert q.put({"status": 503, "rand": 3})
+    assert not q.put({"status": 200, "rand": 4})
+    assert not q.put({"status": 500, "rand": 5})
+
+    assert q.dropped == 4
+    assert q.dropped_by_lane == {"error": 1, "normal": 3}
+    assert [q.get()["rand"], q.get()["rand"]] == [2, 3]
+
+
+def test_tracking_queue_gets_higher_lanes_first_and_control_items_last():
+    q = TrackingQueue(lanes=("error", "normal"), classify=lambda item: item["lane"])
+    q.put({"lane": 1, "rand": 0})
+    q.put_control("stop")
+    q.put({"lane": 0, "rand": 1})
+
+    assert [q.get(), q.get(), q.get()] == [
+        {"lane": 0, "rand": 1},
+        {"lane": 1, "rand": 0},
+        "stop",
+    ]
@@ -0,0 +1,57 @@
+import pytest
+
+from flask_matomo2.ratelimit import RateLimiter
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_rate_limiter_refills_tokens_over_time():
+    clock = FakeClock()
+    limiter = RateLimiter(hits_per_second=2, clock=clock)
+
+    assert limiter.try_acquire()
+    assert limiter.try_acquire()
+    assert not limiter.try_acquire()
+    clock.now = 0.5
+    assert limiter.try_acquire()
+    assert limiter.limited == 1
+
+
+def test_rate_limiter_limits_bytes():
+    clock = FakeClock()
+    limiter = RateLimiter(bytes_per_second=100, clock=clock)
+
+    assert limiter.try_acquire(nbytes=80)
+    assert not limiter.try_acquire(nbytes=80)
+    assert limiter.tokens() == {"bytes": 20}
+
+
+def test_rate_limiter_lets_call_bigger_than_burst_through_when_full():
+    clock = FakeClock()
+    limiter = RateLimiter(hits_per_second=10, clock=clock)
+
+    assert limiter.try_acquire(hits=100)
+    # the next call waits until the big call is paid off
+    assert limiter.reserve(hits=1) == pytest.approx(9.1)
+
+
+def test_rate_limiter_reserves_call_bigger_than_burst_when_full():
+    clock = FakeClock()
+    limiter = RateLimiter(hits_per_second=20, bytes_per_second=10_000, clock=clock)
+
+    assert limiter.reserve(hits=100, nbytes=30_000, max_wait=1.0) == 0.0
+    # the debt of the big call is paid off before the next big call
+    assert limiter.reserve(hits=100, nbytes=30_000, max_wait=1.0) is None
+    clock.now = 4.0
+    assert limiter.reserve(hits=100, nbytes=30_000, max_wait=1.0) == pytest.approx(1.0)
+
+
+def test_rate_limiter_requires_a_limit():
+    with pytest.raises(ValueError, match="must be set"):
+        RateLimiter()
@@ -0,0 +1,105 @@
+import pytest
+from flask import Flask
+
+from flask_matomo2 import Matomo
+from flask_matomo2.hitlog import HitLog
+from flask_matomo2.replay import replay
+from flask_matomo2.spool import Spool
+from flask_matomo2.testing import FakeMatomo
+
+
+@pytest.fixture(name="fake_matomo")
+def fixture_fake_matomo():
+    with FakeMatomo() as fake:
+        yield fake
+
+
+@pytest.fixture(name="app")
+def fixture_app(fake_matomo) -> Flask:
+    app = Flask(__name__)
+    Matomo(app, matomo_url=fake_matomo.url, id_site=1, token_auth="FAKE_TOKEN")  # noqa: S106
+    return app
+
+
+def write_hit_log(directory, count: int, *, compress: bool = False) -> None:
+    hit_log = HitLog(directory, compress=compress, max_bytes=500)
+    for rand in range(count):
+        hit_log.append({"idsite": "1", "rand": rand, "cvar": {"http_status_code": 200}})
+    hit_log.close()
+
+
+def test_replay_sends_hit_logs_and_spool_segments(app, fake_matomo, tmp_path):
+    write_hit_log(tmp_path / "hits", 25, compress=True)
+    spool = Spool(tmp_path / "spool")
+    spool.extend([f"idsite=1&rand={rand}".encode() for rand in range(25, 30)])
+    spool.close()
+
+    args = ["matomo", "replay", str(tmp_path / "hits"), str(tmp_path / "spool")]
+    result = app.test_cli_runner().invoke(
+        args=[*args, "--batch-size", "10", "--concurrency", "2"]
+    )
+
+    assert result.exit_code == 0, result.output
+    assert "Sent 30 hits" in result.output
+    assert sorted(int(hit["rand"]) for hit in fake_matomo.hits) == list(range(30))
+    assert fake_matomo.requests == fake_matomo.bulk_requests
+    (first_hit,) = (hit for hit in fake_matomo.hits if hit["rand"] == "0")
+    assert first_hit["cvar"] == '{"http_status_code": 200}'
+    assert "cdt" in first_hit
+
+
+def test_replay_resumes_from_checkpoint(app, fake_matomo, tmp_path):
+    write_hit_log(tmp_path / "hits", 30)
+    checkpoint = str(tmp_path / "checkpoint.json")
+    args = ["matomo", "replay", str(tmp_path / "hits"), "--batch-size", "10"]
+    args += ["--concurrency", "1", "--max-retries", "0", "--checkpoint", checkpoint]
+    runner = app.test_cli_runner()
+
+    fake_matomo.error_rate = 1.0
+    result = runner.invoke(args=args)
+    assert result.exit_code == 1
+    assert "run again to resume" in result.output
+
+    fake_matomo.error_rate = 0.0
+    assert runner.invoke(args=args).exit_code == 0
+    fake_matomo.reset()
+    result = runner.invoke(args=args)
+
+    assert result.exit_code == 0, result.output
+    assert "Resuming" in result.output
+    assert fake_matomo.hits == []
+
+
+def test_replay_fails_when_matomo_rejects_batch(app, fake_matomo, tmp_path):
+    write_hit_log(tmp_path / "hits", 30)
+    checkpoint = tmp_path / "checkpoint.json"
+    args = ["matomo", "replay", str(tmp_path / "hits"), "--batch-size", "10"]
+    args += ["--concurrency", "1", "--checkpoint", str(checkpoint)]
+    # e.g. an invalid token_auth
+    fake_matomo.error_rate = 1.0
+    fake_matomo.error_status = 400
+
+    result = app.test_cli_runner().invoke(args=args)
+
+    assert result.exit_code == 1
+    assert "Sent 0 hits" in result.output
+    assert "run again to resume" in result.output
+    assert not checkpoint.exists()
+
+
+def test_replay_stops_at_first_failed_batch():
+    sent = []
+
+    def send_batch(batch):
+        if batch == [b"c"]:
+            return False
+        sent.append(batch)
+        return True
+
+    batches = [((0, 1), [b"a"]), ((0, 2), [b"b"]), ((0, 3), [b"c"]), ((0, 4), [b"d"])]
+    result = replay(batches, send_batch, concurrency=1)
+
+    assert result.failed
+    assert result.sent == 2
+    assert result.position == (0, 2)
+    assert sent == [[b"a"], [b"b"]]
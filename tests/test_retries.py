@@ -0,0 +1,80 @@
+import pytest
+
+from flask_matomo2.retries import CircuitBreaker, RetryPolicy
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_retry_policy_backoff_is_capped():
+    policy = RetryPolicy(max_retries=10, backoff_base=1.0, backoff_max=5.0, jitter=False)
+
+    assert [policy.backoff(attempt) for attempt in range(5)] == [1.0, 2.0, 4.0, 5.0, 5.0]
+
+
+def test_retry_policy_backoff_is_jittered():
+    policy = RetryPolicy(max_retries=10, backoff_base=1.0, backoff_max=5.0)
+
+    assert all(0 <= policy.backoff(3) <= 5.0 for _ in range(100))
+
+
+def test_retry_policy_rejects_negative_retries():
+    with pytest.raises(ValueError):
+        RetryPolicy(max_retries=-1)
+
+
+def test_circuit_breaker_opens_after_threshold():
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=10.0, clock=FakeClock())
+
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.allow_request()
+
+    breaker.record_failure()
+    assert breaker.state == "open"
+    assert not breaker.allow_request()
+    assert breaker.rejected == 1
+
+
+def test_circuit_breaker_success_resets_failures():
+    breaker = CircuitBreaker(failure_threshold=2, clock=FakeClock())
+
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+
+    assert breaker.state == "closed"
+
+
+def test_circuit_breaker_lets_one_trial_through_after_timeout():
+    clock = FakeClock()
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10.0, clock=clock)
+    breaker.record_failure()
+
+    clock.now = 10.0
+    assert breaker.state == "half_open"
+    assert breaker.allow_request()
+    assert not breaker.allow_request()
+
+    breaker.record_success()
+    assert breaker.state == "closed"
+    assert breaker.allow_request()
+
+
+def test_circuit_breaker_reopens_when_trial_fails():
+    clock = FakeClock()
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10.0, clock=clock)
+    breaker.record_failure()
+
+    clock.now = 10.0
+    assert breaker.allow_request()
+    breaker.record_failure()
+
+    assert breaker.state == "open"
+    clock.now = 15.0
+    assert not breaker.allow_request()
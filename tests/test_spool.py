@@ -0,0 +1,117 @@
+from flask_matomo2.spool import Spool, iter_records
+
+
+def test_spool_drains_records_in_order(tmp_path):
+    spool = Spool(tmp_path)
+    spool.extend([f"idsite=1&rand={i}".encode() for i in range(5)])
+    batches = []
+
+    def send_batch(records):
+        batches.append(records)
+        return True
+
+    assert spool.drain(send_batch, batch_size=2) == 5
+
+    assert batches == [
+        [b"idsite=1&rand=0", b"idsite=1&rand=1"],
+        [b"idsite=1&rand=2", b"idsite=1&rand=3"],
+        [b"idsite=1&rand=4"],
+    ]
+    assert not spool.pending
+    assert spool.segments() == []
+
+
+def test_spool_keeps_records_when_send_fails(tmp_path):
+    spool = Spool(tmp_path)
+    spool.extend([f"rand={i}".encode() for i in range(4)])
+    sent = []
+
+    def send_batch(records):
+        if len(sent) >= 2:
+            return False
+        sent.extend(records)
+        return True
+
+    assert spool.drain(send_batch, batch_size=2) == 2
+    assert spool.pending
+
+    assert spool.drain(lambda records: sent.extend(records) or True, batch_size=2) == 2
+    assert sent == [b"rand=0", b"rand=1", b"rand=2", b"rand=3"]
+
+
+def test_spool_rotates_segments(tmp_path):
+    spool = Spool(tmp_path, max_segment_bytes=20)
+    spool.extend([b"a" * 10, b"b" * 10, b"c" * 10])
+    spool.close()
+
+    segments = spool.segments()
+    assert len(segments) == 3
+    assert [record for segment in segments for _, record in iter_records(segment)] == [
+        b"a" * 10,
+        b"b" * 10,
+        b"c" * 10,
+    ]
+
+
+def test_spool_removes_oldest_segments_when_full(tmp_path):
+    spool = Spool(tmp_path, max_segment_bytes=20, max_segments=2)
+    spool.extend([b"a" * 10, b"b" * 10, b"c" * 10])
+
+    assert spool.dropped_segments == 1
+    received = []
+    spool.drain(lambda records: received.extend(records) or True)
+    assert received == [b"b" * 10, b"c" * 10]
+
+
+def test_spool_survives_restart(tmp_path):
+    spool = Spool(tmp_path)
+    spool.append(b"rand=0")
+    spool.close()
+
+    spool = Spool(tmp_path)
+    spool.append(b"rand=1")
+    received = []
+
+    assert spool.pending
+    spool.drain(lambda records: received.extend(records) or True)
+    assert received == [b"rand=0", b"rand=1"]
+
+
+def test_iter_records_skips_truncated_record(tmp_path):
+    spool = Spool(tmp_path)
+    spool.extend([b"rand=0", b"rand=1"])
+    spool.close()
+    segment = spool.segments()[0]
+    segment.write_bytes(segment.read_bytes()[:-2])
+
+    assert [record for _, record in iter_records(segment)] == [b"rand=0"]
+
+
+def test_spool_doesnt_drain_segment_written_by_other_process(tmp_path):
+    writer = Spool(tmp_path)
+    writer.append(b"rand=0")
+    drainer = Spool(tmp_path)
+    received = []
+
+    assert drainer.drain(lambda records: received.extend(records) or True) == 0
+    assert drainer.pending
+
+    writer.close()
+    assert drainer.drain(lambda records: received.extend(records) or True) == 1
+    assert received == [b"rand=0"]
+
+
+def test_spool_after_fork_writes_to_own_segment(tmp_path):
+    spool = Spool(tmp_path)
+    spool.append(b"rand=0")
+
+    spool.after_fork()
+    spool.append(b"rand=1")
+    spool.close()
+
+    segments = spool.segments()
+    assert len(segments) == 2
+    assert [record for segment in segments for _, record in iter_records(segment)] == [
+        b"rand=0",
+        b"rand=1",
+    ]
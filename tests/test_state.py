@@ -0,0 +1,42 @@
+import pytest
+
+from flask_matomo2.state import TrackingState
+from flask_matomo2.trackers import PerfMsTracker
+
+
+def test_tracking_state_supports_item_access():
+    state = TrackingState(start_ns=1, tracking_data={"idsite": "1"})
+
+    assert state["tracking"] is True
+    assert state["tracking_data"] == {"idsite": "1"}
+    assert "custom_tracking_data" not in state
+    assert state.get("custom_tracking_data", {}) == {}
+
+    state["custom_tracking_data"] = {"e_a": "Playing"}
+    assert "custom_tracking_data" in state
+    assert state.custom_tracking_data == {"e_a": "Playing"}
+
+
+def test_tracking_state_rejects_unknown_keys():
+    state = TrackingState(start_ns=1, tracking_data={})
+
+    with pytest.raises(KeyError):
+        state["unknown"] = 1
+    with pytest.raises(KeyError):
+        state["unknown"]
+
+
+def test_tracking_state_has_no_instance_dict():
+    state = TrackingState(start_ns=1, tracking_data={})
+
+    with pytest.raises(AttributeError):
+        state.unknown = 1  # type: ignore[attr-defined]
+
+
+def test_perf_ms_tracker_works_with_tracking_state():
+    state = TrackingState(start_ns=1, tracking_data={})
+
+    with PerfMsTracker(scope=state, key="pf_srv"):  # type: ignore[arg-type]
+        pass
+
+    assert "pf_srv" in state.tracking_data
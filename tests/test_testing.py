@@ -0,0 +1,86 @@
+import httpx
+import pytest
+from flask import Flask
+
+from flask_matomo2 import Matomo
+from flask_matomo2.testing import FakeMatomo, Phase
+
+
+@pytest.fixture(name="fake_matomo")
+def fixture_fake_matomo():
+    with FakeMatomo(seed=0) as fake:
+        yield fake
+
+
+def test_fake_matomo_records_single_hits(fake_matomo):
+    app = Flask(__name__)
+    Matomo(app, matomo_url=fake_matomo.url, id_site=1)
+
+    @app.route("/foo")
+    def foo():
+        return "foo"
+
+    app.test_client().get("/foo")
+
+    assert len(fake_matomo.hits) == 1
+    assert fake_matomo.hits[0]["url"] == "http://localhost/foo"
+    assert fake_matomo.bulk_requests == 0
+
+
+def test_fake_matomo_records_bulk_hits(fake_matomo):
+    matomo = Matomo(
+        matomo_url=fake_matomo.url,
+        id_site=1,
+        send_mode="background",
+        max_batch_size=10,
+        max_batch_delay=10.0,
+    )
+    for rand in range(10):
+        matomo.dispatcher.submit({"idsite": "1", "rand": rand})
+
+    matomo.close()
+
+    assert [hit["rand"] for hit in fake_matomo.hits] == [str(rand) for rand in range(10)]
+    assert fake_matomo.requests == fake_matomo.bulk_requests == 1
+
+
+def test_fake_matomo_reports_invalid_hits(fake_matomo):
+    response = httpx.post(fake_matomo.url, json={"requests": ["?rec=1", "?idsite=1"]})
+
+    assert response.json()["invalid_indices"] == [0]
+    assert httpx.post(fake_matomo.url, data={"rec": "1"}).status_code == 400
+
+
+def test_retries_recover_from_errors(fake_matomo):
+    fake_matomo.error_rate = 0.5
+    matomo = Matomo(matomo_url=fake_matomo.url, id_site=1, max_retries=10, retry_backoff=0.0)
+
+    for rand in range(20):
+        matomo.track(tracking_data={"idsite": "1", "rand": rand})
+
+    assert len(fake_matomo.hits) == 20
+    assert fake_matomo.errors > 0
+
+
+def test_hits_are_spooled_during_outage(fake_matomo, tmp_path):
+    matomo = Matomo(matomo_url=fake_matomo.url, id_site=1, spool_dir=tmp_path)
+    fake_matomo.outage(60.0)
+
+    matomo.track(tracking_data={"idsite": "1", "rand": 1})
+
+    assert fake_matomo.hits == []
+    assert matomo.spool is not None
+    assert matomo.spool.pending
+
+    fake_matomo.script([])
+    matomo.track(tracking_data={"idsite": "1", "rand": 2})
+
+    assert sorted(hit["rand"] for hit in fake_matomo.hits) == ["1", "2"]
+
+
+def test_script_runs_phases_in_order():
+    fake = FakeMatomo()
+    fake.script([Phase(0.0, down=True), Phase(60.0, latency_ms=5.0)])
+
+    assert fake.behaviour() == Phase(60.0, latency_ms=5.0)
+    fake.stop()
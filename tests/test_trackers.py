@@ -0,0 +1,67 @@
+import asyncio
+import time
+
+import pytest
+from flask import Flask
+
+from flask_matomo2 import Matomo
+from flask_matomo2.trackers import PerfMsTracker, Span
+from flask_matomo2.transports import InMemoryTransport
+
+
+@pytest.fixture(name="transport")
+def fixture_transport() -> InMemoryTransport:
+    return InMemoryTransport()
+
+
+@pytest.fixture(name="app")
+def fixture_app(transport: InMemoryTransport) -> Flask:
+    app = Flask(__name__)
+    matomo = Matomo(app, matomo_url="http://trackingserver", id_site=1, transport=transport)
+
+    @Span("render", key="pf_srv")
+    def render() -> str:
+        time.sleep(0.02)
+        return "rendered"
+
+    @app.route("/report")
+    def report():
+        with Span("db"):
+            for _ in range(2):
+                with Span("query"):
+                    time.sleep(0.01)
+        return render()
+
+    @app.route("/health")
+    @matomo.ignore()
+    def health():
+        with Span("db"), PerfMsTracker(key="pf_srv"):
+            return "ok"
+
+    return app
+
+
+def test_spans_record_nested_milliseconds(app, transport):
+    app.test_client().get("/report")
+
+    (hit,) = transport.hits
+    assert 20 <= hit["pf_srv"] < 1000
+    assert 20 <= hit["cvar"]["db.query_ms"] <= hit["cvar"]["db_ms"] < 1000
+    assert hit["pf_srv"] + hit["cvar"]["db_ms"] <= hit["gt_ms"] < 5000
+
+
+def test_spans_do_nothing_if_request_isnt_tracked(app, transport):
+    with Span("outside"):
+        pass
+
+    assert app.test_client().get("/health").text == "ok"
+    assert transport.hits == []
+
+
+def test_span_decorates_coroutine_functions():
+    @Span("work")
+    async def work() -> int:
+        return 1
+
+    assert asyncio.iscoroutinefunction(work)
+    assert asyncio.run(work()) == 1
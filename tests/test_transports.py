@@ -0,0 +1,95 @@
+import typing
+
+import pytest
+from flask import Flask
+
+from flask_matomo2 import Matomo
+from flask_matomo2.transports import (
+    DispatcherTransport,
+    FileTransport,
+    HttpTransport,
+    InMemoryTransport,
+    Transport,
+)
+
+
+class RecordingTransport(Transport):
+    def __init__(self) -> None:
+        self.sent: typing.List[typing.Dict] = []
+        self.calls: typing.List[typing.Any] = []
+
+    def send(self, hit):
+        self.sent.append(hit)
+
+    def flush(self):
+        self.calls.append("flush")
+
+    def close(self, timeout=None):
+        self.calls.append(("close", timeout))
+
+    def after_fork(self):
+        self.calls.append("after_fork")
+
+
+def test_transport_without_send_cannot_be_created():
+    class FlushOnlyTransport(Transport):
+        def flush(self):
+            pass
+
+    with pytest.raises(TypeError, match="send"):
+        FlushOnlyTransport()
+
+
+def test_default_transport_follows_send_mode(tmp_path):
+    assert isinstance(
+        Matomo(matomo_url="http://trackingserver", id_site=1).transport, HttpTransport
+    )
+    matomo = Matomo(matomo_url="http://trackingserver", id_site=1, send_mode="background")
+    assert isinstance(matomo.transport, DispatcherTransport)
+    matomo = Matomo(
+        matomo_url="http://trackingserver", id_site=1, send_mode="file", hit_log_dir=tmp_path
+    )
+    assert isinstance(matomo.transport, FileTransport)
+
+
+def test_in_memory_transport_receives_hits_of_requests():
+    app = Flask(__name__)
+    transport = InMemoryTransport()
+    Matomo(app, matomo_url="http://trackingserver", id_site=1, transport=transport)
+
+    @app.route("/foo")
+    def foo():
+        return "foo"
+
+    app.test_client().get("/foo")
+
+    assert [hit["action_name"] for hit in transport.hits] == ["/foo"]
+
+
+def test_matomo_delegates_flush_close_and_after_fork_to_transport():
+    transport = RecordingTransport()
+    matomo = Matomo(matomo_url="http://trackingserver", id_site=1, transport=transport)
+
+    matomo.flush()
+    matomo.after_fork()
+    matomo.close(timeout=2.0)
+
+    assert transport.calls == ["flush", "after_fork", ("close", 2.0)]
+
+
+def test_transport_send_batch_defaults_to_send():
+    transport = RecordingTransport()
+
+    transport.send_batch([{"rand": 1}, {"rand": 2}])
+
+    assert transport.sent == [{"rand": 1}, {"rand": 2}]
+
+
+def test_transport_replaces_send_mode():
+    with pytest.raises(ValueError, match="transport replaces send_mode"):
+        Matomo(
+            matomo_url="http://trackingserver",
+            id_site=1,
+            send_mode="background",
+            transport=InMemoryTransport(),
+        )